@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of sql module hot paths.
+
+Usage:
+    benchmark.py --rows 10000 --save baseline.json
+    benchmark.py --rows 10000 --compare baseline.json
+
+Every benchmark runs in its own process on a synthetic Users table kept in
+a temporary SQLite file and reports operations per second and peak memory
+of the process. Comparison run exits with status 1 if any benchmark is
+slower than the baseline by more than the tolerance.
+"""
+
+import argparse
+import imp
+import json
+import logging
+import os
+import py_compile
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import Process, Queue
+from Queue import Empty
+
+import precompile
+import sql
+
+__author__ = "Gennadiy Zlobin"
+__email__ = "gennad.zlobin@gmail.com"
+__status__ = "Production"
+__version__ = "1.0.0"
+
+BENCHMARKS = []
+
+def benchmark(fn):
+    """
+    Decorator for registering benchmark. Benchmark function receives Db
+    instance and number of rows in the table and returns number of
+    performed operations, or tuple of number of operations and seconds
+    if only part of the benchmark is measured.
+
+    Arguments:
+        fn -- decorated function
+    """
+    BENCHMARKS.append(fn)
+    return fn
+
+def Populate(db, rows):
+    """
+    Creates Users table with deterministic data.
+
+    Arguments:
+        db -- Db instance
+        rows -- number of rows
+    """
+    query = sql.SqlBuilder()
+    query.DropTable(db.Users)
+    query.Execute(db)
+    query.CreateTable(db.Users)
+    query.Execute(db)
+
+    times = [db.Users.last_login_time.to_db('20{0:02d}-01-01'.format(year))
+            for year in xrange(14)]
+    insert = ('INSERT INTO users (id, login, last_login_time, flag, '
+            'position, class_field) VALUES (?, ?, ?, ?, ?, ?)')
+
+    def statements():
+        """Yields INSERT statement per 10000 rows."""
+        for start in xrange(0, rows, 10000):
+            yield insert, [(i, 'user{0}'.format(i), times[i % 14],
+                'AB'[i % 2], i % 10, 'm')
+                for i in xrange(start, min(start + 10000, rows))]
+
+    db.db.ExecuteMany(statements(), bulk=True)
+
+@benchmark
+def build(db, rows):
+    """Builds and compiles query like in GetUsersMapping."""
+    iterations = 20000
+    for _ in xrange(iterations):
+        query = sql.SqlBuilder()
+        query.Select(db.Users.id, db.Users.login).From(db.Users).Where(
+                db.Users.last_login_time < '2012-01-01').And(
+                db.Users.login != 'admin')
+        query.Compile()
+    return iterations
+
+def Templates(db, count):
+    """
+    Builds query templates like the one of GetUsersMapping.
+
+    Arguments:
+        db -- Db instance
+        count -- number of templates
+    Returns:
+        dict from name to SqlBuilder
+    """
+    templates = {}
+    for i in xrange(count):
+        query = sql.SqlBuilder()
+        query.Select(db.Users.id, db.Users.login).From(db.Users).Where(
+                db.Users.last_login_time < sql.Bind('since')).And(
+                db.Users.login != 'admin').And(db.Users.position == i)
+        templates['Users{0}'.format(i)] = query
+    return templates
+
+def Precompiled(db, count):
+    """
+    Writes precompiled module of templates next to the database file and
+    compiles it to bytecode, as it is deployed.
+
+    Arguments:
+        db -- Db instance
+        count -- number of templates
+    Returns:
+        path of the bytecode file
+    """
+    path = os.path.join(os.path.dirname(db.db.name), 'queries.py')
+    with open(path, 'w') as module_file:
+        module_file.write(precompile.Generate(Templates(db, count)))
+    py_compile.compile(path)
+    return path + 'c'
+
+@benchmark
+def startup_build(db, rows):
+    """Builds 300 query templates, i.e. on start of the process."""
+    count = 300
+    Templates(db, count)
+    return count
+
+@benchmark
+def startup_import(db, rows):
+    """Imports module with 300 precompiled queries."""
+    count = 300
+    path = Precompiled(db, count)
+    started = time.time()
+    imp.load_compiled('queries', path)
+    return count, time.time() - started
+
+@benchmark
+def prepared(db, rows):
+    """Binds parameters of precompiled query, compare with build."""
+    iterations = 20000
+    queries = imp.load_compiled('queries', Precompiled(db, 1))
+    started = time.time()
+    for _ in xrange(iterations):
+        queries.Users0('2012-01-01').Compile()
+    return iterations, time.time() - started
+
+@benchmark
+def fetch(db, rows):
+    """Fetches one row by id, i.e. round trip of SQLiteDb.Fetch."""
+    iterations = 2000
+    query = sql.SqlBuilder()
+    for i in xrange(iterations):
+        query.Select(db.Users.login).From(db.Users).Where(
+                db.Users.id == i % rows)
+        query.FetchFrom(db)
+    return iterations
+
+@benchmark
+def replica(db, rows):
+    """Fetches one row by id from in-memory replica of the table."""
+    db = sql.Db('sqlite', {'name': db.db.name, 'replica': [db.Users]})
+    return fetch(db, rows)
+
+@benchmark
+def hydrate(db, rows):
+    """Fetches all rows into Result objects."""
+    query = sql.SqlBuilder()
+    query.Select(db.Users.all).From(db.Users)
+    return len(query.FetchFrom(db))
+
+def PageQueries(db, rows, count=15):
+    """
+    Builds independent cheap queries of one page render, so that cost of
+    connecting is not hidden by table scans.
+
+    Arguments:
+        db -- Db instance
+        rows -- number of rows in the table
+        count -- number of queries
+    Returns:
+        list of SqlBuilder instances
+    """
+    queries = []
+    for i in xrange(count):
+        query = sql.SqlBuilder()
+        query.Select(db.Users.id, db.Users.login).From(db.Users).Where(
+                db.Users.id == i % rows).Limit(1)
+        queries.append(query)
+    return queries
+
+@benchmark
+def page(db, rows):
+    """Fetches 15 queries of the page one by one."""
+    iterations = 200
+    queries = PageQueries(db, rows)
+    for _ in xrange(iterations):
+        for query in queries:
+            query.FetchFrom(db)
+    return iterations
+
+@benchmark
+def page_batch(db, rows):
+    """Fetches 15 queries of the page on one connection."""
+    iterations = 200
+    queries = PageQueries(db, rows)
+    for _ in xrange(iterations):
+        db.FetchBatch(queries)
+    return iterations
+
+@benchmark
+def page_snapshot(db, rows):
+    """Fetches 15 queries of the page in one read transaction."""
+    iterations = 200
+    queries = PageQueries(db, rows)
+    for _ in xrange(iterations):
+        db.FetchBatch(queries, snapshot=True)
+    return iterations
+
+@benchmark
+def mapping(db, rows):
+    """Fetches id to login mapping through Result objects."""
+    query = sql.SqlBuilder()
+    query.Select(db.Users.id, db.Users.login).From(db.Users)
+    return len(dict((row.id, row.login) for row in query.FetchFrom(db)))
+
+@benchmark
+def fetch_mapping(db, rows):
+    """Fetches id to login mapping directly from row tuples."""
+    query = sql.SqlBuilder()
+    query.Select(db.Users.id, db.Users.login).From(db.Users)
+    return len(query.FetchMapping(db, db.Users.id, db.Users.login))
+
+@benchmark
+def scalars(db, rows):
+    """Fetches list of logins through Result objects."""
+    query = sql.SqlBuilder()
+    query.Select(db.Users.login).From(db.Users)
+    return len([row.login for row in query.FetchFrom(db)])
+
+@benchmark
+def fetch_scalars(db, rows):
+    """Fetches list of logins directly from row tuples."""
+    query = sql.SqlBuilder()
+    query.Select(db.Users.login).From(db.Users)
+    return len(query.FetchScalars(db, db.Users.login))
+
+@benchmark
+def insert(db, rows):
+    """Inserts rows one by one."""
+    iterations = 200
+    query = sql.SqlBuilder()
+    for i in xrange(rows, rows + iterations):
+        query.Insert(db.Users).Columns(db.Users.id, db.Users.login).Values(
+                i, 'new')
+        query.Execute(db)
+    return iterations
+
+@benchmark
+def queued(db, rows):
+    """Inserts rows from many threads through the write queue."""
+    iterations = 2000
+    db = sql.Db('sqlite', {'name': db.db.name, 'write_queue': True})
+
+    def insert(start):
+        """Inserts every tenth row starting from start."""
+        query = sql.SqlBuilder()
+        futures = []
+        for i in xrange(rows + start, rows + iterations, 10):
+            query.Insert(db.Users).Columns(db.Users.id,
+                    db.Users.login).Values(i, 'new')
+            futures.append(query.Execute(db))
+        for future in futures:
+            future.Wait()
+
+    threads = [threading.Thread(target=insert, args=(start,))
+            for start in xrange(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    db.db.write_queue.Close()
+    return iterations
+
+def InsertFromThreads(make_db, rows, threads=4, iterations=100):
+    """
+    Inserts rows from several threads, every thread uses its own Db.
+
+    Arguments:
+        make_db -- function returning new Db instance
+        rows -- number of rows in the table
+        threads -- number of threads
+        iterations -- number of rows inserted by every thread
+    Returns:
+        number of inserted rows
+    """
+    def insert(start):
+        """Inserts every threads-th row starting from start."""
+        db = make_db()
+        query = sql.SqlBuilder()
+        for i in xrange(rows + start, rows + threads * iterations, threads):
+            query.Insert(db.Users).Columns(db.Users.id,
+                    db.Users.login).Values(i, 'new')
+            query.Execute(db)
+        db.Close()
+
+    workers = [threading.Thread(target=insert, args=(start,))
+            for start in xrange(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * iterations
+
+@benchmark
+def threaded_insert(db, rows):
+    """Inserts rows from 4 threads into one file."""
+    return InsertFromThreads(lambda: sql.Db('sqlite', {'name': db.db.name}),
+            rows)
+
+@benchmark
+def sharded_insert(db, rows):
+    """Inserts rows from 4 threads into 4 shards."""
+    names = ['{0}.{1}'.format(db.db.name, i) for i in xrange(4)]
+    params = {'names': names, 'keys': [db.Users.id], 'workers': 1}
+    query = sql.SqlBuilder()
+    query.CreateTable(db.Users)
+    sharded = sql.Db('sharded', params)
+    query.Execute(sharded)
+    sharded.Close()
+    return InsertFromThreads(lambda: sql.Db('sharded', params), rows)
+
+class UsersPerFlag(sql.SummaryTable):
+    """Number of users per flag."""
+    source = sql.Db.Users
+    flag = sql.StringColumn()
+    users = sql.CountColumn()
+
+def CreateSummary(db):
+    """
+    Creates UsersPerFlag summary table.
+
+    Arguments:
+        db -- Db instance
+    Returns:
+        seconds spent creating and filling the table
+    """
+    started = time.time()
+    query = sql.SqlBuilder()
+    query.CreateTable(UsersPerFlag)
+    query.Execute(db)
+    return time.time() - started
+
+@benchmark
+def flag_counts(db, rows):
+    """Counts users per flag by scanning Users table."""
+    iterations = 20
+    query = sql.SqlBuilder()
+    for _ in xrange(iterations):
+        counts = {}
+        for flag in 'AB':
+            query.Select(db.Users.id).From(db.Users).Where(
+                    db.Users.flag == flag)
+            counts[flag] = query.Count(db)
+    return iterations
+
+@benchmark
+def summary_counts(db, rows):
+    """Reads users per flag from the summary table."""
+    CreateSummary(db)
+    iterations = 2000
+    query = sql.SqlBuilder()
+    query.Select(UsersPerFlag.flag, UsersPerFlag.users).From(UsersPerFlag)
+    started = time.time()
+    for _ in xrange(iterations):
+        query.FetchMapping(db, UsersPerFlag.flag, UsersPerFlag.users)
+    return iterations, time.time() - started
+
+@benchmark
+def summary_insert(db, rows):
+    """Inserts rows one by one keeping the summary table."""
+    CreateSummary(db)
+    started = time.time()
+    iterations = insert(db, rows)
+    return iterations, time.time() - started
+
+@benchmark
+def update(db, rows):
+    """Updates rows one by one."""
+    iterations = 200
+    query = sql.SqlBuilder()
+    for i in xrange(iterations):
+        query.Update(db.Users).Set(db.Users.login == 'updated').Where(
+                db.Users.id == i % rows)
+        query.Execute(db)
+    return iterations
+
+def Run(fn, name, rows, queue):
+    """
+    Runs benchmark in the current process and puts results into queue.
+
+    Arguments:
+        fn -- benchmark function
+        name -- path of the database file
+        rows -- number of rows in the table
+        queue -- queue for the results
+    """
+    db = sql.Db('sqlite', {'name': name})
+    started = time.time()
+    operations = fn(db, rows)
+    elapsed = time.time() - started
+    if isinstance(operations, tuple):
+        operations, elapsed = operations
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({'ops': operations / elapsed, 'memory': memory})
+
+def Wait(process, queue):
+    """
+    Waits for results of the benchmark process.
+
+    Arguments:
+        process -- started Process running the benchmark
+        queue -- queue for the results
+    Returns:
+        results or None if the process exited without them
+    """
+    while True:
+        # Results of the exited process are already in the queue
+        alive = process.is_alive()
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not alive:
+                return None
+
+def RunAll(rows, names=None):
+    """
+    Runs benchmarks, each one in a separate process on a fresh copy
+    of the populated table.
+
+    Arguments:
+        rows -- number of rows in the table
+        names -- names of benchmarks to run, all by default
+    Returns:
+        tuple of dict from benchmark name to dict with ops per second and
+        peak memory in kilobytes, and list of names of failed benchmarks
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, 'template.db')
+        Populate(sql.Db('sqlite', {'name': template}), rows)
+        results = {}
+        failed = []
+        for fn in BENCHMARKS:
+            if names and fn.__name__ not in names:
+                continue
+            name = os.path.join(directory, fn.__name__ + '.db')
+            shutil.copy(template, name)
+            queue = Queue()
+            process = Process(target=Run, args=(fn, name, rows, queue))
+            process.start()
+            result = Wait(process, queue)
+            process.join()
+            if result is None:
+                logging.error('Benchmark {0} failed with exit code {1}'.format(
+                    fn.__name__, process.exitcode))
+                failed.append(fn.__name__)
+            else:
+                results[fn.__name__] = result
+        return results, failed
+    finally:
+        shutil.rmtree(directory)
+
+def Compare(results, baseline, tolerance):
+    """
+    Compares results with the baseline.
+
+    Arguments:
+        results -- results of the current run
+        baseline -- results of the baseline run
+        tolerance -- allowed relative slowdown
+    Returns:
+        list of names of regressed benchmarks
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        expected = baseline[name]['ops']
+        actual = results[name]['ops']
+        if actual < expected * (1 - tolerance):
+            regressions.append(name)
+    return regressions
+
+def main():
+    """Parses arguments, runs benchmarks and reports results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=10000,
+            help='number of rows in the Users table')
+    parser.add_argument('--save', help='write results to the baseline file')
+    parser.add_argument('--compare', help='compare with the baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+            help='allowed relative slowdown, 0.2 by default')
+    parser.add_argument('names', nargs='*', help='benchmarks to run')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    results, failed = RunAll(args.rows, args.names)
+    for name in sorted(results):
+        print '{0:<14} {1:>14.1f} ops/s {2:>10d} KB'.format(name,
+                results[name]['ops'], results[name]['memory'])
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=4, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = Compare(results, baseline, args.tolerance)
+        if regressions:
+            print 'Regressions: ' + ', '.join(regressions)
+            sys.exit(1)
+    if failed:
+        print 'Failed: ' + ', '.join(failed)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -17,10 +17,18 @@ def GetUsersMapping(since):
     query.Select(db.Users.id, db.Users.login).From(db.Users).Where(
             db.Users.last_login_time < since).And(db.Users.login != 'admin')
 
-    rows = query.FetchFrom(db)
-    result = dict((row.id, row.login) for row in rows)
+    result = query.FetchMapping(db, db.Users.id, db.Users.login)
     print result
 
+def Templates():
+    """Returns query templates compiled by precompile.py."""
+    users = sql.Db.Users
+    query = sql.SqlBuilder()
+    query.Select(users.id, users.login).From(users).Where(
+            users.last_login_time < sql.Bind('since')).And(
+            users.login != 'admin')
+    return {'UsersMapping': query}
+
 if __name__ == '__main__':
     since = '2012-01-01'
     GetUsersMapping(since)
\ No newline at end of file
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compiles query templates ahead of time into python module.
+
+Usage:
+    precompile.py main.py queries.py
+
+Templates module defines function Templates() returning dict from name to
+SqlBuilder, values that change between calls are sql.Bind placeholders:
+
+    query.Select(Db.Users.login).From(Db.Users).Where(
+            Db.Users.last_login_time < sql.Bind('since'))
+
+Generated module keeps constant sql text of every template and function
+of the same name taking placeholders as arguments, i.e.
+queries.UsersMapping('2012-01-01').FetchFrom(db). Values are converted by
+the columns they are compared with, as SqlBuilder does.
+"""
+
+import argparse
+import imp
+import os
+
+import sql
+
+__author__ = "Gennadiy Zlobin"
+__email__ = "gennad.zlobin@gmail.com"
+__status__ = "Production"
+__version__ = "1.0.0"
+
+HEADER = '''#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Queries precompiled from {0} by precompile.py, do not edit."""
+
+'''
+
+def _Tuple(items):
+    """Returns source of the tuple of item sources."""
+    if len(items) == 1:
+        return '({0},)'.format(items[0])
+    return '({0})'.format(', '.join(items))
+
+def Generate(templates, source='templates'):
+    """
+    Generates source of the module with precompiled queries.
+
+    Arguments:
+        templates -- dict from name to SqlBuilder
+        source -- name of the templates module for the header
+    Returns:
+        python source text
+    Raises:
+        ValueError if the template can not be precompiled
+    """
+    imports = set(['sql'])
+    lines = []
+    for name in sorted(templates):
+        query = templates[name]
+        text, suffix, params = query.CompileParts()
+        if query.data is not None:
+            raise ValueError('Template {0} has constructed data'.format(name))
+
+        adapters = []
+        for i, adapter in query.adapters:
+            if adapter.__name__ == '<lambda>':
+                raise ValueError('Adapter of {0} has no name'.format(name))
+            imports.add(adapter.__module__)
+            adapters.append('({0}, {1}.{2})'.format(i, adapter.__module__,
+                adapter.__name__))
+        lines.append('_{0} = ({1!r},\n        {2!r},\n        {3},\n'
+                '        {4!r},\n        {5!r},\n        {6!r},\n'
+                '        {7!r},\n        {8!r})\n'.format(name, text,
+                    tuple(getattr(query, 'select_columns', ())),
+                    _Tuple(adapters), tuple(sorted(query.tables)),
+                    query.script, suffix, query.order, query.limit))
+
+        arguments = []
+        values = []
+        for i, param in enumerate(params):
+            if not isinstance(param, sql.Placeholder):
+                values.append(repr(param))
+                continue
+            if param.name not in arguments:
+                arguments.append(param.name)
+            column = param.column
+            if column is None or (type(column).to_db.im_func is
+                    sql.Column.to_db.im_func):
+                values.append(param.name)
+                continue
+            # Converter is created once, when the module is imported
+            imports.add(type(column).__module__)
+            converter = '_{0}_{1}'.format(name, i)
+            lines.append('{0} = {1}.to_db\n'.format(converter,
+                column.Source()))
+            values.append('{0}({1})'.format(converter, param.name))
+
+        lines.append('\ndef {0}({1}):\n'
+                '    """Returns precompiled {0} query."""\n'
+                '    return sql.Prepared(_{0}, {2})\n\n'.format(name,
+                    ', '.join(arguments), _Tuple(values)))
+
+    header = HEADER.format(source) + ''.join('import {0}\n'.format(module)
+            for module in sorted(imports))
+    return header + '\n' + ''.join(lines).rstrip('\n') + '\n'
+
+def main():
+    """Parses arguments and writes generated module."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('templates', help='path of the templates module')
+    parser.add_argument('output', help='path of the generated module')
+    args = parser.parse_args()
+
+    name = os.path.splitext(os.path.basename(args.templates))[0]
+    module = imp.load_source(name, args.templates)
+    with open(args.output, 'w') as output:
+        output.write(Generate(module.Templates(), name))
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,25 @@
 # -*- coding: utf-8 -*-
 """Module for working with the database."""
 
+import calendar
+import csv
+import json
 import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from Queue import Empty, Queue
+from collections import OrderedDict
+from datetime import date, datetime
+from itertools import chain, islice
+from json.encoder import encode_basestring_ascii
+from multiprocessing.pool import ThreadPool
 from numbers import Number
-from sqlite3 import connect
+from sqlite3 import OperationalError, connect
 
 __author__ = "Gennadiy Zlobin"
 __email__ = "gennad.zlobin@gmail.com"
@@ -27,36 +43,382 @@ class InvalidOrderError(Exception):
     """Raises if SqlBuilder method was called in improper order."""
     pass
 
+class QueryTimeoutError(Exception):
+    """Raises if query was interrupted because its deadline passed."""
+    pass
+
+class QueryCancelledError(Exception):
+    """Raises if query was cancelled with SqlBuilder.Cancel."""
+    pass
+
+class ResultTooLargeError(Exception):
+    """Raises if fetched rows exceed the limit of rows or bytes."""
+    pass
+
 class Result(object):
     """Represents results of fetched data."""
     pass
 
-class Singleton(type):
-    """Singletone meta class."""
-    def __init__(cls, name, bases, dict):
-        super(Singleton, cls).__init__(name, bases, dict)
-        cls.instance = None
+class Expression(object):
+    """
+    Base class for immutable nodes of the condition tree.
+
+    Nodes are produced by Column operator overloads and are compiled to SQL
+    and a tuple of parameters only when the query is executed. Nodes compare
+    and hash by structure so they can be cached and shared between queries.
+    """
+    __slots__ = ()
 
-    def __call__(cls,*args,**kw):
-        if cls.instance is None:
-            cls.instance = super(Singleton, cls).__call__(*args, **kw)
-        return cls.instance
+    def Compile(self, qualified=True):
+        """
+        Compiles the node.
 
-class SingletoneData(object):
-    """Singletone class that contains information that should be shared between
-    Column and SqlBuilder classes."""
-    def __init__(self):
-        self.last_method = ''
-        self.added = set()
-        self.data = []
+        Arguments:
+            qualified -- whether column names are prefixed with table name
+        Returns:
+            tuple of sql text and tuple of parameters
+        """
+        raise NotImplementedError()
+
+    def key(self):
+        """Returns hashable structural representation of the node."""
+        raise NotImplementedError()
+
+    def Tables(self):
+        """Returns names of tables read by nested subqueries."""
+        return frozenset()
+
+    def __and__(self, right):
+        """Combines two nodes with AND."""
+        return BooleanExpression(' AND ', (self, right))
+
+    def __or__(self, right):
+        """Combines two nodes with OR."""
+        return BooleanExpression(' OR ', (self, right))
+
+    def __eq__(self, other):
+        """Compares nodes by structure."""
+        return (isinstance(other, Expression)
+                and self.key() == other.key())
+
+    def __ne__(self, other):
+        """Compares nodes by structure."""
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        """Hashes node by structure."""
+        return hash(self.key())
+
+    def __repr__(self):
+        """Returns compiled sql of the node."""
+        return '<{0} {1!r}>'.format(self.__class__.__name__,
+                self.Compile()[0])
+
+class ColumnRef(Expression):
+    """Reference to a column of the table."""
+    __slots__ = ('table', 'column')
+
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+
+    def Compile(self, qualified=True):
+        """Returns column name, prefixed with table name if required."""
+        if qualified:
+            return ''.join((self.table, '.', self.column)), ()
+        return self.column, ()
+
+    def key(self):
+        return ('column', self.table, self.column)
+
+class Param(Expression):
+    """Bound parameter."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def Compile(self, qualified=True):
+        """Returns placeholder and the value."""
+        return '?', (self.value,)
+
+    def key(self):
+        return ('param', self.value)
+
+class Placeholder(Expression):
+    """
+    Named parameter of the query template, its value is bound when the
+    precompiled query is called, see precompile.py. Column the placeholder
+    is compared with converts the bound value.
+    """
+    __slots__ = ('name', 'column')
+
+    def __init__(self, name, column=None):
+        self.name = name
+        self.column = column
+
+    def Compile(self, qualified=True):
+        """Returns placeholder, the node itself stands for the value."""
+        return '?', (self,)
+
+    def key(self):
+        return ('placeholder', self.name)
+
+def Bind(name):
+    """
+    Returns named parameter for the query template, i.e.
+    db.Users.login != Bind('login').
+
+    Arguments:
+        name -- name of the argument of the precompiled function
+    Returns:
+        Placeholder expression node
+    """
+    return Placeholder(name)
+
+class Statement(Expression):
+    """Sql text compiled ahead of time with its bound parameters."""
+    __slots__ = ('sql', 'params')
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+
+    def Compile(self, qualified=True):
+        """Returns the text and the parameters as they are."""
+        return self.sql, self.params
+
+    def key(self):
+        return ('statement', self.sql)
+
+def _Operand(value):
+    """
+    Wraps value into expression node.
+
+    Arguments:
+        value -- Column, Expression or plain value
+    Returns:
+        Expression instance
+    """
+    if isinstance(value, Column):
+        return ColumnRef(value.table_name, value.column_name)
+    if isinstance(value, Expression):
+        return value
+    return Param(value)
+
+def _CompileFragments(fragments):
+    """
+    Compiles fragments of the query.
+
+    Arguments:
+        fragments -- sequence of text and Expression nodes
+    Returns:
+        tuple of sql text and tuple of parameters
+    """
+    sqls = []
+    params = ()
+    for fragment in fragments:
+        if isinstance(fragment, Expression):
+            fragment, fragment_params = fragment.Compile()
+            params += fragment_params
+        sqls.append(fragment)
+    return ''.join(sqls), params
+
+class Comparison(Expression):
+    """Binary comparison like 'users.id < ?'."""
+    __slots__ = ('left', 'op', 'right', '_cache')
+
+    def __init__(self, left, op, right):
+        self.left = _Operand(left)
+        self.op = op
+        self.right = _Operand(right)
+        self._cache = {}
+
+    def Compile(self, qualified=True):
+        """Compiles both operands once per qualification mode."""
+        compiled = self._cache.get(qualified)
+        if compiled is None:
+            left, left_params = self.left.Compile(qualified)
+            right, right_params = self.right.Compile(qualified)
+            compiled = (''.join((left, self.op, right)),
+                    left_params + right_params)
+            self._cache[qualified] = compiled
+        return compiled
+
+    def key(self):
+        return ('cmp', self.left.key(), self.op, self.right.key())
+
+class InList(Expression):
+    """IN (...) and NOT IN (...) expressions."""
+    __slots__ = ('left', 'values', 'negate')
+
+    def __init__(self, left, values, negate=False):
+        self.left = _Operand(left)
+        self.values = tuple(values)
+        self.negate = negate
+
+    def Compile(self, qualified=True):
+        """Renders one placeholder per value."""
+        left, params = self.left.Compile(qualified)
+        op = ' NOT IN ' if self.negate else ' IN '
+        placeholders = ', '.join('?' * len(self.values))
+        return ''.join((left, op, '(', placeholders, ')')), \
+                params + self.values
+
+    def key(self):
+        return ('in', self.left.key(), self.values, self.negate)
+
+class BooleanExpression(Expression):
+    """Several nodes joined with AND or OR, enclosed in brackets."""
+    __slots__ = ('op', 'items')
+
+    def __init__(self, op, items):
+        self.op = op
+        self.items = tuple(_Operand(item) for item in items)
+
+    def Compile(self, qualified=True):
+        """Compiles all nested nodes."""
+        sqls = []
+        params = ()
+        for item in self.items:
+            sql, item_params = item.Compile(qualified)
+            sqls.append(sql)
+            params += item_params
+        return ''.join(('(', self.op.join(sqls), ')')), params
+
+    def key(self):
+        return ('bool', self.op, tuple(item.key() for item in self.items))
+
+    def Tables(self):
+        return frozenset().union(*[item.Tables() for item in self.items])
+
+class Subquery(Expression):
+    """
+    Nested query enclosed in brackets. Fragments of the query are copied,
+    so changing the builder later does not change the node.
+    """
+    __slots__ = ('fragments', 'tables')
+
+    def __init__(self, sqlbuilder):
+        self.fragments = tuple(sqlbuilder.prefix + sqlbuilder.sql +
+                sqlbuilder._Tail())
+        self.tables = frozenset(sqlbuilder.tables)
+
+    def Compile(self, qualified=True):
+        """Compiles the nested query, its columns are always qualified."""
+        sql, params = _CompileFragments(self.fragments)
+        return ''.join(('(', sql, ')')), params
+
+    def key(self):
+        return ('subquery', tuple(fragment.key()
+            if isinstance(fragment, Expression) else fragment
+            for fragment in self.fragments))
+
+    def Tables(self):
+        return self.tables
+
+class InQuery(Expression):
+    """IN (SELECT ...) and NOT IN (SELECT ...) expressions."""
+    __slots__ = ('left', 'query', 'negate')
+
+    def __init__(self, left, query, negate=False):
+        self.left = _Operand(left)
+        self.query = Subquery(query)
+        self.negate = negate
+
+    def Compile(self, qualified=True):
+        """Compiles column and the nested query."""
+        left, params = self.left.Compile(qualified)
+        query, query_params = self.query.Compile()
+        op = ' NOT IN ' if self.negate else ' IN '
+        return ''.join((left, op, query)), params + query_params
 
-    __metaclass__ = Singleton
+    def key(self):
+        return ('in query', self.left.key(), self.query.key(), self.negate)
+
+    def Tables(self):
+        return self.query.Tables()
+
+class ExistsQuery(Expression):
+    """EXISTS (SELECT ...) and NOT EXISTS (SELECT ...) expressions."""
+    __slots__ = ('query', 'negate')
+
+    def __init__(self, query, negate=False):
+        self.query = Subquery(query)
+        self.negate = negate
+
+    def Compile(self, qualified=True):
+        """Compiles the nested query."""
+        query, params = self.query.Compile()
+        op = 'NOT EXISTS ' if self.negate else 'EXISTS '
+        return op + query, params
+
+    def key(self):
+        return ('exists', self.query.key(), self.negate)
+
+    def Tables(self):
+        return self.query.Tables()
+
+def Exists(query):
+    """
+    Returns condition that is true if the query returns any rows, the query
+    may refer to the columns of the outer query.
+
+    Arguments:
+        query -- SqlBuilder instance
+    Returns:
+        ExistsQuery expression node
+    """
+    return ExistsQuery(query)
+
+def NotExists(query):
+    """
+    Returns condition that is true if the query returns no rows.
+
+    Arguments:
+        query -- SqlBuilder instance
+    Returns:
+        ExistsQuery expression node
+    """
+    return ExistsQuery(query, negate=True)
+
+class Assignments(Expression):
+    """Comma separated list of assignments for UPDATE ... SET."""
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = tuple(items)
+
+    def Compile(self, qualified=True):
+        """Compiles nested comparisons without table prefixes."""
+        sqls = []
+        params = ()
+        for item in self.items:
+            sql, item_params = item.Compile(False)
+            sqls.append(sql)
+            params += item_params
+        return ', '.join(sqls), params
+
+    def key(self):
+        return ('set', tuple(item.key() for item in self.items))
+
+class ValueList(Expression):
+    """VALUES (...) list of bound parameters for INSERT."""
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = tuple(values)
+
+    def Compile(self, qualified=True):
+        """Renders one placeholder per value."""
+        placeholders = ', '.join('?' * len(self.values))
+        return ''.join(('VALUES (', placeholders, ')')), self.values
+
+    def key(self):
+        return ('values', self.values)
 
 class Column(object):
     """Base class for columns."""
-    def __init__(self):
-        self.sdata = SingletoneData()
-
     @property
     def table_name(self):
         """Returns table name."""
@@ -76,6 +438,58 @@ class Column(object):
         """Returns column name and type for CREATE TABLE expression."""
         raise NotImplementedError()
 
+    def to_db(self, value):
+        """
+        Converts value to the form it is stored in the database.
+
+        Arguments:
+            value -- python value, Column or Expression
+        Returns:
+            converted value
+        """
+        return value
+
+    def adapter(self):
+        """
+        Returns function that converts fetched values back to python
+        values or None if values are returned as is.
+        """
+        return None
+
+    def _Value(self, value):
+        """
+        Converts value with to_db. Placeholder is converted later, when
+        the value is bound, so it keeps the column.
+
+        Arguments:
+            value -- python value, Column, Expression or Placeholder
+        Returns:
+            converted value
+        """
+        if isinstance(value, Placeholder):
+            return Placeholder(value.name, self)
+        return self.to_db(value)
+
+    def Source(self):
+        """
+        Returns python expression creating the same column, used by
+        precompiled query modules to convert bound values.
+        """
+        return '{0}.{1}()'.format(type(self).__module__, type(self).__name__)
+
+    def parse(self, value):
+        """
+        Converts value read from the file to the type of the column.
+
+        Arguments:
+            value -- text or json value
+        Returns:
+            converted value
+        Raises:
+            InvalidTypeError
+        """
+        raise NotImplementedError()
+
     def __lt__(self, right):
         """
         Overrides '<' sign.
@@ -83,15 +497,9 @@ class Column(object):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
-        if isinstance(right, Column):
-            right = ''.join((right.table_name, '.', right.column_name))
-
-        left = ''.join((self.table_name, '.', self.column_name))
-        sql = ''.join((left, ' < ', '?'))
-        self.sdata.data.append(right)
-        return sql
+        return Comparison(self, ' < ', self._Value(right))
 
     def __le__(self, right):
         """
@@ -100,15 +508,9 @@ class Column(object):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
-        if isinstance(right, Column):
-            right = ''.join((right.table_name, '.', right.column_name))
-
-        left = ''.join((self.table_name, '.', self.column_name))
-        sql = ''.join((left, ' <= ', '?'))
-        self.sdata.data.append(right)
-        return sql
+        return Comparison(self, ' <= ', self._Value(right))
 
     def __gt__(self, right):
         """
@@ -117,15 +519,9 @@ class Column(object):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
-        if isinstance(right, Column):
-            right = ''.join((right.table_name, '.', right.column_name))
-
-        left = ''.join((self.table_name, '.', self.column_name))
-        sql = ''.join((left, ' > ', '?'))
-        self.sdata.data.append(right)
-        return sql
+        return Comparison(self, ' > ', self._Value(right))
 
     def __ge__(self, right):
         """
@@ -134,15 +530,9 @@ class Column(object):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
-        if isinstance(right, Column):
-            right = ''.join((right.table_name, '.', right.column_name))
-
-        left = ''.join((self.table_name, '.', self.column_name))
-        sql = ''.join((left, ' >= ', '?'))
-        self.sdata.data.append(right)
-        return sql
+        return Comparison(self, ' >= ', self._Value(right))
 
     def __eq__(self, right):
         """
@@ -151,26 +541,9 @@ class Column(object):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
-        if isinstance(right, Column):
-            if self.sdata.last_method != 'Update':
-                right = ''.join((right.table_name, '.', right.column_name))
-            else:
-                right = right.column_name
-
-        if self.sdata.last_method != 'Update':
-            left = ''.join((self.table_name, '.', self.column_name))
-        else:
-            left = self.column_name
-
-        sql = ''.join((left, ' = '))
-        if self.sdata.last_method == 'Join':
-            sql += right
-        else:
-            sql += '?'
-            self.sdata.data.append(right)
-        return sql
+        return Comparison(self, ' = ', self._Value(right))
 
     def __ne__(self, right):
         """
@@ -179,54 +552,35 @@ class Column(object):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
-        if isinstance(right, Column):
-            if self.sdata.last_method != 'Update':
-                right = ''.join((right.table_name, '.', right.column_name))
-            else:
-                right = right.column_name
-
-        if self.sdata.last_method != 'Update':
-            left = ''.join((self.table_name, '.', self.column_name))
-        else:
-            left = self.column_name
-
-        sql = ''.join((left, ' != '))
-        if self.sdata.last_method == 'Join':
-            sql += right
-        else:
-            sql += '?'
-            self.sdata.data.append(right)
-        return sql
+        return Comparison(self, ' != ', self._Value(right))
 
     def In(self, arg):
         """
         Method for IN (set) expression.
 
         Arguments:
-            arg -- sequence for checking in
+            arg -- sequence or SqlBuilder selecting one column
         Returns:
-            text representation of the condition.
+            InList or InQuery expression node.
         """
-        left = ''.join((self.table_name, '.', self.column_name))
-        right = str(tuple(arg))
-        sql = ''.join((left, ' IN ', right))
-        return sql
+        if isinstance(arg, SqlBuilder):
+            return InQuery(self, arg)
+        return InList(self, map(self._Value, arg))
 
     def NotIn(self, arg):
         """
         Method for NOT IN (set) expression.
 
         Arguments:
-            arg -- sequence for checking in
+            arg -- sequence or SqlBuilder selecting one column
         Returns:
-            text representation of the condition.
+            InList or InQuery expression node.
         """
-        left = ''.join((self.table_name, '.', self.column_name))
-        right = str(tuple(arg))
-        sql = ''.join((left, ' NOT IN ', right))
-        return sql
+        if isinstance(arg, SqlBuilder):
+            return InQuery(self, arg, negate=True)
+        return InList(self, map(self._Value, arg), negate=True)
 
 class IntegerColumn(Column):
     """Represents integer column in the database."""
@@ -234,6 +588,20 @@ class IntegerColumn(Column):
         """Return column name and type for CREATE TABLE expression."""
         return self.column_name + ' INT'
 
+    def parse(self, value):
+        """Converts value to number, empty value becomes NULL."""
+        if value is None or value == '':
+            return None
+        if isinstance(value, Number):
+            return value
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                raise InvalidTypeError('Invalid type of {0}'.format(value))
+
     def validate_type(fn):
         """Decorator for validating type. In expressions with integer column
         the second parameter must be integer or Column subclass.
@@ -249,7 +617,7 @@ class IntegerColumn(Column):
                 InvalidTypeError
             """
             right = args[1]
-            if not isinstance(right, Number) and not isinstance(right, Column):
+            if not isinstance(right, (Number, Column, Placeholder)):
                 raise InvalidTypeError('Invalid type of {0}'.format(right))
             return fn(*args, **kwargs)
         return nested
@@ -262,7 +630,7 @@ class IntegerColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         return super(IntegerColumn, self).__lt__(right)
 
@@ -274,7 +642,7 @@ class IntegerColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         return super(IntegerColumn, self).__le__(right)
 
@@ -286,7 +654,7 @@ class IntegerColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         return super(IntegerColumn, self).__gt__(right)
 
@@ -298,7 +666,7 @@ class IntegerColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         return super(IntegerColumn, self).__ge__(right)
 
@@ -310,7 +678,7 @@ class IntegerColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         return super(IntegerColumn, self).__eq__(right)
 
@@ -322,7 +690,7 @@ class IntegerColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         return super(IntegerColumn, self).__ne__(right)
 
@@ -333,6 +701,16 @@ class StringColumn(Column):
         """Return column name and type for CREATE TABLE expression."""
         return self.column_name + ' TEXT'
 
+    def parse(self, value):
+        """Converts value to unicode text."""
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return value.decode('utf-8')
+        if isinstance(value, (unicode, Number)):
+            return unicode(value)
+        raise InvalidTypeError('Invalid type of {0}'.format(value))
+
     def validate_type(fn):
         """
         Decorator for validating type. In expressions with text column
@@ -345,8 +723,7 @@ class StringColumn(Column):
             """Checks type. Raises InvalidTypeError if argument is
             not basestring or Column subclass."""
             right = args[1]
-            if (not isinstance(right, basestring)
-                    and not isinstance(right, Column)):
+            if not isinstance(right, (basestring, Column, Placeholder)):
                 raise InvalidTypeError('Invalid type of {0}'.format(right))
             return fn(*args, **kwargs)
         return nested
@@ -358,7 +735,7 @@ class StringColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         raise InvalidTypeError('Invalid sign')
 
@@ -370,7 +747,7 @@ class StringColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         raise InvalidTypeError('Invalid sign')
 
@@ -382,7 +759,7 @@ class StringColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         raise InvalidTypeError('Invalid sign')
 
@@ -394,7 +771,7 @@ class StringColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         raise InvalidTypeError('Invalid sign')
 
@@ -406,7 +783,7 @@ class StringColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         return super(StringColumn, self).__eq__(right)
 
@@ -418,20 +795,113 @@ class StringColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         return super(StringColumn, self).__ne__(right)
 
+class FullTextColumn(StringColumn):
+    """
+    Represents text column indexed for full-text search. Tables with such
+    columns get FTS5 index <table>_fts with external content kept in sync
+    by triggers, see SqlBuilder.CreateTable and SqlBuilder.Match.
+    """
+    pass
+
 class DateTimeColumn(Column):
-    """Represents datetime column in the database."""
+    """
+    Represents datetime column in the database.
+
+    Values are stored either as text in ISO format or, with 'epoch'
+    storage, as integer number of seconds since 1970-01-01 UTC which keeps
+    indexes compact and range comparisons numeric. Naive datetimes are
+    treated as UTC. Epoch values are converted back to datetime on fetch.
+    """
+    FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S')
+
+    def __init__(self, storage='text'):
+        """
+        Constructor.
+
+        Arguments:
+            storage -- 'text' or 'epoch'
+        """
+        if storage not in ('text', 'epoch'):
+            raise NotImplementedError(
+                    'Unsupported storage {0}'.format(storage))
+        self.storage = storage
+
     def create(self):
         """Return column name and type for CREATE TABLE expression."""
         return ''.join((' ', self.column_name, ' DATETIME'))
 
+    def to_db(self, value):
+        """
+        Converts datetime, date or text in one of FORMATS to the storage
+        form of the column.
+
+        Arguments:
+            value -- python value, Column or Expression
+        Returns:
+            converted value
+        Raises:
+            InvalidTypeError
+        """
+        if value is None or isinstance(value, (Column, Expression)):
+            return value
+        if self.storage == 'text':
+            if isinstance(value, datetime):
+                return value.isoformat(' ')
+            if isinstance(value, date):
+                return value.isoformat()
+            return value
+        if isinstance(value, Number):
+            return value
+        if isinstance(value, basestring):
+            for time_format in self.FORMATS:
+                try:
+                    value = datetime.strptime(value, time_format)
+                    break
+                except ValueError:
+                    pass
+            else:
+                raise InvalidTypeError('Invalid type of {0}'.format(value))
+        if isinstance(value, datetime):
+            return calendar.timegm(value.utctimetuple())
+        return calendar.timegm(value.timetuple())
+
+    def Source(self):
+        """Returns python expression creating the same column."""
+        return '{0}.{1}(storage={2!r})'.format(type(self).__module__,
+                type(self).__name__, self.storage)
+
+    def adapter(self):
+        """Returns converter from epoch to datetime for epoch storage."""
+        if self.storage == 'epoch':
+            return _FromEpoch
+        return None
+
+    def parse(self, value):
+        """
+        Checks format of the date, empty value becomes NULL. Numbers, also
+        as text for epoch storage, are seconds since 1970-01-01 UTC.
+        """
+        if value is None or value == '':
+            return None
+        if self.storage == 'epoch' and isinstance(value, basestring):
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        if isinstance(value, Number):
+            return self.to_db(datetime.utcfromtimestamp(value))
+        if not isinstance(value, basestring) or len(value.split('-')) != 3:
+            raise InvalidTypeError('Invalid type of {0}'.format(value))
+        return self.to_db(unicode(value))
+
     def validate_type(fn):
         """Decorator for validating type. In expressions with datetime column
-        the second parameter must be basestring subclass in proper format
-        or Column subcass.
+        the second parameter must be basestring subclass in proper format,
+        datetime, date, number for epoch storage or Column subcass.
 
         Arguments:
             fn -- decorated function
@@ -445,8 +915,12 @@ class DateTimeColumn(Column):
                 InvalidTypeError
             """
             right = args[1]
-            if (not isinstance(right, Column) and
-                    not isinstance(right, basestring)
+            if isinstance(right, (Column, date, Placeholder)):
+                return fn(*args, **kwargs)
+            if (isinstance(right, Number)
+                    and args[0].storage == 'epoch'):
+                return fn(*args, **kwargs)
+            if (not isinstance(right, basestring)
                     or len(right.split('-')) != 3):
                 raise InvalidTypeError('Invalid type of {0}'.format(right))
             return fn(*args, **kwargs)
@@ -460,7 +934,7 @@ class DateTimeColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         return super(DateTimeColumn, self).__lt__(right)
 
@@ -472,7 +946,7 @@ class DateTimeColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         return super(DateTimeColumn, self).__le__(right)
 
@@ -484,7 +958,7 @@ class DateTimeColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         return super(DateTimeColumn, self).__gt__(right)
 
@@ -496,7 +970,7 @@ class DateTimeColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         return super(DateTimeColumn, self).__ge__(right)
 
@@ -508,7 +982,7 @@ class DateTimeColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         return super(DateTimeColumn, self).__eq__(right)
 
@@ -520,17 +994,21 @@ class DateTimeColumn(Column):
         Arguments:
             right -- object to the right from the sign.
         Returns:
-            text representation of the condition.
+            Comparison expression node.
         """
         return super(DateTimeColumn, self).__ne__(right)
 
 class MetaTable(type):
     """Meta class for Table."""
+    # Names of summary tables by name of their source table
+    summaries = {}
+
     def __new__(cls, name, bases, attrs):
         """
         Inspects table columns and assigns them table name and column name.
         Adds a new attribute 'all' that keeps all available
-        columns of the table.
+        columns of the table and 'fulltext' with full-text columns.
+        Summary tables are registered by their source table.
         """
         attrs['all'] = []
         for key in attrs:
@@ -538,7 +1016,14 @@ class MetaTable(type):
                 attrs[key].table_name = name
                 attrs[key].column_name = key
                 attrs['all'].append(attrs[key])
-        return super(MetaTable, cls).__new__(cls, name, bases, attrs)
+        attrs['fulltext'] = [column for column in attrs['all']
+                if isinstance(column, FullTextColumn)]
+        table = super(MetaTable, cls).__new__(cls, name, bases, attrs)
+        source = attrs.get('source')
+        if isinstance(source, MetaTable) and issubclass(table, SummaryTable):
+            cls.summaries.setdefault(source.get_name(), set()).add(
+                    table.get_name())
+        return table
 
 class Table(object):
     """Base class for all tables."""
@@ -547,163 +1032,2260 @@ class Table(object):
         """Returns table_name."""
         return cls.__name__.lower()
 
-    __metaclass__ = MetaTable
-
-class Db(object):
-    """
-    Base class for database abstraction. Should be subclassed with the
-    concrete implementations.
+    @classmethod
+    def get_fulltext_name(cls):
+        """Returns name of the full-text index of the table."""
+        return cls.get_name() + '_fts'
 
-    Keeps all tables in the database represented as nested classes.
-    """
-    def __init__(self, db_type='sqlite', params=None):
-        """Constructor creates delegated Db subclass depending on
-        requested db type."""
-        if not params:
-            params = {}
-        if db_type == 'sqlite':
-            self.db = SQLiteDb(params)
-        elif db_type == 'mysql':
-            self.db = MySQLDb(params)
-        else:
-            raise NotImplementedError()
+    __metaclass__ = MetaTable
 
-    def _Query(self):
-        """Queries database."""
-        raise NotImplementedError()
+class CountColumn(IntegerColumn):
+    """Number of rows of the source table in the group of SummaryTable."""
+    def Initial(self):
+        """Returns aggregate computing the column from the source table."""
+        return 'COUNT(*)'
 
-    def _OpenConnection(self):
-        """Opens connection with the database."""
-        raise NotImplementedError()
+    def Delta(self, row):
+        """
+        Returns change of the column caused by one row.
 
-    def _CloseConnection(self):
-        """Closes connection with the database."""
-        raise NotImplementedError()
+        Arguments:
+            row -- 'new' or 'old' row of the trigger
+        """
+        return '1'
 
-    def _GetResults(self, select_columns):
+class SumColumn(IntegerColumn):
+    """Sum of the source column in the group of SummaryTable."""
+    def __init__(self, column):
         """
-        Returns results from cursor object.
+        Constructor.
 
         Arguments:
-            select_columns -- columns to fetch from
-        Returns:
-            list of Result objects
+            column -- summed column of the source table
         """
-        raise NotImplementedError()
+        self.source_column = column.column_name
 
-    def _Commit(self):
-        """Commits a transaction."""
-        raise NotImplementedError()
+    def Initial(self):
+        """Returns aggregate computing the column from the source table."""
+        return 'IFNULL(SUM({0}), 0)'.format(self.source_column)
 
-    def Fetch(self, sqlbuilder, result=False, commit=False):
+    def Delta(self, row):
         """
-        Facade for Db class for executing queries
-        and fetching the results.
+        Returns change of the column caused by one row.
 
         Arguments:
-            sqlbuilder -- SqlBuilder instance
-            result -- is it need to return result
-            commit -- is it need to commit
-        Returns:
-            if result is True, returns list of Result objects
+            row -- 'new' or 'old' row of the trigger
         """
-        raise NotImplementedError()
+        return 'IFNULL({0}.{1}, 0)'.format(row, self.source_column)
 
-    class Users(Table):
-        """ Represents Users table in the database."""
-        id = IntegerColumn()
-        login = StringColumn()
-        last_login_time = DateTimeColumn()
-        flag = StringColumn()
-        position = IntegerColumn()
-        class_field = StringColumn()
+class SummaryTable(Table):
+    """
+    Base class for tables keeping aggregates of the source table by group,
+    i.e. number of users per flag:
+
+        class UsersPerFlag(SummaryTable):
+            source = Db.Users
+            flag = StringColumn()
+            users = CountColumn()
+
+    Plain columns are group columns and have the names of the source
+    columns. Table is filled on CreateTable and kept up to date by triggers
+    on the source table, so every write applies its delta in its own
+    transaction and reads cost O(groups). Groups without rows are removed,
+    so CountColumn is required.
+    """
+    source = None
 
-    class Managers(Table):
-        """ Represents Managers table in the database."""
-        id = IntegerColumn()
-        photo = StringColumn()
+    @classmethod
+    def get_groups(cls):
+        """Returns names of group columns."""
+        return sorted(column.column_name for column in cls.all
+                if not isinstance(column, (CountColumn, SumColumn)))
 
-class SQLiteDb(Db):
-    """SQLite3 implementation."""
-    def __init__(self, params):
-        self.cursor = None
-        self.connection = None
-        self.name = params.get('name', 'sample.db')
+    @classmethod
+    def get_aggregates(cls):
+        """Returns aggregate columns sorted by name."""
+        return sorted((column for column in cls.all
+            if isinstance(column, (CountColumn, SumColumn))),
+            key=lambda column: column.column_name)
 
-    def _Query(self):
-        """Queries database."""
-        logging.info('Sql = {0}, data={1}'.format(self.sql, self.data))
-        self.cursor.execute(self.sql, self.data)
+def _FromEpoch(value):
+    """
+    Converts epoch seconds to naive UTC datetime. Other values, i.e. NULL
+    or text stored before MigrateToEpoch, are returned as they are.
 
-    def _Commit(self):
-        """Commits a transaction."""
-        self.connection.commit()
+    Arguments:
+        value -- number of seconds
+    Returns:
+        datetime or the value
+    """
+    if not isinstance(value, Number):
+        return value
+    return datetime.utcfromtimestamp(value)
 
-    def _OpenConnection(self):
-        """Opens connection with the database."""
-        self.connection = connect(self.name)
-        self.cursor = self.connection.cursor()
+def _ColumnForType(declared_type):
+    """
+    Chooses Column subclass for the declared type of reflected column
+    using SQLite type affinity rules.
 
-    def _CloseConnection(self):
-        """Closes connection with the database."""
-        self.cursor.close()
-        self.connection.close()
+    Arguments:
+        declared_type -- type from PRAGMA table_info
+    Returns:
+        Column instance
+    """
+    declared_type = declared_type.upper()
+    if 'DATE' in declared_type or 'TIME' in declared_type:
+        return DateTimeColumn()
+    if ('INT' in declared_type or 'REAL' in declared_type
+            or 'FLOA' in declared_type or 'DOUB' in declared_type
+            or 'NUM' in declared_type):
+        return IntegerColumn()
+    return StringColumn()
+
+def _JsonValue(value):
+    """
+    Encodes value fetched from the database as JSON. Strings and integers
+    skip generic json.dumps machinery.
+
+    Arguments:
+        value -- value of the column
+    Returns:
+        JSON text
+    """
+    value_type = type(value)
+    if value_type is str or value_type is unicode:
+        return encode_basestring_ascii(value)
+    if value_type is int or value_type is long:
+        return str(value)
+    if value_type is datetime:
+        return '"{0}"'.format(value.isoformat(' '))
+    return json.dumps(value)
+
+class QueryLog(object):
+    """
+    Aggregates latency and number of rows of executed queries by
+    fingerprint. Fingerprint is the sql text with whitespace collapsed and
+    IN lists of placeholders of any length folded, values are never part
+    of it because they are bound as parameters.
+
+    Memory is bounded: at most max_queries fingerprints are kept (least
+    recently seen is evicted) and latency percentiles are estimated from
+    a reservoir of at most max_samples values per fingerprint.
+    """
+    PLACEHOLDERS = re.compile(r'\bIN\s*\(\s*\?(\s*,\s*\?)*\s*\)', re.I)
+    SPACES = re.compile(r'\s+')
 
-    def _GetResults(self, select_columns):
+    def __init__(self, threshold=0.0, max_queries=1000, max_samples=1000):
         """
-        Returns results from cursor object.
+        Constructor.
 
         Arguments:
-            select_columns -- columns to fetch from
-        Returns:
-            list of Result objects
+            threshold -- seconds, faster queries are not recorded
+            max_queries -- max number of kept fingerprints
+            max_samples -- max number of kept latencies per fingerprint
         """
-        results = []
-        for row in self.cursor:
-            myobj = Result()
-            for i, name in enumerate(select_columns):
-                # Split name and take last part if there is a dot in it
-                name = name.split('.')[-1] if name.find('.') != -1 else name
-                setattr(myobj, name, row[i])
-            results.append(myobj)
-        return results
+        self.threshold = threshold
+        self.max_queries = max_queries
+        self.max_samples = max_samples
+        self.queries = OrderedDict()
+        self.lock = threading.Lock()
 
-    def Fetch(self, sqlbuilder, result=False, commit=False):
+    @classmethod
+    def Fingerprint(cls, sql):
         """
-        Facade for Db class for executing queries
-        and fetching the results.
+        Normalizes sql text.
+
+        Arguments:
+            sql -- sql text
+        Returns:
+            fingerprint
+        """
+        sql = cls.SPACES.sub(' ', sql).strip()
+        return cls.PLACEHOLDERS.sub('IN (?, ...)', sql)
+
+    def Record(self, sql, elapsed, rows, size=0):
+        """
+        Records executed query.
+
+        Arguments:
+            sql -- sql text
+            elapsed -- seconds
+            rows -- number of fetched or affected rows
+            size -- approximate number of bytes of fetched values
+        """
+        if elapsed < self.threshold:
+            return
+        fingerprint = self.Fingerprint(sql)
+        with self.lock:
+            stats = self.queries.pop(fingerprint, None)
+            if stats is None:
+                stats = {'count': 0, 'total': 0.0, 'rows': 0, 'peak_bytes': 0,
+                        'samples': []}
+                if len(self.queries) >= self.max_queries:
+                    self.queries.popitem(last=False)
+            self.queries[fingerprint] = stats
+            stats['count'] += 1
+            stats['total'] += elapsed
+            stats['rows'] += rows
+            stats['peak_bytes'] = max(stats['peak_bytes'], size)
+            if len(stats['samples']) < self.max_samples:
+                stats['samples'].append(elapsed)
+            else:
+                i = random.randint(0, stats['count'] - 1)
+                if i < self.max_samples:
+                    stats['samples'][i] = elapsed
+
+    def Top(self, top=10):
+        """
+        Returns the most expensive queries by total time.
+
+        Arguments:
+            top -- number of queries
+        Returns:
+            list of dicts with fingerprint, count, total, p50, p99, rows
+            and peak_bytes, the largest result of the query
+        """
+        with self.lock:
+            items = [(fingerprint, dict(stats, samples=sorted(
+                stats['samples']))) for fingerprint, stats
+                in self.queries.items()]
+        report = []
+        for fingerprint, stats in items:
+            samples = stats['samples']
+            report.append({'fingerprint': fingerprint,
+                'count': stats['count'],
+                'total': stats['total'],
+                'p50': samples[int(round(0.5 * (len(samples) - 1)))],
+                'p99': samples[int(round(0.99 * (len(samples) - 1)))],
+                'rows': stats['rows'],
+                'peak_bytes': stats['peak_bytes']})
+        report.sort(key=lambda stats: stats['total'], reverse=True)
+        return report[:top]
+
+    def Dump(self, path=None, top=10):
+        """
+        Writes report of the most expensive queries to the file or
+        to the log.
+
+        Arguments:
+            path -- path of the file, report is logged if not set
+            top -- number of queries
+        """
+        lines = ['{total:10.3f}s {count:8d} p50={p50:.4f}s p99={p99:.4f}s '
+                'rows={rows:d} peak={peak_bytes:d}B {fingerprint}'.format(
+                    **stats)
+                for stats in self.Top(top)]
+        if path is None:
+            logging.info('Top queries:\n' + '\n'.join(lines))
+        else:
+            with open(path, 'w') as report_file:
+                report_file.write('\n'.join(lines) + '\n')
+
+class IndexAdvisor(object):
+    """
+    Records which columns are filtered and joined by every query shape
+    and recommends indexes for the shapes whose plan scans the table.
+
+    Time saved by an index is estimated as the total time spent by the
+    queries that would use it.
+    """
+    EQUALITY = (' = ',)
+    RANGE = (' < ', ' <= ', ' > ', ' >= ')
+    SCAN = re.compile(r'^(?:SCAN (?:TABLE )?(\w+)|'
+            r'SEARCH (?:TABLE )?(\w+) .*USING AUTOMATIC)')
+
+    def __init__(self):
+        """Constructor."""
+        self.shapes = {}
+        self.lock = threading.Lock()
+
+    def Record(self, sqlbuilder, sql, data, elapsed):
+        """
+        Records executed query.
+
+        Arguments:
+            sqlbuilder -- SqlBuilder instance
+            sql -- compiled sql
+            data -- parameters of the query
+            elapsed -- seconds
+        """
+        fingerprint = QueryLog.Fingerprint(sql)
+        with self.lock:
+            shape = self.shapes.get(fingerprint)
+            if shape is None:
+                shape = {'sql': sql, 'data': data, 'total': 0.0, 'count': 0,
+                        'columns': self._Columns(sqlbuilder.Predicates())}
+                self.shapes[fingerprint] = shape
+            shape['total'] += elapsed
+            shape['count'] += 1
+
+    def _Columns(self, predicates):
+        """
+        Chooses index columns for every table: columns compared for
+        equality or joined first, then one column compared by range.
+        Columns of ORDER BY are not considered.
+
+        Arguments:
+            predicates -- list of (operator, ColumnRef, is join) tuples
+        Returns:
+            dict from table name to tuple of column names
+        """
+        equality = {}
+        ranges = {}
+        for op, ref, _ in predicates:
+            table = ref.table.lower()
+            if op in self.EQUALITY or op == 'IN':
+                equality.setdefault(table, set()).add(ref.column)
+            elif op in self.RANGE:
+                ranges.setdefault(table, ref.column)
+        columns = {}
+        for table in set(equality) | set(ranges):
+            names = sorted(equality.get(table, ()))
+            if table in ranges and ranges[table] not in names:
+                names.append(ranges[table])
+            columns[table] = tuple(names)
+        return columns
+
+    def Recommend(self, db):
+        """
+        Checks plans of the recorded shapes and recommends indexes.
+
+        Arguments:
+            db -- Db instance
+        Returns:
+            list of (CREATE INDEX statement, estimated seconds saved),
+            the most useful first
+        """
+        with self.lock:
+            shapes = self.shapes.values()
+        saved = {}
+        for shape in shapes:
+            plan = db.db.ExplainPlan(shape['sql'], shape['data'])
+            scanned = set()
+            for detail in plan:
+                match = self.SCAN.search(detail)
+                if match:
+                    table = match.group(1) or match.group(2)
+                    scanned.add(table.lower())
+            for table, names in shape['columns'].items():
+                if table in scanned:
+                    key = (table, names)
+                    saved[key] = saved.get(key, 0.0) + shape['total']
+        recommendations = []
+        for (table, names), seconds in saved.items():
+            statement = 'CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})'.format(
+                    '_'.join(('idx', table) + names), table, ', '.join(names))
+            recommendations.append((statement, seconds))
+        recommendations.sort(key=lambda item: item[1], reverse=True)
+        return recommendations
+
+class RetryPolicy(object):
+    """
+    Retries statements that failed because the database is locked by
+    another connection. Delays grow exponentially with full jitter so that
+    colliding writers do not retry in lockstep.
+
+    Only safe statements are retried: reads, and, if writes is True,
+    single statements whose transaction is rolled back on failure.
+    Scripts are never retried, executescript commits every statement
+    separately so part of the script may be already applied.
+    """
+    READ = re.compile(r'\s*(SELECT|WITH|EXPLAIN|PRAGMA)\b', re.IGNORECASE)
+    LOCKED = re.compile(r'database( \w+)? is (locked|busy)')
+
+    def __init__(self, max_attempts=5, base_delay=0.01, max_delay=1.0,
+            busy_timeout=5.0, writes=True):
+        """
+        Constructor.
+
+        Arguments:
+            max_attempts -- max number of attempts including the first one
+            base_delay -- seconds, delay before the first retry
+            max_delay -- seconds, upper bound of the delay
+            busy_timeout -- seconds sqlite waits for the lock itself
+                before reporting that the database is locked
+            writes -- retry writes, otherwise only reads are retried
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.busy_timeout = busy_timeout
+        self.writes = writes
+        self.counters = {'retries': 0, 'recovered': 0, 'failures': 0}
+        self.lock = threading.Lock()
+
+    def IsSafe(self, sql, script=False):
+        """
+        Checks if the statement may be executed again.
+
+        Arguments:
+            sql -- sql text
+            script -- statement is executed with executescript
+        Returns:
+            True if the statement is safe to retry
+        """
+        if script:
+            return False
+        return self.writes or self.READ.match(sql) is not None
+
+    def IsRetryable(self, error):
+        """
+        Checks if the error is caused by the lock of another connection.
+
+        Arguments:
+            error -- exception instance
+        Returns:
+            True if the error is worth retrying
+        """
+        return (isinstance(error, OperationalError) and
+                self.LOCKED.search(str(error)) is not None)
+
+    def Delay(self, attempt):
+        """
+        Returns delay before the next attempt.
+
+        Arguments:
+            attempt -- number of failed attempts, starting from 1
+        Returns:
+            seconds
+        """
+        return random.uniform(0, min(self.max_delay,
+            self.base_delay * 2 ** (attempt - 1)))
+
+    def Call(self, fn, safe=True):
+        """
+        Calls function retrying it while the database is locked.
+
+        Arguments:
+            fn -- function without arguments
+            safe -- function may be called again after the failure
+        Returns:
+            result of the function
+        """
+        attempt = 1
+        while True:
+            try:
+                result = fn()
+            except Exception:
+                error = sys.exc_info()[1]
+                if not self.IsRetryable(error):
+                    raise
+                if not safe or attempt >= self.max_attempts:
+                    self._Count('failures')
+                    raise
+                self._Count('retries')
+                delay = self.Delay(attempt)
+                logging.info('Retrying in {0:.3f}s after {1}'.format(delay,
+                    error))
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if attempt > 1:
+                self._Count('recovered')
+            return result
+
+    def Stats(self):
+        """
+        Returns counters: number of retries, of calls that succeeded after
+        retrying and of calls that failed because the lock was not released.
+        """
+        with self.lock:
+            return dict(self.counters)
+
+    def _Count(self, name):
+        """Increments counter."""
+        with self.lock:
+            self.counters[name] += 1
+
+class WriteFuture(object):
+    """Result of the statement executed by WriteQueue."""
+    def __init__(self):
+        """Constructor."""
+        self.event = threading.Event()
+        self.count = None
+        self.error = None
+
+    def Done(self):
+        """Returns True if the statement is committed or failed."""
+        return self.event.is_set()
+
+    def Wait(self, timeout=None):
+        """
+        Waits until the statement is committed.
+
+        Arguments:
+            timeout -- seconds or None to wait forever
+        Returns:
+            number of affected rows
+        Raises:
+            error of the statement or QueryTimeoutError
+        """
+        if not self.event.wait(timeout):
+            raise QueryTimeoutError('Write is not committed yet')
+        if self.error is not None:
+            raise self.error
+        return self.count
+
+    def _Set(self, count=None, error=None):
+        """Stores result and wakes up waiting threads."""
+        self.count = count
+        self.error = error
+        self.event.set()
+
+class WriteQueue(object):
+    """
+    Write-behind queue. Statements from many threads are executed by one
+    writer thread that groups them into transactions of at most
+    max_batch statements, waiting at most max_delay seconds for more
+    statements to arrive. If a group fails, its statements are retried one
+    by one so that only the failed statement reports the error. Scripts
+    and other statements than INSERT, UPDATE, DELETE and REPLACE, i.e.
+    CREATE TABLE, commit on their own, so every one of them is written as
+    a separate group and is never retried.
+    """
+    DML = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+
+    def __init__(self, db, max_batch=100, max_delay=0.005):
+        """
+        Constructor.
+
+        Arguments:
+            db -- SQLiteDb instance
+            max_batch -- max number of statements in one transaction
+            max_delay -- seconds to wait for the group to fill up
+        """
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._Run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Put(self, sql, data, script=False, tables=()):
+        """
+        Enqueues statement.
+
+        Arguments:
+            sql -- sql text
+            data -- parameters
+            script -- execute with executescript
+            tables -- names of written tables
+        Returns:
+            WriteFuture
+        """
+        future = WriteFuture()
+        self.queue.put((sql, data, script, tables, future))
+        return future
+
+    def Close(self):
+        """Writes pending statements and stops the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _Run(self):
+        """Drains the queue into grouped transactions."""
+        connection = connect(self.db.name, timeout=self.db.busy_timeout)
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                batch = [item]
+                deadline = time.time() + self.max_delay
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self.queue.get(
+                                timeout=max(deadline - time.time(), 0))
+                    except Empty:
+                        break
+                    if item is None:
+                        self._Flush(connection, batch)
+                        return
+                    batch.append(item)
+                self._Flush(connection, batch)
+        finally:
+            connection.close()
+
+    def _Flush(self, connection, batch):
+        """
+        Writes the batch in groups, every script and statement that
+        commits on its own in a separate group.
+
+        Arguments:
+            connection -- connection of the writer thread
+            batch -- list of queued items
+        """
+        group = []
+        for item in batch:
+            if not item[2] and self.DML.match(item[0]):
+                group.append(item)
+                continue
+            if group:
+                self._Write(connection, group)
+                group = []
+            self._Write(connection, [item])
+        if group:
+            self._Write(connection, group)
+
+    def _Write(self, connection, batch):
+        """
+        Executes statements in one transaction.
+
+        Arguments:
+            connection -- connection of the writer thread
+            batch -- list of queued items
+        """
+        logging.info('Writing {0} statements'.format(len(batch)))
+
+        def write():
+            """Executes and commits the group."""
+            try:
+                counts = [self._Execute(connection, item) for item in batch]
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            return counts
+
+        try:
+            counts = self.db._Retry(write,
+                    not any(item[2] for item in batch))
+        except Exception:
+            if len(batch) > 1:
+                for item in batch:
+                    self._Write(connection, [item])
+            else:
+                batch[0][-1]._Set(error=sys.exc_info()[1])
+            return
+        tables = set()
+        for item in batch:
+            tables.update(item[3])
+        self.db._InvalidateReplica(tables)
+        for item, count in zip(batch, counts):
+            item[-1]._Set(count)
+
+    def _Execute(self, connection, item):
+        """
+        Executes one queued statement.
+
+        Arguments:
+            connection -- connection of the writer thread
+            item -- queued item
+        Returns:
+            number of affected rows
+        """
+        sql, data, script = item[:3]
+        if script:
+            connection.executescript(sql)
+            return 0
+        return max(connection.execute(sql, data).rowcount, 0)
+
+class Db(object):
+    """
+    Base class for database abstraction. Should be subclassed with the
+    concrete implementations.
+
+    Keeps all tables in the database represented as nested classes.
+    """
+    def __init__(self, db_type='sqlite', params=None):
+        """Constructor creates delegated Db subclass depending on
+        requested db type."""
+        if not params:
+            params = {}
+        if db_type == 'sqlite':
+            self.db = SQLiteDb(params)
+        elif db_type == 'mysql':
+            self.db = MySQLDb(params)
+        elif db_type == 'sharded':
+            self.db = ShardedDb(params)
+        else:
+            raise NotImplementedError()
+
+    def __getattr__(self, name):
+        """
+        Materializes Table subclass for reflected table on first access.
+
+        Arguments:
+            name -- name of the table, case insensitive
+        Returns:
+            Table subclass
+        Raises:
+            AttributeError
+        """
+        schema = self.__dict__.get('schema')
+        if not schema or name.lower() not in schema:
+            raise AttributeError(name)
+        attrs = dict((str(column), _ColumnForType(declared_type))
+                for column, declared_type in schema[name.lower()])
+        table = MetaTable(str(name), (Table,), attrs)
+        setattr(self, name, table)
+        return table
+
+    def Reflect(self, cache=None, refresh=False):
+        """
+        Reads schema of the existing database. Table classes are
+        created lazily on first attribute access, i.e. db.Orders.
+
+        Arguments:
+            cache -- path of the file to keep the schema in
+            refresh -- read schema from the database even if cache exists
+        Returns:
+            list of table names
+        """
+        if cache and not refresh and os.path.exists(cache):
+            with open(cache) as cache_file:
+                self.schema = json.load(cache_file)
+        else:
+            self.schema = self.db._ReadSchema()
+            if cache:
+                with open(cache, 'w') as cache_file:
+                    json.dump(self.schema, cache_file)
+        return sorted(self.schema)
+
+    def ExplainPlan(self, sql, data):
+        """
+        Returns plan of the query.
+
+        Arguments:
+            sql -- sql text
+            data -- parameters
+        Returns:
+            list of plan steps as text
+        """
+        raise NotImplementedError()
+
+    def _ReadSchema(self):
+        """
+        Reads schema from the database.
+
+        Returns:
+            dict from table name to list of (column name, type) pairs
+        """
+        raise NotImplementedError()
+
+    def _Query(self):
+        """Queries database."""
+        raise NotImplementedError()
+
+    def _OpenConnection(self):
+        """Opens connection with the database."""
+        raise NotImplementedError()
+
+    def _CloseConnection(self):
+        """Closes connection with the database."""
+        raise NotImplementedError()
+
+    def _GetResults(self, select_columns, adapters=()):
+        """
+        Returns results from cursor object.
+
+        Arguments:
+            select_columns -- columns to fetch from
+            adapters -- list of (index, function) converting fetched values
+        Returns:
+            list of Result objects
+        """
+        raise NotImplementedError()
+
+    def _GetNested(self, select_columns, adapters, parent_key, children):
+        """
+        Returns parent objects with lists of child objects from the
+        cursor of joined query.
+
+        Arguments:
+            select_columns -- columns to fetch from
+            adapters -- list of (index, function) converting fetched values
+            parent_key -- key column of the parent table
+            children -- dict from attribute name to key column of
+                the child table
+        Returns:
+            list of Result objects
+        """
+        raise NotImplementedError()
+
+    def _GetMapping(self, adapters, key_index, value_index):
+        """
+        Returns dict built from two columns of the cursor.
+
+        Arguments:
+            adapters -- list of (index, function) converting fetched values
+            key_index -- position of the key column
+            value_index -- position of the value column
+        Returns:
+            dict from key to value
+        """
+        raise NotImplementedError()
+
+    def _GetScalars(self, adapters, index):
+        """
+        Returns values of one column of the cursor.
+
+        Arguments:
+            adapters -- list of (index, function) converting fetched values
+            index -- position of the column
+        Returns:
+            list of values
+        """
+        raise NotImplementedError()
+
+    def _Commit(self):
+        """Commits a transaction."""
+        raise NotImplementedError()
+
+    def Fetch(self, sqlbuilder, result=False, commit=False, nested=None,
+            mapping=None, scalars=None):
+        """
+        Facade for Db class for executing queries
+        and fetching the results.
+
+        Arguments:
+            sqlbuilder -- SqlBuilder instance
+            result -- is it need to return result
+            commit -- is it need to commit
+            nested -- tuple of parent key column and dict from attribute
+                name to child key column, see _GetNested
+            mapping -- tuple of key and value indexes, see _GetMapping
+            scalars -- index of the column, see _GetScalars
+        Returns:
+            if result is True, returns list of Result objects
+        """
+        raise NotImplementedError()
+
+    def ExecuteMany(self, statements, bulk=False):
+        """
+        Executes statements in one transaction.
+
+        Arguments:
+            statements -- iterable of (sql, sequence of parameter tuples)
+            bulk -- tune connection for loading large amount of data
+        Returns:
+            number of affected rows
+        """
+        raise NotImplementedError()
+
+    def Export(self, sqlbuilder, path, format='csv', batch_size=1000):
+        """
+        Writes results of the query to the file.
+
+        Arguments:
+            sqlbuilder -- SqlBuilder instance
+            path -- path of the file
+            format -- 'csv' or 'jsonl'
+            batch_size -- number of rows read from cursor at once
+        Returns:
+            number of written rows
+        """
+        raise NotImplementedError()
+
+    def FetchMany(self, sqlbuilders, snapshot=False, workers=None):
+        """
+        Executes several queries and fetches their results.
+
+        Arguments:
+            sqlbuilders -- list of SqlBuilder instances
+            snapshot -- read all queries in one transaction
+            workers -- number of threads executing the queries
+        Returns:
+            list of lists of Result objects
+        """
+        raise NotImplementedError()
+
+    def FetchBatch(self, sqlbuilders, snapshot=False, workers=None):
+        """
+        Executes independent queries, i.e. all queries of the page, on one
+        connection instead of connecting for each of them. With snapshot
+        all queries see the same state of the database. With workers the
+        queries are spread over that many threads, every one with its own
+        connection.
+
+        Arguments:
+            sqlbuilders -- list of SqlBuilder instances
+            snapshot -- read all queries in one transaction
+            workers -- number of threads executing the queries
+        Returns:
+            list of lists of Result objects in the order of queries
+        Raises:
+            ValueError if both snapshot and workers are requested
+        """
+        if snapshot and workers:
+            raise ValueError('Snapshot can not be shared between threads')
+        return self.db.FetchMany(list(sqlbuilders), snapshot, workers)
+
+    def Close(self):
+        """
+        Stops threads of the database, i.e. the write queue or the thread
+        pool of shards. Pending writes are written first.
+        """
+        self.db._Close()
+
+    def _Close(self):
+        """Stops threads of the implementation."""
+        pass
+
+    def DeleteMany(self, table, key_column, keys):
+        """
+        Deletes rows by the list of keys. Keys are bound as parameters
+        and split into chunks so that every statement stays within
+        the limit of host parameters.
+
+        Arguments:
+            table -- subclass of Table
+            key_column -- column of the table to match keys against
+            keys -- iterable of keys
+        Returns:
+            number of deleted rows
+        """
+        return self.db.ExecuteMany(
+                self._DeleteStatements(table, key_column, keys))
+
+    def UpdateMany(self, table, key_column, rows):
+        """
+        Updates rows by key. Rows that set the same columns share one
+        prepared UPDATE statement executed with executemany.
+
+        Arguments:
+            table -- subclass of Table
+            key_column -- column of the table to match keys against
+            rows -- iterable of dicts from Column (or column name) to
+                new value, each of them contains the key column
+        Returns:
+            number of updated rows
+        """
+        return self.db.ExecuteMany(
+                self._UpdateStatements(table, key_column, rows))
+
+    def MigrateToEpoch(self, column):
+        """
+        Converts values of the datetime column stored as ISO text, i.e.
+        before the column was switched to epoch storage, to epoch seconds.
+        Text that is not a date is left as is. Should be run once on
+        existing databases, otherwise text values are compared with
+        numbers.
+
+        Arguments:
+            column -- DateTimeColumn with epoch storage
+        Returns:
+            number of converted rows
+        Raises:
+            InvalidTypeError if the column is not stored as epoch
+        """
+        if getattr(column, 'storage', None) != 'epoch':
+            raise InvalidTypeError('{0}.{1} is not stored as epoch'.format(
+                column.table_name, column.column_name))
+        sql = ("UPDATE {0} SET {1} = CAST(strftime('%s', {1}) AS INTEGER) "
+                "WHERE typeof({1}) = 'text' AND strftime('%s', {1}) "
+                "IS NOT NULL").format(column.table_name.lower(),
+                        column.column_name)
+        return self.db.ExecuteMany([(sql, [()])])
+
+    def _DeleteStatements(self, table, key_column, keys):
+        """
+        Yields one DELETE statement per chunk of keys.
+
+        Arguments:
+            table -- subclass of Table
+            key_column -- column of the table to match keys against
+            keys -- iterable of keys
+        Returns:
+            generator of (sql, list of parameter tuples)
+        """
+        limit = self.db.max_variables
+        prefix = 'DELETE FROM {0} WHERE {1} IN ('.format(table.get_name(),
+                key_column.column_name)
+        keys = (key_column.to_db(key) for key in keys)
+        chunk = tuple(islice(keys, limit))
+        while chunk:
+            sql = ''.join((prefix, ', '.join('?' * len(chunk)), ')'))
+            yield sql, [chunk]
+            chunk = tuple(islice(keys, limit))
+
+    def _UpdateStatements(self, table, key_column, rows):
+        """
+        Yields one UPDATE statement per set of updated columns.
+
+        Arguments:
+            table -- subclass of Table
+            key_column -- column of the table to match keys against
+            rows -- iterable of dicts from Column (or column name) to
+                new value, each of them contains the key column
+        Returns:
+            generator of (sql, list of parameter tuples)
+        """
+        key_name = key_column.column_name
+        groups = {}
+        for names, values in self._GroupRows(table, rows):
+            index = names.index(key_name)
+            groups.setdefault(names[:index] + names[index + 1:], []).append(
+                    values[:index] + values[index + 1:] + (values[index],))
+        for names, params in groups.items():
+            sql = 'UPDATE {0} SET {1} WHERE {2} = ?'.format(
+                    table.get_name(),
+                    ', '.join(name + ' = ?' for name in names),
+                    key_name)
+            yield sql, params
+
+    def _InsertStatements(self, table, rows):
+        """
+        Yields one INSERT statement per set of inserted columns.
+
+        Arguments:
+            table -- subclass of Table
+            rows -- iterable of dicts from Column (or column name) to value
+        Returns:
+            generator of (sql, list of parameter tuples)
+        """
+        groups = {}
+        for names, values in self._GroupRows(table, rows):
+            groups.setdefault(names, []).append(values)
+        for names, params in groups.items():
+            sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                    table.get_name(), ', '.join(names),
+                    ', '.join('?' * len(names)))
+            yield sql, params
+
+    def _GroupRows(self, table, rows):
+        """
+        Converts rows to the storage form.
+
+        Arguments:
+            table -- subclass of Table
+            rows -- iterable of dicts from Column (or column name) to value
+        Returns:
+            generator of (sorted tuple of column names, tuple of values)
+        """
+        for row in rows:
+            values = {}
+            for column, value in row.items():
+                if not isinstance(column, Column):
+                    column = getattr(table, column)
+                values[column.column_name] = column.to_db(value)
+            names = tuple(sorted(values))
+            yield names, tuple(values[name] for name in names)
+
+    def ImportFrom(self, table, path, format='csv', columns=None,
+            batch_size=1000):
+        """
+        Loads rows from the file into the table. The file is parsed
+        lazily, values are checked against the column types batch by batch
+        and inserted with executemany in one transaction.
+
+        Arguments:
+            table -- subclass of Table
+            path -- path of the file
+            format -- 'csv' with header line or 'jsonl'
+            columns -- columns to load, by default all columns of the table
+                present in the csv header
+            batch_size -- number of rows inserted at once
+        Returns:
+            number of inserted rows
+        Raises:
+            InvalidTypeError
+        """
+        with open(path, 'rb') as source:
+            if format == 'csv':
+                reader = csv.reader(source)
+                header = next(reader)
+                if columns is None:
+                    columns = [column for column in table.all
+                            if column.column_name in header]
+                positions = [header.index(column.column_name)
+                        for column in columns]
+                rows = (tuple(row[i] for i in positions) for row in reader)
+            elif format == 'jsonl':
+                if columns is None:
+                    columns = table.all
+                names = [column.column_name for column in columns]
+                rows = (tuple(map(json.loads(line).get, names))
+                        for line in source if line.strip())
+            else:
+                raise NotImplementedError(
+                        'Unsupported format {0}'.format(format))
+
+            sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                    table.get_name(),
+                    ', '.join(column.column_name for column in columns),
+                    ', '.join('?' * len(columns)))
+
+            def statements():
+                """Yields INSERT statement per checked batch of rows."""
+                batch = list(islice(rows, batch_size))
+                while batch:
+                    values = [map(column.parse, column_values)
+                            for column, column_values
+                            in zip(columns, zip(*batch))]
+                    yield sql, zip(*values)
+                    batch = list(islice(rows, batch_size))
+
+            return self.db.ExecuteMany(statements(), bulk=True)
+
+    class Users(Table):
+        """ Represents Users table in the database."""
+        id = IntegerColumn()
+        login = StringColumn()
+        last_login_time = DateTimeColumn()
+        flag = StringColumn()
+        position = IntegerColumn()
+        class_field = StringColumn()
+
+    class Managers(Table):
+        """ Represents Managers table in the database."""
+        id = IntegerColumn()
+        photo = StringColumn()
+
+class SQLiteDb(Db):
+    """SQLite3 implementation."""
+    BULK_PRAGMAS = ('PRAGMA synchronous = OFF',
+            'PRAGMA cache_size = -65536',
+            'PRAGMA temp_store = MEMORY')
+
+    def __init__(self, params):
+        self.params = params
+        self.cursor = None
+        self.connection = None
+        self.held = False
+        self.script = False
+        self.name = params.get('name', 'sample.db')
+        self.max_variables = params.get('max_variables', 999)
+        self.batch_size = params.get('batch_size', 1000)
+        self.timeout = params.get('timeout')
+        self.max_rows = params.get('max_rows')
+        self.max_bytes = params.get('max_bytes')
+        self.row_limit = self.byte_limit = None
+        self.fetched_bytes = 0
+        self.query_log = params.get('query_log')
+        self.index_advisor = params.get('index_advisor')
+        self.retry = params.get('retry')
+        self.busy_timeout = (self.retry.busy_timeout
+                if self.retry is not None else 5.0)
+        replica = params.get('replica')
+        self.replica = None
+        if replica:
+            self.replica = connect(':memory:', check_same_thread=False)
+            self.replica_lock = threading.Lock()
+            self.replica_tables = (None if replica is True else
+                    set(table.get_name() for table in replica))
+            # Virtual tables and their shadow tables are not copied
+            self.replica_virtual = set()
+            self.replica_stale = True
+        write_queue = params.get('write_queue')
+        self.write_queue = None
+        if write_queue:
+            self.write_queue = WriteQueue(self,
+                    **(write_queue if isinstance(write_queue, dict) else {}))
+
+    def _Query(self):
+        """Queries database."""
+        logging.info('Sql = {0}, data={1}'.format(self.sql, self.data))
+        if self.script:
+            self.cursor.executescript(self.sql)
+        else:
+            self.cursor.execute(self.sql, self.data)
+
+    def _Commit(self):
+        """Commits a transaction."""
+        self.connection.commit()
+
+    def ExplainPlan(self, sql, data):
+        """
+        Returns plan of the query from EXPLAIN QUERY PLAN.
+
+        Arguments:
+            sql -- sql text
+            data -- parameters
+        Returns:
+            list of plan steps as text
+        """
+        try:
+            self._OpenConnection()
+            self.cursor.execute('EXPLAIN QUERY PLAN ' + sql, data)
+            return [row[-1] for row in self.cursor.fetchall()]
+        finally:
+            self._CloseConnection()
+
+    def _ReadSchema(self):
+        """
+        Reads schema from sqlite_master and PRAGMA table_info.
+
+        Returns:
+            dict from table name to list of (column name, type) pairs
+        """
+        schema = {}
+        try:
+            self._OpenConnection()
+            self.cursor.execute("SELECT name FROM sqlite_master "
+                    "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+            names = [row[0] for row in self.cursor.fetchall()]
+            for name in names:
+                self.cursor.execute('PRAGMA table_info("{0}")'.format(
+                    name.replace('"', '""')))
+                schema[name.lower()] = [(row[1], row[2])
+                        for row in self.cursor.fetchall()]
+        finally:
+            self._CloseConnection()
+        return schema
+
+    def _OpenConnection(self, replica=False):
+        """
+        Opens connection with the database.
+
+        Arguments:
+            replica -- use in-memory replica instead of the file
+        """
+        if self.held:
+            self.cursor = self.connection.cursor()
+            return
+        if replica:
+            self.replica_lock.acquire()
+            try:
+                if self.replica_stale:
+                    self._LoadReplica()
+            except Exception:
+                self.replica_lock.release()
+                raise
+            self.connection = self.replica
+        else:
+            self.connection = connect(self.name, timeout=self.busy_timeout)
+        self.cursor = self.connection.cursor()
+
+    def _CloseConnection(self):
+        """Closes connection with the database."""
+        self.cursor.close()
+        if self.held:
+            return
+        if self.connection is self.replica:
+            self.replica_lock.release()
+        else:
+            self.connection.close()
+
+    def _Close(self):
+        """Writes pending statements and stops the write queue."""
+        if self.write_queue is not None:
+            self.write_queue.Close()
+
+    def _IsReplicated(self, sqlbuilder):
+        """
+        Checks if all tables of the query are kept in the replica.
+        Queries of virtual tables, i.e. full-text indexes, are served
+        from the file.
+
+        Arguments:
+            sqlbuilder -- SqlBuilder instance
+        """
+        if self.replica is None or not sqlbuilder.tables:
+            return False
+        if (self.replica_tables is not None
+                and not sqlbuilder.tables <= self.replica_tables):
+            return False
+        with self.replica_lock:
+            if self.replica_stale:
+                self._LoadReplica()
+            return not sqlbuilder.tables & self.replica_virtual
+
+    def _InvalidateReplica(self, tables=None):
+        """
+        Marks replica to be reloaded on the next read after write.
+
+        Arguments:
+            tables -- names of written tables, all tables if not known
+        """
+        if self.replica is None:
+            return
+        if tables:
+            # Summary tables are written by triggers of their sources
+            tables = set(tables).union(*[MetaTable.summaries.get(name, ())
+                for name in tables])
+        if (not tables or self.replica_tables is None
+                or tables & self.replica_tables):
+            self.replica_stale = True
+
+    def _LoadReplica(self):
+        """
+        Copies replicated tables with their indexes from the file into
+        the in-memory database. Is called with replica lock held.
+        """
+        replica = self.replica
+        replica.execute('ATTACH DATABASE ? AS disk', (self.name,))
+        try:
+            tables = replica.execute("SELECT name, sql FROM "
+                    "disk.sqlite_master WHERE type = 'table' AND "
+                    "name NOT LIKE 'sqlite_%'").fetchall()
+            virtual = [name for name, sql in tables
+                    if sql.upper().startswith('CREATE VIRTUAL')]
+            skipped = set(name for name, _ in tables if name in virtual or
+                    any(name.startswith(prefix + '_') for prefix in virtual))
+            for name, _ in replica.execute("SELECT name, sql FROM "
+                    "main.sqlite_master WHERE type = 'table'").fetchall():
+                replica.execute('DROP TABLE main."{0}"'.format(name))
+            for name, sql in tables:
+                if (self.replica_tables is not None
+                        and name.lower() not in self.replica_tables):
+                    continue
+                if name in skipped:
+                    continue
+                replica.execute(sql)
+                replica.execute('INSERT INTO main."{0}" SELECT * FROM '
+                        'disk."{0}"'.format(name))
+                for index, in replica.execute("SELECT sql FROM "
+                        "disk.sqlite_master WHERE type = 'index' AND "
+                        "tbl_name = ? AND sql IS NOT NULL", (name,)
+                        ).fetchall():
+                    replica.execute(index)
+            replica.commit()
+            self.replica_virtual = set(name.lower() for name in skipped)
+            self.replica_stale = False
+        finally:
+            replica.rollback()
+            replica.execute('DETACH DATABASE disk')
+
+    def _GetResults(self, select_columns, adapters=()):
+        """
+        Returns results from cursor object. Adapters are applied
+        to whole columns of every batch of fetched rows.
+
+        Arguments:
+            select_columns -- columns to fetch from
+            adapters -- list of (index, function) converting fetched values
+        Returns:
+            list of Result objects
+        """
+        results = []
+        for rows in self._Batches(adapters):
+            for row in rows:
+                myobj = Result()
+                for i, name in enumerate(select_columns):
+                    # Split name and take last part if there is a dot in it
+                    name = (name.split('.')[-1] if name.find('.') != -1
+                            else name)
+                    setattr(myobj, name, row[i])
+                results.append(myobj)
+        return results
+
+    def _Batches(self, adapters=()):
+        """
+        Reads rows from cursor in batches. Adapters are applied to whole
+        columns of every batch. Limits of rows and bytes are checked after
+        every batch, bytes are estimated as length of text values and
+        8 bytes for other values.
+
+        Arguments:
+            adapters -- list of (index, function) converting fetched values
+        Returns:
+            generator of lists of row tuples
+        """
+        measure = self.byte_limit is not None or self.query_log is not None
+        count = 0
+        while True:
+            size = self.batch_size
+            if self.row_limit is not None:
+                # One row over the limit is enough to detect the overflow
+                size = min(size, self.row_limit - count + 1)
+            rows = self.cursor.fetchmany(size)
+            if not rows:
+                return
+            count += len(rows)
+            if self.row_limit is not None and count > self.row_limit:
+                raise ResultTooLargeError('Query returned more than {0} '
+                        'rows, stream it with ExportTo or FetchSince: '
+                        '{1}'.format(self.row_limit, self.sql))
+            if measure:
+                self.fetched_bytes += sum([len(value)
+                    if isinstance(value, basestring) else 8
+                    for row in rows for value in row])
+                if (self.byte_limit is not None and
+                        self.fetched_bytes > self.byte_limit):
+                    raise ResultTooLargeError('Query returned more than {0} '
+                            'bytes, stream it with ExportTo or FetchSince: '
+                            '{1}'.format(self.byte_limit, self.sql))
+            if adapters:
+                columns = zip(*rows)
+                for i, adapter in adapters:
+                    columns[i] = map(adapter, columns[i])
+                rows = zip(*columns)
+            yield rows
+
+    def _GetMapping(self, adapters, key_index, value_index):
+        """
+        Returns dict built directly from batches of row tuples, no Result
+        objects are created.
+
+        Arguments:
+            adapters -- list of (index, function) converting fetched values
+            key_index -- position of the key column
+            value_index -- position of the value column
+        Returns:
+            dict from key to value
+        """
+        mapping = {}
+        pairs = (key_index, value_index) == (0, 1)
+        for rows in self._Batches(adapters):
+            if pairs and len(rows[0]) == 2:
+                mapping.update(rows)
+            else:
+                mapping.update([(row[key_index], row[value_index])
+                    for row in rows])
+        return mapping
+
+    def _GetScalars(self, adapters, index):
+        """
+        Returns values of one column built directly from batches of row
+        tuples.
+
+        Arguments:
+            adapters -- list of (index, function) converting fetched values
+            index -- position of the column
+        Returns:
+            list of values
+        """
+        values = []
+        for rows in self._Batches(adapters):
+            values.extend([row[index] for row in rows])
+        return values
+
+    def _GetNested(self, select_columns, adapters, parent_key, children):
+        """
+        Returns parent objects with lists of child objects from the
+        cursor of joined query. Every row of the parent and child tables
+        is hydrated once: objects are kept in identity map by table name
+        and key, so the same child is shared between parents.
+
+        Arguments:
+            select_columns -- columns to fetch from, key columns must be
+                among them
+            adapters -- list of (index, function) converting fetched values
+            parent_key -- key column of the parent table
+            children -- dict from attribute name to key column of
+                the child table
+        Returns:
+            list of Result objects
+        """
+        fields = {}
+        for i, name in enumerate(select_columns):
+            table, column = name.split('.')
+            fields.setdefault(table, []).append((i, column))
+
+        def key_index(column):
+            """Returns position of the key column in the row."""
+            return select_columns.index(''.join((column.table_name, '.',
+                column.column_name)))
+
+        parent_table = parent_key.table_name
+        parent_index = key_index(parent_key)
+        parent_fields = fields[parent_table]
+        relations = [(name, column.table_name, key_index(column),
+            fields[column.table_name]) for name, column in children.items()]
+
+        identity = {}
+        linked = set()
+        results = []
+        for rows in self._Batches(adapters):
+            for row in rows:
+                key = row[parent_index]
+                parent = identity.get((parent_table, key))
+                if parent is None:
+                    parent = Result()
+                    for i, name in parent_fields:
+                        setattr(parent, name, row[i])
+                    for name, _, _, _ in relations:
+                        setattr(parent, name, [])
+                    identity[(parent_table, key)] = parent
+                    results.append(parent)
+
+                for name, table, index, child_fields in relations:
+                    child_key = row[index]
+                    if child_key is None:
+                        continue
+                    child = identity.get((table, child_key))
+                    if child is None:
+                        child = Result()
+                        for i, field in child_fields:
+                            setattr(child, field, row[i])
+                        identity[(table, child_key)] = child
+                    link = (parent_table, key, name, child_key)
+                    if link not in linked:
+                        linked.add(link)
+                        getattr(parent, name).append(child)
+        return results
+
+    def Fetch(self, sqlbuilder, result=False, commit=False, nested=None,
+            mapping=None, scalars=None):
+        """
+        Facade for Db class for executing queries
+        and fetching the results.
+
+        Arguments:
+            sqlbuilder -- SqlBuilder instance
+            result -- is it need to return result
+            commit -- is it need to commit
+            nested -- tuple of parent key column and dict from attribute
+                name to child key column, see _GetNested
+            mapping -- tuple of key and value indexes, see _GetMapping
+            scalars -- index of the column, see _GetScalars
+        Returns:
+            if result is True, returns list of Result objects, dict for
+            mapping or list of values for scalars,
+            WriteFuture if the statement is queued to write queue
+        """
+        sql, data = sqlbuilder.Compile()
+        if sqlbuilder.data is not None:
+            data = sqlbuilder.data
+        if commit and not result and self.write_queue is not None:
+            # Many threads put statements at once, so they are not kept
+            # in the attributes of the instance
+            return self.write_queue.Put(sql, data, sqlbuilder.script,
+                    set(sqlbuilder.tables))
+        self.sql, self.data = sql, data
+        self.script = sqlbuilder.script
+        safe = self.retry is not None and self.retry.IsSafe(self.sql,
+                self.script)
+        return self._Retry(lambda: self._Fetch(sqlbuilder, result, commit,
+            nested, mapping, scalars), safe)
+
+    def _Fetch(self, sqlbuilder, result, commit, nested, mapping, scalars):
+        """
+        Executes compiled query once, see Fetch.
+
+        Arguments:
+            sqlbuilder -- SqlBuilder instance
+            result -- is it need to return result
+            commit -- is it need to commit
+            nested -- see Fetch
+            mapping -- see Fetch
+            scalars -- see Fetch
+        Returns:
+            fetched data or None
+        """
+        timeout = sqlbuilder.timeout
+        if timeout is None:
+            timeout = self.timeout
+        self.row_limit = (sqlbuilder.max_rows
+                if sqlbuilder.max_rows is not None else self.max_rows)
+        self.byte_limit = (sqlbuilder.max_bytes
+                if sqlbuilder.max_bytes is not None else self.max_bytes)
+        self.fetched_bytes = 0
+        reason = []
+        started = time.time()
+        replica = result and not commit and self._IsReplicated(sqlbuilder)
+        # Cancel of the query interrupts only executions running now
+        cancel = threading.Event()
+        sqlbuilder.executions.add(cancel)
+        try:
+            self._OpenConnection(replica)
+            self._SetProgressHandler(cancel, timeout, reason)
+            self._Query()
+            if commit:
+                self._Commit()
+                self._InvalidateReplica(sqlbuilder.tables)
+            if result and nested:
+                rows = self._GetNested(sqlbuilder.select_columns,
+                        sqlbuilder.adapters, *nested)
+            elif result and mapping:
+                rows = self._GetMapping(sqlbuilder.adapters, *mapping)
+            elif result and scalars is not None:
+                rows = self._GetScalars(sqlbuilder.adapters, scalars)
+            elif result:
+                rows = self._GetResults(sqlbuilder.select_columns,
+                        sqlbuilder.adapters)
+            else:
+                rows = None
+            elapsed = time.time() - started
+            if self.query_log is not None:
+                self.query_log.Record(self.sql, elapsed,
+                        max(self.cursor.rowcount, 0) if rows is None
+                        else len(rows), self.fetched_bytes)
+            if self.index_advisor is not None:
+                self.index_advisor.Record(sqlbuilder, self.sql, self.data,
+                        elapsed)
+            return rows
+        except OperationalError:
+            if reason == ['timeout']:
+                raise QueryTimeoutError('Query exceeded {0}s: {1}'.format(
+                    timeout, self.sql))
+            if reason == ['cancelled']:
+                raise QueryCancelledError('Query cancelled: ' + self.sql)
+            raise
+        finally:
+            sqlbuilder.executions.discard(cancel)
+            self._CloseConnection()
+
+    def FetchMany(self, sqlbuilders, snapshot=False, workers=None):
+        """
+        Executes queries on one connection, or on connections of worker
+        threads if workers is set.
+
+        Arguments:
+            sqlbuilders -- list of SqlBuilder instances
+            snapshot -- read all queries in one transaction
+            workers -- number of threads executing the queries
+        Returns:
+            list of lists of Result objects
+        """
+        if workers and len(sqlbuilders) > 1:
+            workers = min(workers, len(sqlbuilders))
+            pool = ThreadPool(workers)
+            try:
+                # Every thread has its own instance, instances keep state
+                # of the executed query
+                chunks = pool.map(lambda i: self._Reader().FetchMany(
+                    sqlbuilders[i::workers]), range(workers))
+            finally:
+                pool.close()
+            results = [None] * len(sqlbuilders)
+            for i, chunk in enumerate(chunks):
+                results[i::workers] = chunk
+            return results
+
+        self._OpenConnection()
+        self.held = True
+        try:
+            if snapshot:
+                self.cursor.execute('BEGIN')
+            return [self.Fetch(sqlbuilder, result=True)
+                    for sqlbuilder in sqlbuilders]
+        finally:
+            self.held = False
+            if snapshot:
+                self.connection.rollback()
+            self._CloseConnection()
+
+    def _Reader(self):
+        """
+        Returns instance for reading from another thread. It shares the
+        query log, the index advisor and the retry policy, but has no
+        replica and no write queue.
+        """
+        return SQLiteDb(dict(self.params, replica=None, write_queue=None))
+
+    def _SetProgressHandler(self, cancel, timeout, reason):
+        """
+        Installs progress handler that interrupts the query when
+        the deadline passes or the query is cancelled from another thread.
+
+        Arguments:
+            cancel -- threading.Event set to cancel this execution
+            timeout -- seconds or None
+            reason -- list that receives 'timeout' or 'cancelled'
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+
+        def handler():
+            """Returns True to interrupt the query."""
+            if cancel.is_set():
+                reason.append('cancelled')
+                return True
+            if deadline is not None and time.time() > deadline:
+                reason.append('timeout')
+                return True
+            return False
+
+        self.connection.set_progress_handler(handler, 1000)
+
+    def _Retry(self, fn, safe=True):
+        """
+        Calls function according to the retry policy of the database.
+
+        Arguments:
+            fn -- function without arguments
+            safe -- function may be called again after the failure
+        Returns:
+            result of the function
+        """
+        if self.retry is None:
+            return fn()
+        return self.retry.Call(fn, safe)
+
+    def ExecuteMany(self, statements, bulk=False):
+        """
+        Executes statements in one transaction.
+
+        Arguments:
+            statements -- iterable of (sql, sequence of parameter tuples)
+            bulk -- tune connection for loading large amount of data
+        Returns:
+            number of affected rows
+        """
+        count = 0
+        try:
+            self._OpenConnection()
+            if bulk:
+                for pragma in self.BULK_PRAGMAS:
+                    self.cursor.execute(pragma)
+            if self.retry is not None:
+                # Statements may be a generator that can not be replayed,
+                # so the write lock is taken before consuming it
+                self._Retry(lambda: self.cursor.execute('BEGIN IMMEDIATE'))
+            for sql, params in statements:
+                logging.info('Sql = {0}, rows={1}'.format(sql, len(params)))
+                self.cursor.executemany(sql, params)
+                count += self.cursor.rowcount
+            # Failed COMMIT keeps the transaction active and may be repeated
+            self._Retry(self._Commit)
+            self._InvalidateReplica()
+        finally:
+            self._CloseConnection()
+        return count
+
+    def Export(self, sqlbuilder, path, format='csv', batch_size=1000):
+        """
+        Writes results of the query to the file. Rows are read from
+        the cursor in batches and written as plain tuples, text is kept
+        as utf-8 bytes so it is not decoded and encoded again. Adapters
+        are applied, so epoch datetimes are written as text the same way
+        as they are fetched.
+
+        Arguments:
+            sqlbuilder -- SqlBuilder instance
+            path -- path of the file
+            format -- 'csv' or 'jsonl'
+            batch_size -- number of rows read from cursor at once
+        Returns:
+            number of written rows
+        """
+        names = [name.split('.')[-1] for name in sqlbuilder.select_columns]
+        if format == 'csv':
+            def write(out, rows):
+                """Writes batch of rows as csv."""
+                writer.writerows(rows)
+        elif format == 'jsonl':
+            template = ''.join(('{',
+                ', '.join(json.dumps(name).replace('%', '%%') + ': %s'
+                    for name in names), '}\n'))
+
+            def write(out, rows):
+                """Writes batch of rows as json lines."""
+                out.write(''.join([template % tuple(map(_JsonValue, row))
+                    for row in rows]))
+        else:
+            raise NotImplementedError('Unsupported format {0}'.format(format))
+
+        self.sql, self.data = sqlbuilder.Compile()
+        if sqlbuilder.data is not None:
+            self.data = sqlbuilder.data
+        self.script = False
+        count = 0
+        started = time.time()
+        try:
+            self._OpenConnection()
+            self.connection.text_factory = str
+            self._Query()
+            with open(path, 'wb', 1 << 16) as out:
+                if format == 'csv':
+                    writer = csv.writer(out)
+                    writer.writerow(names)
+                rows = self.cursor.fetchmany(batch_size)
+                while rows:
+                    if sqlbuilder.adapters:
+                        columns = zip(*rows)
+                        for i, adapter in sqlbuilder.adapters:
+                            columns[i] = map(adapter, columns[i])
+                        rows = zip(*columns)
+                    write(out, rows)
+                    count += len(rows)
+                    rows = self.cursor.fetchmany(batch_size)
+        finally:
+            self._CloseConnection()
+        elapsed = time.time() - started
+        logging.info('Exported {0} rows in {1:.2f}s ({2:.0f} rows/s)'.format(
+            count, elapsed, count / elapsed if elapsed else 0))
+        return count
+
+class MySQLDb(Db):
+    """MySQL implementation."""
+    def __init__(self, host, username, password,
+            db_name='sample'):
+        raise NotImplementedError()
+
+class ShardedDb(Db):
+    """
+    Rows of sharded tables are spread over several SQLite files by hash of
+    the shard key column, every shard is a SQLiteDb. Other tables are
+    reference tables: writes are sent to all shards so that joins stay
+    local, reads go to the first shard.
+
+    Statements restricted to keys by equality or IN in WHERE are sent only
+    to the shards of the keys, other ones are sent to all shards in
+    parallel and the results are merged, ORDER BY and LIMIT are applied
+    again to the merged rows.
+
+    Not supported: ExportTo, FetchSince, precompiled INSERT into sharded
+    tables and ordering fan-out queries by columns that are not selected.
+    Writes of DeleteMany, UpdateMany, ImportFrom and Session are atomic
+    per shard, not across shards.
+    """
+    INSERT = re.compile(r'\s*INSERT\s+INTO\s+(\w+)\s*\(([^)]*)\)',
+            re.IGNORECASE)
+    UPDATE = re.compile(r'\s*UPDATE\s+\w+\s+SET\s+(.*?)\s+WHERE\b',
+            re.IGNORECASE | re.DOTALL)
+    WRITTEN = re.compile(r'\s*(?:UPDATE|DELETE\s+FROM)\s+(\w+)',
+            re.IGNORECASE)
+    def __init__(self, params):
+        """
+        Constructor.
+
+        Arguments:
+            params -- dict with 'names' of shard files, 'keys' list of
+                shard key columns, i.e. [Db.Users.id], optional 'workers'
+                size of the thread pool, other parameters are passed to
+                every SQLiteDb
+        """
+        params = dict(params)
+        names = params.pop('names')
+        self.keys = dict((column.table_name.lower(), column.column_name)
+                for column in params.pop('keys', ()))
+        workers = params.pop('workers', len(names))
+        self.shards = [SQLiteDb(dict(params, name=name)) for name in names]
+        self.max_variables = self.shards[0].max_variables
+        self.pool = ThreadPool(workers)
+
+    def _Close(self):
+        """Stops the thread pool and write queues of the shards."""
+        self.pool.close()
+        self.pool.join()
+        for shard in self.shards:
+            shard._Close()
+
+    def ShardFor(self, value):
+        """
+        Returns shard keeping rows with the key value.
+
+        Arguments:
+            value -- value of the shard key as stored in the database
+        Returns:
+            SQLiteDb instance
+        """
+        if isinstance(value, (int, long)):
+            index = value % len(self.shards)
+        else:
+            if not isinstance(value, unicode):
+                value = unicode(value)
+            index = (zlib.crc32(value.encode('utf-8')) & 0xffffffff) % len(
+                    self.shards)
+        return self.shards[index]
+
+    def _Route(self, sqlbuilder):
+        """
+        Chooses shards for the statement.
+
+        Arguments:
+            sqlbuilder -- SqlBuilder instance
+        Returns:
+            list of SQLiteDb instances
+        Raises:
+            ValueError if the key of the inserted row is missing or
+            the statement updates shard key
+        """
+        first = sqlbuilder.sql[0] if sqlbuilder.sql else ''
+        if isinstance(first, Statement):
+            first = first.sql
+        statement = first.split(' ', 1)[0]
+        write = statement in ('INSERT', 'UPDATE', 'DELETE')
+        refs = set((table, column) for table, column in self.keys.items()
+                if table in sqlbuilder.tables)
+        if not refs:
+            if write or statement != 'SELECT':
+                return self.shards
+            return self.shards[:1]
+        if statement == 'INSERT':
+            if isinstance(sqlbuilder.sql[0], Statement):
+                raise ValueError('Precompiled INSERT into sharded table can '
+                        'not be routed, build it with SqlBuilder')
+            return [self.ShardFor(self._InsertedKey(sqlbuilder, refs))]
+
+        keys = None
+        where = False
+        for fragment in sqlbuilder.sql:
+            if isinstance(fragment, Assignments):
+                for item in fragment.items:
+                    if (item.left.table.lower(), item.left.column) in refs:
+                        raise ValueError('Shard key can not be updated')
+            elif isinstance(fragment, Expression):
+                values = _KeyValues(fragment, refs) if where else None
+                if values is not None:
+                    keys = values if keys is None else keys & values
+            elif ' OR ' in fragment:
+                return self.shards
+            elif ' WHERE ' in fragment:
+                where = True
+        if keys is None:
+            return self.shards
+        shards = []
+        for key in keys:
+            shard = self.ShardFor(key)
+            if shard not in shards:
+                shards.append(shard)
+        return shards or self.shards[:1]
+
+    def _InsertedKey(self, sqlbuilder, refs):
+        """
+        Returns value of the shard key of the inserted row.
+
+        Arguments:
+            sqlbuilder -- SqlBuilder with INSERT statement
+            refs -- set of (table, key column) pairs
+        Raises:
+            ValueError if the key is not inserted
+        """
+        values = [fragment for fragment in sqlbuilder.sql
+                if isinstance(fragment, ValueList)]
+        for i, column in enumerate(sqlbuilder.insert_columns):
+            if ((column.table_name.lower(), column.column_name) in refs
+                    and values and i < len(values[0].values)):
+                return values[0].values[i]
+        raise ValueError('Value of the shard key is not inserted')
+
+    def Fetch(self, sqlbuilder, result=False, commit=False, nested=None,
+            mapping=None, scalars=None):
+        """
+        Executes the statement on the chosen shards and merges results.
+
+        Arguments:
+            sqlbuilder -- SqlBuilder instance
+            result -- is it need to return result
+            commit -- is it need to commit
+            nested -- see SQLiteDb.Fetch
+            mapping -- see SQLiteDb.Fetch
+            scalars -- see SQLiteDb.Fetch
+        Returns:
+            merged results, list of WriteFuture objects if shards have
+            write queue
+        Raises:
+            ValueError if rows of several shards are ordered by columns
+            that are not selected
+        """
+        shards = self._Route(sqlbuilder)
+        sqlbuilder.Compile()
+        ordered = result and len(shards) > 1 and (
+                sqlbuilder.order is not None or sqlbuilder.limit is not None)
+        if ordered and sqlbuilder.order is not None:
+            names = [name.split('.')[-1]
+                    for name in sqlbuilder.select_columns]
+            missing = [name for name in sqlbuilder.order[0]
+                    if name not in names]
+            if missing:
+                raise ValueError('Rows of shards can not be merged by '
+                        'columns that are not selected: {0}'.format(
+                            ', '.join(missing)))
+        if ordered:
+            # Order is restored from Result objects, they are reshaped below
+            call = lambda shard: shard.Fetch(sqlbuilder, result, commit,
+                    nested)
+        else:
+            call = lambda shard: shard.Fetch(sqlbuilder, result, commit,
+                    nested, mapping, scalars)
+        if len(shards) == 1:
+            return call(shards[0])
+        results = self.pool.map(call, shards)
+
+        if not result:
+            futures = [future for future in results if future is not None]
+            return futures or None
+        if sqlbuilder.combine is not None:
+            return [sqlbuilder.combine(values[0] for values in results)]
+        if ordered:
+            return self._Reshape(sqlbuilder, self._Merge(sqlbuilder, results),
+                    mapping, scalars)
+        if mapping:
+            merged = {}
+            for values in results:
+                merged.update(values)
+            return merged
+        return list(chain.from_iterable(results))
+
+    def _Merge(self, sqlbuilder, results):
+        """
+        Merges Result objects of the shards applying ORDER BY and LIMIT.
+
+        Arguments:
+            sqlbuilder -- SqlBuilder instance
+            results -- list of lists of Result objects
+        Returns:
+            list of Result objects
+        """
+        rows = list(chain.from_iterable(results))
+        if sqlbuilder.order is not None:
+            names, descending = sqlbuilder.order
+            rows.sort(key=lambda row: tuple(getattr(row, name)
+                for name in names), reverse=descending)
+        if sqlbuilder.limit is not None:
+            rows = rows[:sqlbuilder.limit]
+        return rows
+
+    def _Reshape(self, sqlbuilder, rows, mapping, scalars):
+        """
+        Converts Result objects to dict or list of values.
 
         Arguments:
             sqlbuilder -- SqlBuilder instance
-            result -- is it need to return result
-            commit -- is it need to commit
+            rows -- list of Result objects
+            mapping -- see SQLiteDb.Fetch
+            scalars -- see SQLiteDb.Fetch
         Returns:
-            if result is True, returns list of Result objects
+            converted rows
         """
-        self.sql = ''.join(sqlbuilder.sql)
-        self.data = sqlbuilder.sdata.data
-        try:
-            self._OpenConnection()
-            self._Query()
-            if commit:
-                self._Commit()
-            if result:
-                return self._GetResults(sqlbuilder.select_columns)
-        finally:
-            self._CloseConnection()
+        names = [name.split('.')[-1] for name in sqlbuilder.select_columns]
+        if mapping:
+            key, value = names[mapping[0]], names[mapping[1]]
+            return dict((getattr(row, key), getattr(row, value))
+                    for row in rows)
+        if scalars is not None:
+            name = names[scalars]
+            return [getattr(row, name) for row in rows]
+        return rows
+
+    def FetchMany(self, sqlbuilders, snapshot=False, workers=None):
+        """
+        Executes queries one by one, every query is already executed on
+        its shards in parallel. Snapshot is not supported across shards.
+        """
+        if snapshot:
+            raise NotImplementedError('Snapshot can not span shards')
+        return [self.Fetch(sqlbuilder, result=True)
+                for sqlbuilder in sqlbuilders]
 
-class MySQLDb(Db):
-    """MySQL implementation."""
-    def __init__(self, host, username, password,
-            db_name='sample'):
-        raise NotImplementedError()
+    def ExplainPlan(self, sql, data):
+        """Returns plan of the query on the first shard."""
+        return self.shards[0].ExplainPlan(sql, data)
+
+    def _ReadSchema(self):
+        """Reads schema of the first shard."""
+        return self.shards[0]._ReadSchema()
+
+    def ExecuteMany(self, statements, bulk=False):
+        """
+        Routes statements of DeleteMany, UpdateMany, ImportFrom, Session
+        and MigrateToEpoch to shards and executes them in one transaction
+        per shard. Rows of INSERT into sharded tables are grouped by shard
+        of their key, other statements are sent to all shards: rows of
+        a key live in one shard only. Statements are collected in memory
+        before they are executed.
+
+        Arguments:
+            statements -- iterable of (sql, sequence of parameter tuples)
+            bulk -- tune connection for loading large amount of data
+        Returns:
+            number of affected rows, rows of reference tables are counted
+            once
+        Raises:
+            ValueError if the statement updates shard key or inserts
+            rows without it
+        """
+        routed = dict((shard, []) for shard in self.shards)
+        sharded = False
+        for sql, rows in statements:
+            match = self.INSERT.match(sql)
+            table = match.group(1) if match else self._Table(sql)
+            key = self.keys.get(table.lower()) if table else None
+            if key is None:
+                for shard in self.shards:
+                    routed[shard].append((sql, rows))
+                continue
+            sharded = True
+            if match is None:
+                update = self.UPDATE.match(sql)
+                if update and re.search(r'\b{0}\s*='.format(key),
+                        update.group(1)):
+                    raise ValueError('Shard key can not be updated')
+                for shard in self.shards:
+                    routed[shard].append((sql, rows))
+                continue
+            columns = [column.strip() for column in match.group(2).split(',')]
+            if key not in columns:
+                raise ValueError('Value of the shard key is not inserted')
+            index = columns.index(key)
+            groups = {}
+            for row in rows:
+                groups.setdefault(self.ShardFor(row[index]), []).append(row)
+            for shard, shard_rows in groups.items():
+                routed[shard].append((sql, shard_rows))
+        counts = self.pool.map(lambda shard: shard.ExecuteMany(
+            routed[shard], bulk), self.shards)
+        return sum(counts) if sharded else counts[0]
+
+    def _Table(self, sql):
+        """
+        Returns name of the table written by UPDATE or DELETE statement.
+
+        Arguments:
+            sql -- sql text
+        Returns:
+            name of the table or None
+        """
+        match = self.WRITTEN.match(sql)
+        return match.group(1) if match else None
+
+    def Export(self, sqlbuilder, path, format='csv', batch_size=1000):
+        """Export streams one cursor, it is not supported on shards."""
+        raise NotImplementedError('ExportTo is not supported on ShardedDb, '
+                'use FetchFrom')
+
+def _KeyValues(node, refs):
+    """
+    Returns values of the shard key the condition restricts rows to.
+
+    Arguments:
+        node -- Expression node
+        refs -- set of (table, key column) pairs
+    Returns:
+        set of values or None if rows are not restricted
+    """
+    if isinstance(node, Comparison) and node.op == ' = ':
+        for side, other in ((node.left, node.right), (node.right, node.left)):
+            if (isinstance(side, ColumnRef) and isinstance(other, Param) and
+                    (side.table.lower(), side.column) in refs):
+                return set([other.value])
+    elif (isinstance(node, InList) and not node.negate and
+            isinstance(node.left, ColumnRef) and
+            (node.left.table.lower(), node.left.column) in refs):
+        return set(node.values)
+    elif isinstance(node, BooleanExpression):
+        values = [_KeyValues(item, refs) for item in node.items]
+        if node.op == ' AND ':
+            values = [value for value in values if value is not None]
+            return set.intersection(*values) if values else None
+        if None not in values:
+            return set.union(*values)
+    return None
+
+class Session(object):
+    """
+    Unit of work. Records changes of the rows and writes all of them on
+    Flush in one transaction, grouped into executemany statements.
+
+    Repeated updates of the same row are merged, pending updates and
+    inserts of the deleted row are dropped. Changes are applied in order:
+    deletes, inserts, updates.
+    """
+    def __init__(self, db):
+        """
+        Constructor.
+
+        Arguments:
+            db -- Db instance
+        """
+        self.db = db
+        self.Clear()
+
+    def __enter__(self):
+        """Returns session."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Flushes changes if block exited without exception."""
+        if exc_type is None:
+            self.Flush()
+
+    def Clear(self):
+        """Forgets all pending changes."""
+        self.inserts = OrderedDict()
+        self.updates = OrderedDict()
+        self.deletes = OrderedDict()
+
+    def _Names(self, row):
+        """
+        Returns copy of the row keyed by column names.
+
+        Arguments:
+            row -- dict from Column (or column name) to value
+        """
+        return dict((column.column_name if isinstance(column, Column)
+            else column, value) for column, value in row.items())
+
+    def Insert(self, table, row):
+        """
+        Records new row.
+
+        Arguments:
+            table -- subclass of Table
+            row -- dict from Column (or column name) to value
+        """
+        self.inserts.setdefault(table, []).append(self._Names(row))
+
+    def Update(self, table, key_column, row):
+        """
+        Records new values of the row.
+
+        Arguments:
+            table -- subclass of Table
+            key_column -- column of the table identifying the row
+            row -- dict from Column (or column name) to value, contains
+                the key column
+        """
+        row = self._Names(row)
+        name = key_column.column_name
+        pending = self.updates.setdefault((table, name, row[name]),
+                (key_column, {}))
+        pending[1].update(row)
+
+    def Delete(self, table, key_column, key):
+        """
+        Records deletion of the row.
+
+        Arguments:
+            table -- subclass of Table
+            key_column -- column of the table identifying the row
+            key -- value of the key column
+        """
+        name = key_column.column_name
+        self.updates.pop((table, name, key), None)
+        if table in self.inserts:
+            self.inserts[table] = [row for row in self.inserts[table]
+                    if row.get(name) != key]
+        pending = self.deletes.setdefault((table, name),
+                (key_column, OrderedDict()))
+        pending[1][key] = None
+
+    def Flush(self):
+        """
+        Writes pending changes in one transaction. Changes are kept if
+        writing fails.
+
+        Returns:
+            number of affected rows
+        """
+        if not (self.inserts or self.updates or self.deletes):
+            return 0
+        statements = []
+        for (table, _), (key_column, keys) in self.deletes.items():
+            statements.append(self.db._DeleteStatements(table, key_column,
+                keys))
+        for table, rows in self.inserts.items():
+            statements.append(self.db._InsertStatements(table, rows))
+        updates = OrderedDict()
+        for (table, name, _), (key_column, row) in self.updates.items():
+            updates.setdefault((table, name), (key_column, []))[1].append(row)
+        for (table, _), (key_column, rows) in updates.items():
+            statements.append(self.db._UpdateStatements(table, key_column,
+                rows))
+
+        count = self.db.db.ExecuteMany(chain.from_iterable(statements))
+        self.Clear()
+        return count
 
 class SqlBuilder(object):
     """Class for building sql queries."""
     def __init__(self):
         self.sql = []
-        self.sdata = SingletoneData()
+        # Order of calls is checked per query, queries are built
+        # in many threads
+        self.last_method = ''
         self.constructed_sql = ''
+        self.compiled = None
+        self.data = None
+        self.adapters = []
+        self.insert_columns = ()
+        self.timeout = None
+        self.max_rows = None
+        self.max_bytes = None
+        # Cancel events of executions running in other threads
+        self.executions = set()
+        self.script = False
+        self.prefix = []
+        self.with_pending = False
+        self.suffix = []
+        self.order = None
+        self.limit = None
+        self.combine = None
+        self.tables = set()
 
     def check_order(fn):
         """
@@ -727,58 +3309,197 @@ class SqlBuilder(object):
 
             sqlbuilder = args[0]
             def clear_data():
+                # Common table expressions are kept for the statement
+                # that follows With
+                if not sqlbuilder.with_pending:
+                    sqlbuilder.prefix = []
+                sqlbuilder.with_pending = False
                 sqlbuilder.sql[:] = []
-                sqlbuilder.sdata.data[:] = []
-
-            if fn.__name__ == 'Select':
+                sqlbuilder.compiled = None
+                sqlbuilder.data = None
+                sqlbuilder.insert_columns = ()
+                sqlbuilder.script = False
+                sqlbuilder.suffix = []
+                sqlbuilder.order = None
+                sqlbuilder.limit = None
+                sqlbuilder.tables = set(chain.from_iterable(
+                    fragment.Tables() for fragment in sqlbuilder.prefix
+                    if isinstance(fragment, Expression)))
+
+            if fn.__name__ == 'With':
                 clear_data()
-                sqlbuilder.sdata.last_method = 'Select'
+                sqlbuilder.with_pending = True
+                sqlbuilder.last_method = 'With'
+            elif fn.__name__ == 'Select':
+                clear_data()
+                sqlbuilder.last_method = 'Select'
             elif fn.__name__ == 'Delete':
                 clear_data()
-                sqlbuilder.sdata.last_method = 'Delete'
+                sqlbuilder.last_method = 'Delete'
             elif fn.__name__ == 'Update':
                 clear_data()
-                sqlbuilder.sdata.last_method = 'Update'
+                sqlbuilder.last_method = 'Update'
             elif fn.__name__ == 'Insert':
                 clear_data()
-                sqlbuilder.sdata.last_method = 'Insert'
+                sqlbuilder.last_method = 'Insert'
             elif fn.__name__ == 'CreateTable':
                 clear_data()
-                sqlbuilder.sdata.last_method = 'CreateTable'
+                sqlbuilder.last_method = 'CreateTable'
             elif fn.__name__ == 'DropTable':
                 clear_data()
-                sqlbuilder.sdata.last_method = 'DropTable'
+                sqlbuilder.last_method = 'DropTable'
             elif fn.__name__ == 'From':
-                if sqlbuilder.sdata.last_method not in ['Select', 'Delete']:
+                if sqlbuilder.last_method not in ['Select', 'Delete']:
                     raise InvalidOrderError('Wrong order')
-                sqlbuilder.sdata.last_method = 'From'
+                sqlbuilder.last_method = 'From'
             elif fn.__name__ == 'Where':
-                if sqlbuilder.sdata.last_method not in ['From', 'Set',
+                if sqlbuilder.last_method not in ['From', 'Set',
                         'Update']:
                     raise InvalidOrderError('Wrong order')
-                sqlbuilder.sdata.last_method = 'Where'
+                sqlbuilder.last_method = 'Where'
             elif fn.__name__ == 'And':
-                if sqlbuilder.sdata.last_method not in ['Where', 'Or',
+                if sqlbuilder.last_method not in ['Where', 'Or',
                         'And']:
                     raise InvalidOrderError('Wrong order')
-                sqlbuilder.sdata.last_method = 'And'
+                sqlbuilder.last_method = 'And'
             elif fn.__name__ == 'Or':
-                if sqlbuilder.sdata.last_method not in ['Where', 'And',
+                if sqlbuilder.last_method not in ['Where', 'And',
                         'Or']:
                     raise InvalidOrderError('Wrong order')
-                sqlbuilder.sdata.last_method = 'Or'
+                sqlbuilder.last_method = 'Or'
             elif fn.__name__  in ['InnerJoin', 'LeftJoin', 'RightJoin',
                     'OuterJoin']:
-                if sqlbuilder.sdata.last_method != 'From':
+                if sqlbuilder.last_method != 'From':
                     raise InvalidOrderError('Wrong order')
-                sqlbuilder.sdata.last_method = 'Join'
+                sqlbuilder.last_method = 'Join'
             elif fn.__name__ == 'On':
-                if sqlbuilder.sdata.last_method != 'Join':
+                if sqlbuilder.last_method != 'Join':
+                    raise InvalidOrderError('Wrong order')
+                sqlbuilder.last_method = 'On'
+            elif fn.__name__ == 'Match':
+                if sqlbuilder.last_method not in ['From', 'On']:
                     raise InvalidOrderError('Wrong order')
-                sqlbuilder.sdata.last_method = 'On'
+                sqlbuilder.last_method = 'Where'
+            elif fn.__name__ == 'OrderBy':
+                if sqlbuilder.last_method not in ['From', 'Where',
+                        'And', 'Or', 'On']:
+                    raise InvalidOrderError('Wrong order')
+                sqlbuilder.last_method = 'OrderBy'
+            elif fn.__name__ == 'Limit':
+                if sqlbuilder.last_method not in ['From', 'Where',
+                        'And', 'Or', 'On', 'OrderBy']:
+                    raise InvalidOrderError('Wrong order')
+                sqlbuilder.last_method = 'Limit'
             return fn(*args, **kwargs)
         return nested
 
+    def _Append(self, fragment):
+        """
+        Appends fragment of the query and drops compiled sql.
+
+        Arguments:
+            fragment -- text or Expression node
+        """
+        self.sql.append(fragment)
+        self.compiled = None
+
+    def _Extend(self, prefix, args):
+        """
+        Appends keyword followed by conditions.
+
+        Arguments:
+            prefix -- sql keyword
+            args -- conditions
+        """
+        self._Append(prefix)
+        for arg in args:
+            if isinstance(arg, Expression):
+                self.tables.update(arg.Tables())
+            self._Append(arg)
+
+    def Compile(self):
+        """
+        Compiles the query. Expression nodes are rendered only once until
+        the query is changed.
+
+        Returns:
+            tuple of sql text and tuple of parameters
+        """
+        if self.compiled is None:
+            self.compiled = _CompileFragments(self.prefix + self.sql +
+                    self._Tail())
+        return self.compiled
+
+    def CompileParts(self):
+        """
+        Compiles the query without LIMIT, which is kept as a number,
+        and keeps ORDER BY apart from the statement.
+
+        Returns:
+            tuple of sql text of the statement, sql text of ORDER BY and
+            tuple of parameters of both
+        """
+        sql, params = _CompileFragments(self.prefix + self.sql)
+        suffix, suffix_params = _CompileFragments(self.suffix)
+        return sql, suffix, params + suffix_params
+
+    def _Tail(self):
+        """Returns ORDER BY and LIMIT fragments of the query."""
+        if self.limit is None:
+            return self.suffix
+        return self.suffix + [' LIMIT ', Param(self.limit)]
+
+    def Predicates(self):
+        """
+        Returns conditions of WHERE and ON parts of the query.
+
+        Returns:
+            list of (operator, ColumnRef, is join) tuples, operator is
+            'IN' for IN lists
+        """
+        predicates = []
+        nodes = [fragment for fragment in self.sql
+                if isinstance(fragment, Expression)]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, BooleanExpression):
+                nodes.extend(node.items)
+            elif isinstance(node, (InList, InQuery)) and not node.negate:
+                predicates.append(('IN', node.left, False))
+            elif isinstance(node, Comparison):
+                join = isinstance(node.right, ColumnRef)
+                for side in (node.left, node.right):
+                    if isinstance(side, ColumnRef):
+                        predicates.append((node.op, side, join))
+        return predicates
+
+    def key(self):
+        """Returns hashable structural representation of the query."""
+        return tuple(fragment.key() if isinstance(fragment, Expression)
+                else fragment for fragment in self.prefix + self.sql)
+
+    @check_order
+    def With(self, table, query):
+        """
+        Generates common table expression WITH name AS (SELECT ...) for
+        the following statement. The table is a Table subclass describing
+        columns of the query, it is used in From and column expressions like
+        an ordinary table. Several calls add several expressions.
+
+        Arguments:
+            table -- subclass of Table naming the expression
+            query -- SqlBuilder instance
+        Returns:
+            self
+        """
+        if self.prefix:
+            self.prefix[-1] = ', '
+        else:
+            self.prefix.append('WITH ')
+        self.prefix += [table.get_name() + ' AS ', Subquery(query), ' ']
+        self.compiled = None
+        return self
+
     @check_order
     def Select(self, *args):
         """
@@ -799,7 +3520,9 @@ class SqlBuilder(object):
         self.select_columns = [''.join((arg.table_name, '.', arg.column_name))
                 for arg in args]
         sql += ', '.join(self.select_columns)
-        self.sql.append(sql)
+        self.adapters = [(i, arg.adapter()) for i, arg in enumerate(args)
+                if arg.adapter()]
+        self._Append(sql)
         return self
 
     @check_order
@@ -813,7 +3536,8 @@ class SqlBuilder(object):
             self
         """
         sql = 'UPDATE {0} SET '.format(table.get_name())
-        self.sql.append(sql)
+        self.tables.add(table.get_name())
+        self._Append(sql)
         return self
 
     @check_order
@@ -827,7 +3551,8 @@ class SqlBuilder(object):
             self
         """
         sql = 'INSERT INTO {0} '.format(table.get_name())
-        self.sql.append(sql)
+        self.tables.add(table.get_name())
+        self._Append(sql)
         return self
 
     @check_order
@@ -838,7 +3563,7 @@ class SqlBuilder(object):
         Returns:
             self
         """
-        self.sql.append('DELETE ')
+        self._Append('DELETE ')
         return self
 
     @check_order
@@ -853,7 +3578,8 @@ class SqlBuilder(object):
         """
         sql = ' FROM '
         tables = [arg.get_name() for arg in args]
-        self.sql.append(sql + ', '.join(tables))
+        self.tables.update(tables)
+        self._Append(sql + ', '.join(tables))
         return self
 
     @check_order
@@ -866,8 +3592,7 @@ class SqlBuilder(object):
         Returns:
             self
         """
-        sql = ''.join(args)
-        self.sql.append(' WHERE ' + sql)
+        self._Extend(' WHERE ', args)
         return self
 
     @check_order
@@ -880,7 +3605,8 @@ class SqlBuilder(object):
         Returns:
             self
         """
-        self.sql.append(' INNER JOIN ' + table.get_name())
+        self._Append(' INNER JOIN ' + table.get_name())
+        self.tables.add(table.get_name())
         return self
 
     @check_order
@@ -893,7 +3619,8 @@ class SqlBuilder(object):
         Returns:
             self
         """
-        self.sql.append(' OUTER JOIN ' + table.get_name())
+        self._Append(' OUTER JOIN ' + table.get_name())
+        self.tables.add(table.get_name())
         return self
 
     @check_order
@@ -906,7 +3633,8 @@ class SqlBuilder(object):
         Returns:
             self
         """
-        self.sql.append(' LEFT JOIN ' + table.get_name())
+        self._Append(' LEFT JOIN ' + table.get_name())
+        self.tables.add(table.get_name())
         return self
 
     @check_order
@@ -919,7 +3647,8 @@ class SqlBuilder(object):
         Returns:
             self
         """
-        self.sql.append(' RIGHT JOIN ' + table.get_name())
+        self._Append(' RIGHT JOIN ' + table.get_name())
+        self.tables.add(table.get_name())
         return self
 
     @check_order
@@ -932,8 +3661,7 @@ class SqlBuilder(object):
         Returns:
             self
         """
-        sql = ''.join(args)
-        self.sql.append(' ON ' + sql)
+        self._Extend(' ON ', args)
         return self
 
     @check_order
@@ -946,8 +3674,7 @@ class SqlBuilder(object):
         Returns:
             self
         """
-        sql = ''.join(args)
-        self.sql.append(' AND ' + sql)
+        self._Extend(' AND ', args)
         return self
 
     @check_order
@@ -960,8 +3687,7 @@ class SqlBuilder(object):
         Returns:
             self
         """
-        sql = ''.join(args)
-        self.sql.append(' OR ' + sql)
+        self._Extend(' OR ', args)
         return self
 
     @check_order
@@ -977,7 +3703,8 @@ class SqlBuilder(object):
         """
         sql = ', '.join([i.column_name for i in args])
         sql = ''.join((' (', sql, ') '))
-        self.sql.append(sql)
+        self.insert_columns = args
+        self._Append(sql)
         return self
 
     @check_order
@@ -989,15 +3716,16 @@ class SqlBuilder(object):
             args -- values
         Returns:
             self
+        Raises:
+            ValueError if number of values differs from number of columns
         """
-        args = list(args)
-        for i in range(len(args)):
-            if isinstance(args[i], basestring):
-                args[i] = "'{0}'".format(args[i])
-
-        sql = ', '.join([str(i) for i in args])
-        sql = 'VALUES (' + sql + ')'
-        self.sql.append(sql)
+        if self.insert_columns:
+            if len(self.insert_columns) != len(args):
+                raise ValueError('{0} values for {1} columns'.format(
+                    len(args), len(self.insert_columns)))
+            args = [column._Value(value)
+                    for column, value in zip(self.insert_columns, args)]
+        self._Append(ValueList(args))
         return self
 
     @check_order
@@ -1010,8 +3738,7 @@ class SqlBuilder(object):
         Returns:
             self
         """
-        sql = ', '.join(args)
-        self.sql.append(sql)
+        self._Append(Assignments(args))
         return self
 
     def LeftBracket(self, *args):
@@ -1021,9 +3748,7 @@ class SqlBuilder(object):
         Returns:
             self
         """
-        sql = ''.join(args)
-        self.sql.append(' (')
-        self.sql.append(sql)
+        self._Extend(' (', args)
         return self
 
     def RightBracket(self):
@@ -1033,7 +3758,7 @@ class SqlBuilder(object):
         Returns:
             self
         """
-        self.sql.append(') ')
+        self._Append(') ')
         return self
 
     @check_order
@@ -1045,12 +3770,201 @@ class SqlBuilder(object):
             table -- subclass of Table
         Returns:
             self
+        Raises:
+            InvalidTypeError if the summary table is not valid
         """
+        if issubclass(table, SummaryTable):
+            self._CheckSummary(table)
         sql = ''.join(('CREATE TABLE ', table.get_name(), ' ('))
+        self.tables.add(table.get_name())
         columns = [column.create() for column in table.all]
         sql += ', '.join(columns)
         sql += ')'
-        self.sql.append(sql)
+        self._Append(sql)
+        if table.fulltext:
+            self._CreateFullText(table)
+        if issubclass(table, SummaryTable):
+            self._CreateSummary(table)
+        return self
+
+    def _CheckSummary(self, table):
+        """
+        Checks definition of the summary table before anything is
+        generated, script with triggers is not run in one transaction.
+
+        Arguments:
+            table -- subclass of SummaryTable
+        Raises:
+            InvalidTypeError if the source is not a table, there is no
+            CountColumn or columns are not columns of the source
+        """
+        source = table.source
+        if not isinstance(source, MetaTable):
+            raise InvalidTypeError('Source of {0} is not a table'.format(
+                table.__name__))
+        aggregates = table.get_aggregates()
+        if not any(isinstance(column, CountColumn) for column in aggregates):
+            raise InvalidTypeError('{0} has no CountColumn'.format(
+                table.__name__))
+        names = set(column.column_name for column in source.all)
+        columns = table.get_groups() + [column.source_column
+                for column in aggregates if isinstance(column, SumColumn)]
+        for name in columns:
+            if name not in names:
+                raise InvalidTypeError('{0} has no column {1}'.format(
+                    source.__name__, name))
+
+    def _CreateSummary(self, table):
+        """
+        Generates triggers applying changes of the source table to
+        the summary table and fills it with current aggregates.
+
+        Arguments:
+            table -- subclass of SummaryTable checked by _CheckSummary
+        """
+        aggregates = table.get_aggregates()
+        counts = [column.column_name for column in aggregates
+                if isinstance(column, CountColumn)]
+        name = table.get_name()
+        source = table.source.get_name()
+        groups = table.get_groups()
+        names = ', '.join(groups + [column.column_name
+            for column in aggregates])
+
+        def match(row):
+            """Returns condition selecting the group of the row."""
+            return ' AND '.join('{0} IS {1}.{0}'.format(group, row)
+                    for group in groups) or '1'
+
+        def change(row, sign):
+            """Returns assignments applying the row to aggregates."""
+            return ', '.join('{0} = {0} {1} {2}'.format(column.column_name,
+                sign, column.Delta(row)) for column in aggregates)
+
+        insert = ('INSERT INTO {0} ({1}) SELECT {2} WHERE NOT EXISTS '
+                '(SELECT 1 FROM {0} WHERE {3}); '
+                'UPDATE {0} SET {4} WHERE {3};').format(name, names,
+                        ', '.join(['new.' + group for group in groups] +
+                            ['0'] * len(aggregates)),
+                        match('new'), change('new', '+'))
+        delete = ('UPDATE {0} SET {1} WHERE {2}; '
+                'DELETE FROM {0} WHERE {2} AND {3} = 0;').format(name,
+                        change('old', '-'), match('old'), counts[0])
+        watched = groups + sorted(set(column.source_column
+            for column in aggregates if isinstance(column, SumColumn)))
+
+        sql = [';\n']
+        if groups:
+            sql.append('CREATE INDEX {0}_groups ON {0} ({1});\n'.format(name,
+                ', '.join(groups)))
+        sql += ['CREATE TRIGGER {0}_ai AFTER INSERT ON {1} BEGIN {2} END;\n'
+                .format(name, source, insert),
+                'CREATE TRIGGER {0}_ad AFTER DELETE ON {1} BEGIN {2} END;\n'
+                .format(name, source, delete)]
+        if watched:
+            # Updates can not move rows between groups of plain counts
+            sql.append('CREATE TRIGGER {0}_au AFTER UPDATE OF {1} ON {2} '
+                    'BEGIN {3} {4} END;\n'.format(name, ', '.join(watched),
+                        source, delete, insert))
+        sql += ['INSERT INTO {0} ({1}) SELECT {2} FROM {3}{4} '
+                'HAVING COUNT(*) > 0'.format(name, names,
+                    ', '.join(groups + [column.Initial()
+                        for column in aggregates]), source,
+                    ' GROUP BY ' + ', '.join(groups) if groups else '')]
+        self._Append(''.join(sql))
+        self.tables.add(source)
+        self.script = True
+
+    def _CreateFullText(self, table):
+        """
+        Generates FTS5 index with external content and triggers keeping
+        it in sync with the table. Index refers to rows by rowid.
+
+        Arguments:
+            table -- subclass of Table
+        """
+        name = table.get_name()
+        fts = table.get_fulltext_name()
+        columns = [column.column_name for column in table.fulltext]
+        names = ', '.join(columns)
+        new = ', '.join(['new.rowid'] + ['new.' + c for c in columns])
+        old = ', '.join(["'delete'", 'old.rowid'] +
+                ['old.' + c for c in columns])
+        insert = 'INSERT INTO {0} (rowid, {1}) VALUES ({2});'.format(fts,
+                names, new)
+        delete = 'INSERT INTO {0} ({0}, rowid, {1}) VALUES ({2});'.format(
+                fts, names, old)
+        self._Append(''.join((';\n',
+            "CREATE VIRTUAL TABLE {0} USING fts5({1}, content='{2}', "
+            "content_rowid='rowid');\n".format(fts, names, name),
+            'CREATE TRIGGER {0}_ai AFTER INSERT ON {1} BEGIN {2} END;\n'
+            .format(fts, name, insert),
+            'CREATE TRIGGER {0}_ad AFTER DELETE ON {1} BEGIN {2} END;\n'
+            .format(fts, name, delete),
+            'CREATE TRIGGER {0}_au AFTER UPDATE ON {1} BEGIN {2} {3} END;'
+            .format(fts, name, delete, insert))))
+        self.script = True
+
+    @check_order
+    def Match(self, column, text):
+        """
+        Generates full-text search condition. Rows are ordered by
+        relevance, further conditions can be added with And and Or.
+
+        Arguments:
+            column -- FullTextColumn, or Table to search in all its
+                full-text columns
+            text -- FTS5 query
+        Returns:
+            self
+        """
+        if isinstance(column, Column):
+            table = column.table_name
+            fts = table.lower() + '_fts'
+            target = '.'.join((fts, column.column_name))
+        else:
+            table = column.get_name()
+            fts = target = column.get_fulltext_name()
+        self._Append(' INNER JOIN {0} ON {0}.rowid = {1}.rowid WHERE {2} '
+                'MATCH '.format(fts, table, target))
+        self._Append(Param(text))
+        self.suffix = [' ORDER BY {0}.rank'.format(fts)]
+        self.tables.add(fts)
+        self.compiled = None
+        return self
+
+    @check_order
+    def OrderBy(self, *args, **kwargs):
+        """
+        Generates ORDER BY expression, replaces ordering by relevance
+        of Match.
+
+        Arguments:
+            args -- columns to order by, they should be selected
+            descending -- keyword argument, order all columns descending
+        Returns:
+            self
+        """
+        descending = kwargs.get('descending', False)
+        direction = ' DESC' if descending else ''
+        self.suffix = [' ORDER BY ' + ', '.join(''.join((arg.table_name,
+            '.', arg.column_name, direction)) for arg in args)]
+        self.order = ([arg.column_name for arg in args], descending)
+        self.compiled = None
+        return self
+
+    @check_order
+    def Limit(self, count):
+        """
+        Generates LIMIT expression.
+
+        Arguments:
+            count -- max number of rows
+        Returns:
+            self
+        """
+        self.limit = count
+        self.compiled = None
         return self
 
     @check_order
@@ -1063,17 +3977,64 @@ class SqlBuilder(object):
         Returns:
             self
         """
-        self.sql.append('DROP TABLE IF EXISTS ' + table.get_name())
+        if table.fulltext:
+            self._Append('DROP TABLE IF EXISTS {0};\n'.format(
+                table.get_fulltext_name()))
+            self.script = True
+        if issubclass(table, SummaryTable):
+            self._Append(''.join('DROP TRIGGER IF EXISTS {0}_{1};\n'.format(
+                table.get_name(), suffix) for suffix in ('ai', 'ad', 'au')))
+            self.script = True
+        self._Append('DROP TABLE IF EXISTS ' + table.get_name())
+        self.tables.add(table.get_name())
+        return self
+
+    def Timeout(self, seconds):
+        """
+        Sets deadline for the query, overrides timeout of the db.
+
+        Arguments:
+            seconds -- number of seconds or None
+        Returns:
+            self
+        """
+        self.timeout = seconds
+        return self
+
+    def Guard(self, max_rows=None, max_bytes=None):
+        """
+        Sets limits of fetched rows and approximate bytes of fetched
+        values, override limits of the db. Fetching raises
+        ResultTooLargeError as soon as a limit is exceeded.
+
+        Arguments:
+            max_rows -- max number of rows or None
+            max_bytes -- max number of bytes or None
+        Returns:
+            self
+        """
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
         return self
 
+    def Cancel(self):
+        """
+        Interrupts executions of the query running in other threads,
+        executions started later are not affected.
+        """
+        for cancel in list(self.executions):
+            cancel.set()
+
     def Execute(self, db):
         """
         Executes expression without fetching the results.
 
         Arguments:
             db -- db
+        Returns:
+            WriteFuture if db has write queue
         """
-        db.db.Fetch(self, commit=True)
+        return db.db.Fetch(self, commit=True)
 
     def FetchFrom(self, db):
         """
@@ -1086,6 +4047,163 @@ class SqlBuilder(object):
         """
         return db.db.Fetch(self, result=True)
 
+    def FetchNested(self, db, parent_key, **children):
+        """
+        Executes joined expression and groups rows of the child tables
+        under the rows of the parent table, i.e.
+        FetchNested(db, db.Users.id, managers=db.Managers.id).
+
+        Arguments:
+            db -- db to fetch from
+            parent_key -- key column of the parent table
+            children -- attribute names and key columns of child tables
+        Returns:
+            list of parent Result objects with lists of children
+        """
+        return db.db.Fetch(self, result=True, nested=(parent_key, children))
+
+    def FetchMapping(self, db, key, value):
+        """
+        Executes expression and returns dict from values of the key column
+        to values of the value column, i.e. FetchMapping(db, db.Users.id,
+        db.Users.login). Both columns must be selected.
+
+        Arguments:
+            db -- db to fetch from
+            key -- key column
+            value -- value column
+        Returns:
+            dict
+        Raises:
+            ValueError if the column is not selected
+        """
+        return db.db.Fetch(self, result=True,
+                mapping=(self._Index(key), self._Index(value)))
+
+    def FetchScalars(self, db, column):
+        """
+        Executes expression and returns values of one selected column.
+
+        Arguments:
+            db -- db to fetch from
+            column -- selected column
+        Returns:
+            list of values
+        Raises:
+            ValueError if the column is not selected
+        """
+        return db.db.Fetch(self, result=True, scalars=self._Index(column))
+
+    def FetchOne(self, db):
+        """
+        Executes expression limited to one row.
+
+        Arguments:
+            db -- db to fetch from
+        Returns:
+            Result object or None if there are no rows
+        """
+        rows = db.db.Fetch(self._First(), result=True)
+        return rows[0] if rows else None
+
+    def FetchScalar(self, db, column=None):
+        """
+        Executes expression limited to one row and returns one value.
+
+        Arguments:
+            db -- db to fetch from
+            column -- selected column, the first one by default
+        Returns:
+            value or None if there are no rows
+        Raises:
+            ValueError if the column is not selected
+        """
+        index = self._Index(column) if column is not None else 0
+        values = db.db.Fetch(self._First(), result=True, scalars=index)
+        return values[0] if values else None
+
+    def Exists(self, db):
+        """
+        Checks if the expression returns any rows with SELECT EXISTS,
+        so the database stops at the first matching row.
+
+        Arguments:
+            db -- db to fetch from
+        Returns:
+            True or False
+        """
+        query = self._Derive(['SELECT EXISTS ('] + self.sql + self._Tail() +
+                [')'])
+        query.select_columns = ['exists']
+        query.adapters = []
+        query.combine = max
+        return bool(db.db.Fetch(query, result=True, scalars=0)[0])
+
+    def Count(self, db):
+        """
+        Counts rows of the expression with COUNT(*) in the database.
+
+        Arguments:
+            db -- db to fetch from
+        Returns:
+            number of rows
+        """
+        query = self._Derive(['SELECT COUNT(*) FROM ('] + self.sql +
+                self._Tail() + [')'])
+        query.select_columns = ['count']
+        query.adapters = []
+        limit = self.limit
+        # Counts of shards are summed, each one is limited separately
+        query.combine = sum if limit is None else (
+                lambda counts: min(sum(counts), limit))
+        return db.db.Fetch(query, result=True, scalars=0)[0]
+
+    def _First(self):
+        """Returns the query limited to one row."""
+        query = self._Derive(self.sql)
+        query.suffix = self.suffix
+        query.order = self.order
+        query.limit = 1 if self.limit is None else min(self.limit, 1)
+        return query
+
+    def _Derive(self, sql):
+        """
+        Returns query with other fragments, i.e. the query wrapped into
+        outer SELECT, that keeps columns, adapters, timeout and tables.
+        Queries selecting other columns have to replace columns and
+        adapters.
+
+        Arguments:
+            sql -- list of fragments
+        Returns:
+            SqlBuilder instance
+        """
+        derived = SqlBuilder()
+        derived.prefix = self.prefix
+        derived.sql = sql
+        derived.select_columns = self.select_columns
+        derived.adapters = self.adapters
+        derived.timeout = self.timeout
+        derived.max_rows = self.max_rows
+        derived.max_bytes = self.max_bytes
+        derived.tables = self.tables
+        derived.executions = self.executions
+        return derived
+
+    def _Index(self, column):
+        """
+        Returns position of the column among selected columns.
+
+        Arguments:
+            column -- Column instance
+        Raises:
+            ValueError if the column is not selected
+        """
+        name = ''.join((column.table_name, '.', column.column_name))
+        if name not in self.select_columns:
+            raise ValueError('{0} is not selected'.format(name))
+        return self.select_columns.index(name)
+
     def FetchConstructed(self, db, data):
         """
         Fetches new data with constrcuted sql but new params.
@@ -1096,5 +4214,122 @@ class SqlBuilder(object):
         Returns:
             fetched data
         """
-        self.sdata.data = data
-        return db.db.Fetch(self, result=True)
\ No newline at end of file
+        self.data = tuple(data)
+        return db.db.Fetch(self, result=True)
+
+    def FetchSince(self, db, watermark_column, last_value=None, state=None,
+            batch_size=1000):
+        """
+        Fetches rows with watermark column greater than the last seen
+        value in batches ordered by the column. The watermark column must
+        be selected, not NULL and grow monotonically, i.e. integer key or
+        epoch time. Values may repeat: batches are ordered by the column
+        and rowid of its table, so rows sharing one value are not skipped
+        at the end of the batch. The table of the watermark column must
+        have rowid.
+
+        The watermark is kept in the state file as the value and rowid of
+        the last row, it is saved after every batch is processed by
+        the caller, so the next call continues from the last processed row.
+
+        Arguments:
+            db -- db to fetch from
+            watermark_column -- monotonic column
+            last_value -- value to start after, defaults to saved watermark
+            state -- path of json file keeping watermarks
+            batch_size -- number of rows in one batch
+        Returns:
+            generator of lists of Result objects
+        Raises:
+            ValueError if watermark column is not selected or db is
+            sharded, rowids of shards are not comparable
+        """
+        if isinstance(db.db, ShardedDb):
+            raise ValueError('FetchSince is not supported on ShardedDb')
+        self._Index(watermark_column)
+        name = ''.join((watermark_column.table_name, '.',
+            watermark_column.column_name))
+        watermarks = {}
+        if state and os.path.exists(state):
+            with open(state) as state_file:
+                watermarks = json.load(state_file)
+        last_rowid = None
+        if last_value is None:
+            last_value = watermarks.get(name)
+            if isinstance(last_value, list):
+                last_value, last_rowid = last_value
+        else:
+            last_value = watermark_column.to_db(last_value)
+
+        column = watermark_column.column_name
+        rowid = 'watermark_rowid'
+        select = '{0}, {1}.rowid AS {2}'.format(self.sql[0],
+                watermark_column.table_name, rowid)
+        while True:
+            page = self._Derive(['SELECT * FROM (', select] + self.sql[1:] +
+                    [')'])
+            page.select_columns = self.select_columns + [rowid]
+            if last_rowid is not None:
+                page.sql += [' WHERE ({0}, {1}) > ('.format(column, rowid),
+                        Param(last_value), ', ', Param(last_rowid), ')']
+            elif last_value is not None:
+                page.sql += [' WHERE {0} > '.format(column),
+                        Param(last_value)]
+            page.suffix = [' ORDER BY {0}, {1}'.format(column, rowid)]
+            page.order = ([column, rowid], False)
+            page.limit = batch_size
+            rows = db.db.Fetch(page, result=True)
+            if not rows:
+                return
+            for row in rows:
+                last_rowid = row.__dict__.pop(rowid)
+            last_value = watermark_column.to_db(getattr(rows[-1], column))
+            yield rows
+
+            if state:
+                watermarks[name] = [last_value, last_rowid]
+                with open(state + '.tmp', 'w') as state_file:
+                    json.dump(watermarks, state_file)
+                os.rename(state + '.tmp', state)
+            if len(rows) < batch_size:
+                return
+
+    def ExportTo(self, db, path, format='csv', batch_size=1000):
+        """
+        Executes expression and streams the results to the file.
+
+        Arguments:
+            db -- db to fetch from
+            path -- path of the file
+            format -- 'csv' or 'jsonl'
+            batch_size -- number of rows written at once
+        Returns:
+            number of written rows
+        """
+        return db.db.Export(self, path, format, batch_size)
+
+class Prepared(SqlBuilder):
+    """
+    Query compiled ahead of time by precompile.py. Functions of the
+    generated module create an instance with bound parameters for every
+    call. ORDER BY and LIMIT are kept apart from the statement, so fetch
+    methods limiting or merging rows work with it. ShardedDb can not
+    read values of the shard key from the compiled text and sends
+    prepared queries to all shards.
+    """
+    def __init__(self, query, params=()):
+        """
+        Constructor.
+
+        Arguments:
+            query -- tuple of sql text, selected columns, adapters, names
+                of tables, script flag, sql text of ORDER BY, ordering
+                columns and direction, and limit
+            params -- tuple of parameters
+        """
+        SqlBuilder.__init__(self)
+        (sql, self.select_columns, self.adapters, tables, self.script,
+                suffix, self.order, self.limit) = query
+        self.sql = [Statement(sql, params)]
+        self.suffix = [suffix] if suffix else []
+        self.tables = set(tables)
@@ -2,16 +2,65 @@
 # -*- coding: utf-8 -*-
 """Unit tests."""
 
+from datetime import date, datetime
+import json
+import imp
+import os
+import shutil
 import sql
 from sql import InvalidOrderError, InvalidTypeError
+from sql import QueryCancelledError, QueryTimeoutError, ResultTooLargeError
+import sqlite3
+import tempfile
+import threading
 import unittest
 
+import precompile
+
 __author__ = "Gennadiy Zlobin"
 __email__ = "gennad.zlobin@gmail.com"
 __status__ = "Production"
 __version__ = "1.0.0"
 
 
+class Articles(sql.Table):
+    """Table with full-text columns."""
+    id = sql.IntegerColumn()
+    title = sql.FullTextColumn()
+    body = sql.FullTextColumn()
+
+
+class Missing(sql.Table):
+    """Table that is never created."""
+    id = sql.IntegerColumn()
+
+
+class Veterans(sql.Table):
+    """Common table expression over users."""
+    id = sql.IntegerColumn()
+    login = sql.StringColumn()
+
+
+class Logins(sql.Table):
+    """Table with datetime column stored as epoch."""
+    id = sql.IntegerColumn()
+    time = sql.DateTimeColumn(storage='epoch')
+
+
+class UsersPerFlag(sql.SummaryTable):
+    """Number of users and sum of positions per flag."""
+    source = sql.Db.Users
+    flag = sql.StringColumn()
+    users = sql.CountColumn()
+    positions = sql.SumColumn(sql.Db.Users.position)
+
+
+class UsersTotal(sql.SummaryTable):
+    """Number of all users."""
+    source = sql.Db.Users
+    users = sql.CountColumn()
+
+
 class TestSql(unittest.TestCase):
     """Test case for testing sql module."""
 
@@ -84,6 +133,810 @@ class TestSql(unittest.TestCase):
         row = rows[0]
         self.assertTrue(row.login == 'Mark')
 
+    def test_update_many(self):
+        """Tests updating rows by the list of keys."""
+        count = self.db.UpdateMany(self.db.Users, self.db.Users.id, [
+                {self.db.Users.id: 1, self.db.Users.login: 'Greg2'},
+                {'id': 2, 'login': 'Mike2', 'flag': 'C'},
+                {'id': 10, 'login': 'Nobody'}])
+        self.assertEquals(count, 2)
+
+        self.query.Select(self.db.Users.id, self.db.Users.login,
+                self.db.Users.flag).From(self.db.Users).Where(
+                self.db.Users.id.In([1, 2]))
+        rows = self.query.FetchFrom(self.db)
+        result = dict((row.id, (row.login, row.flag)) for row in rows)
+        self.assertEquals(result, {1: (u'Greg2', None), 2: (u'Mike2', u'C')})
+
+    def test_delete_many(self):
+        """Tests deleting rows by the list of keys in chunks."""
+        db = sql.Db(self.db_type, {'max_variables': 2})
+        count = db.DeleteMany(db.Users, db.Users.id, iter([1, 2, 3, 10]))
+        self.assertEquals(count, 3)
+
+        self.query.Select(self.db.Users.id).From(self.db.Users)
+        rows = self.query.FetchFrom(self.db)
+        self.assertEquals([row.id for row in rows], [4])
+
+    def test_reflect(self):
+        """Tests reading tables from the existing database."""
+        connection = sqlite3.connect(self.db.db.name)
+        connection.execute('DROP TABLE IF EXISTS orders')
+        connection.execute('CREATE TABLE orders (id INTEGER, '
+                'title VARCHAR(10), created DATETIME)')
+        connection.execute("INSERT INTO orders VALUES (1, 'book', "
+                "'2012-01-01')")
+        connection.commit()
+        connection.close()
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = os.path.join(directory, 'schema.json')
+        db = sql.Db(self.db_type)
+        self.assertTrue('orders' in db.Reflect(cache))
+        self.assertFalse('Orders' in db.__dict__)
+
+        self.assertTrue(isinstance(db.Orders.id, sql.IntegerColumn))
+        self.assertTrue(isinstance(db.Orders.title, sql.StringColumn))
+        self.assertTrue(isinstance(db.Orders.created, sql.DateTimeColumn))
+        self.query.Select(db.Orders.all).From(db.Orders).Where(
+                db.Orders.title == 'book')
+        rows = self.query.FetchFrom(db)
+        self.assertEquals(rows[0].id, 1)
+
+        # Schema is read from the cache file
+        db = sql.Db(self.db_type, {'name': 'missing.db'})
+        db.db._ReadSchema = None
+        db.Reflect(cache)
+        self.assertEquals(db.Orders.get_name(), 'orders')
+        with self.assertRaises(AttributeError):
+            db.Customers
+
+    def test_export(self):
+        """Tests exporting results to csv and json lines."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.query.Select(self.db.Users.id, self.db.Users.login).From(
+                self.db.Users).Where(self.db.Users.id < 3)
+
+        path = os.path.join(directory, 'users.csv')
+        self.assertEquals(self.query.ExportTo(self.db, path, batch_size=1), 2)
+        with open(path) as export_file:
+            self.assertEquals(export_file.read().splitlines(),
+                    ['id,login', '1,Greg', '2,Mike'])
+
+        path = os.path.join(directory, 'users.jsonl')
+        self.assertEquals(self.query.ExportTo(self.db, path, 'jsonl'), 2)
+        with open(path) as export_file:
+            rows = [json.loads(line) for line in export_file]
+        self.assertEquals(rows, [{'id': 1, 'login': 'Greg'},
+            {'id': 2, 'login': 'Mike'}])
+
+        with self.assertRaises(NotImplementedError):
+            self.query.ExportTo(self.db, path, 'xml')
+
+    def test_import(self):
+        """Tests loading rows from csv and json lines."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'users.csv')
+        with open(path, 'wb') as import_file:
+            import_file.write('id,login,position,unknown\n'
+                    '10,Anna,1,x\n11,Bob,,y\n12,Carl,3,z\n')
+        count = self.db.ImportFrom(self.db.Users, path, batch_size=2)
+        self.assertEquals(count, 3)
+
+        path = os.path.join(directory, 'users.jsonl')
+        with open(path, 'wb') as import_file:
+            import_file.write('{"id": 13, "login": "Dan", '
+                    '"last_login_time": "2012-01-01"}\n')
+        count = self.db.ImportFrom(self.db.Users, path, 'jsonl',
+                columns=[self.db.Users.id, self.db.Users.login,
+                    self.db.Users.last_login_time])
+        self.assertEquals(count, 1)
+
+        self.query.Select(self.db.Users.id, self.db.Users.login,
+                self.db.Users.position).From(self.db.Users).Where(
+                self.db.Users.id > 9)
+        rows = self.query.FetchFrom(self.db)
+        result = dict((row.id, (row.login, row.position)) for row in rows)
+        self.assertEquals(result, {10: (u'Anna', 1), 11: (u'Bob', None),
+            12: (u'Carl', 3), 13: (u'Dan', None)})
+
+        with open(path, 'wb') as import_file:
+            import_file.write('{"id": "x", "login": "Eve"}\n')
+        with self.assertRaises(InvalidTypeError):
+            self.db.ImportFrom(self.db.Users, path, 'jsonl')
+
+    def test_session(self):
+        """Tests writing recorded changes at once."""
+        with sql.Session(self.db) as session:
+            session.Update(self.db.Users, self.db.Users.id,
+                    {self.db.Users.id: 1, self.db.Users.login: 'Greg2'})
+            session.Update(self.db.Users, self.db.Users.id,
+                    {'id': 1, 'flag': 'C'})
+            session.Update(self.db.Users, self.db.Users.id,
+                    {'id': 2, 'login': 'Mike2'})
+            session.Insert(self.db.Users, {'id': 5, 'login': 'Nick'})
+            session.Insert(self.db.Users, {'id': 6, 'login': 'Olga'})
+            session.Delete(self.db.Users, self.db.Users.id, 2)
+            session.Delete(self.db.Users, self.db.Users.id, 6)
+            session.Delete(self.db.Users, self.db.Users.id, 3)
+            self.assertEquals(len(session.updates), 1)
+
+        self.query.Select(self.db.Users.id, self.db.Users.login,
+                self.db.Users.flag).From(self.db.Users)
+        rows = self.query.FetchFrom(self.db)
+        result = dict((row.id, (row.login, row.flag)) for row in rows)
+        self.assertEquals(result, {1: (u'Greg2', u'C'), 4: (u'admin', u'B'),
+            5: (u'Nick', None)})
+        self.assertEquals(session.Flush(), 0)
+
+    def test_timeout(self):
+        """Tests interrupting long queries."""
+        with sql.Session(self.db) as session:
+            for i in range(10, 2010):
+                session.Insert(self.db.Users, {'id': i})
+                session.Insert(self.db.Managers, {'id': i})
+        self.query.Select(self.db.Users.id).From(self.db.Users,
+                self.db.Managers).Where(
+                self.db.Users.position > self.db.Managers.id)
+
+        with self.assertRaises(QueryTimeoutError):
+            self.query.Timeout(0.001).FetchFrom(self.db)
+
+        db = sql.Db(self.db_type, {'timeout': 0.001})
+        with self.assertRaises(QueryTimeoutError):
+            self.query.Timeout(None).FetchFrom(db)
+
+        timer = threading.Timer(0.001, self.query.Cancel)
+        timer.start()
+        with self.assertRaises(QueryCancelledError):
+            self.query.FetchFrom(self.db)
+        timer.join()
+        timer = threading.Timer(0.001, self.query.Cancel)
+        timer.start()
+        with self.assertRaises(QueryCancelledError):
+            self.query.Count(self.db)
+        timer.join()
+
+        # Cancel after the query completed does not affect the next run
+        self.query.Cancel()
+        self.assertFalse(self.query.executions)
+
+        self.assertEquals(len(self.query.Timeout(60).FetchFrom(self.db)), 3)
+
+    def test_query_log(self):
+        """Tests aggregating queries by fingerprint."""
+        query_log = sql.QueryLog(max_queries=3)
+        db = sql.Db(self.db_type, {'query_log': query_log})
+        for ids in [[1], [1, 2], [1, 2, 3]]:
+            self.query.Select(db.Users.id).From(db.Users).Where(
+                    db.Users.id.In(ids))
+            self.query.FetchFrom(db)
+        self.query.Update(db.Users).Set(db.Users.login == 'x').Where(
+                db.Users.id < 3)
+        self.query.Execute(db)
+        self.query.Delete().From(db.Users).Where(db.Users.id == 4)
+        self.query.Execute(db)
+
+        top = query_log.Top()
+        self.assertEquals(len(top), 3)
+        stats = dict((stats['fingerprint'], stats) for stats in top)
+        select = stats['SELECT Users.id FROM users WHERE Users.id IN (?, ...)']
+        self.assertEquals((select['count'], select['rows']), (3, 6))
+        update = stats['UPDATE users SET login = ? WHERE Users.id < ?']
+        self.assertEquals((update['count'], update['rows']), (1, 2))
+        self.assertEquals(sql.QueryLog.Fingerprint(
+            'SELECT a FROM b WHERE c IN (?)'), sql.QueryLog.Fingerprint(
+                'SELECT a FROM b WHERE c IN (?, ?, ?)'))
+        self.assertEquals(sql.QueryLog.Fingerprint(
+            'SELECT a FROM b WHERE c in(?)'),
+            'SELECT a FROM b WHERE c IN (?, ...)')
+
+        # Least recently seen fingerprint is evicted
+        query_log.Record('SELECT 1', 0.01, 1)
+        self.assertEquals(len(query_log.Top()), 3)
+        self.assertFalse(any(stats['fingerprint'].startswith('SELECT Users')
+            for stats in query_log.Top()))
+
+        query_log = sql.QueryLog()
+        for elapsed in [0.1, 0.2, 0.3]:
+            query_log.Record('SELECT a FROM b WHERE c IN (?,\n ?)',
+                    elapsed, 1)
+        query_log.Record('SELECT a FROM b', 0.01, 5)
+        top = query_log.Top(1)
+        self.assertEquals(top[0]['fingerprint'],
+                'SELECT a FROM b WHERE c IN (?, ...)')
+        self.assertEquals((top[0]['count'], top[0]['rows'], top[0]['p50']),
+                (3, 3, 0.2))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'report.txt')
+        query_log.Dump(path)
+        with open(path) as report_file:
+            self.assertEquals(len(report_file.readlines()), 2)
+
+    def test_index_advisor(self):
+        """Tests recommending indexes for recorded queries."""
+        advisor = sql.IndexAdvisor()
+        db = sql.Db(self.db_type, {'index_advisor': advisor})
+        for login in ['Greg', 'Mike']:
+            self.query.Select(db.Users.id).From(db.Users).Where(
+                    db.Users.login == login).And(db.Users.position > 1)
+            self.query.FetchFrom(db)
+        self.query.Select(db.Users.id, db.Managers.photo).From(
+                db.Users).InnerJoin(db.Managers).On(
+                db.Users.id == db.Managers.id)
+        self.query.FetchFrom(db)
+
+        statements = [statement for statement, _ in advisor.Recommend(db)]
+        self.assertTrue('CREATE INDEX IF NOT EXISTS idx_users_login_position'
+                ' ON users (login, position)' in statements)
+
+        connection = sqlite3.connect(db.db.name)
+        connection.execute(statements[0])
+        connection.execute('CREATE INDEX idx_managers_id ON managers (id)')
+        connection.commit()
+        connection.close()
+        remaining = [statement for statement, _ in advisor.Recommend(db)]
+        self.assertFalse(statements[0] in remaining)
+
+        for detail in ['SCAN TABLE managers', 'SCAN managers',
+                'SEARCH TABLE managers USING AUTOMATIC COVERING INDEX (id=?)',
+                'SEARCH managers USING AUTOMATIC COVERING INDEX (id=?)']:
+            match = advisor.SCAN.search(detail)
+            self.assertEquals(match.group(1) or match.group(2), 'managers')
+        self.assertFalse(advisor.SCAN.search(
+                'SEARCH managers USING INTEGER PRIMARY KEY (rowid=?)'))
+
+    def test_fetch_since(self):
+        """Tests fetching rows after the saved watermark."""
+        state = os.path.join(tempfile.mkdtemp(), 'state.json')
+        self.query.Select(self.db.Users.id, self.db.Users.login).From(
+                self.db.Users).Where(self.db.Users.login != 'admin')
+        batches = [[row.id for row in rows] for rows in self.query.FetchSince(
+            self.db, self.db.Users.id, state=state, batch_size=2)]
+        self.assertEquals(batches, [[1, 2], [3]])
+
+        self.query.Insert(self.db.Users).Columns(self.db.Users.id,
+                self.db.Users.login).Values(5, 'Nick')
+        self.query.Execute(self.db)
+        self.query.Select(self.db.Users.id, self.db.Users.login).From(
+                self.db.Users).Where(self.db.Users.login != 'admin')
+        batches = [[row.id for row in rows] for rows in self.query.FetchSince(
+            self.db, self.db.Users.id, state=state, batch_size=2)]
+        self.assertEquals(batches, [[5]])
+
+        rows = next(self.query.FetchSince(self.db, self.db.Users.id, 2))
+        self.assertEquals([row.id for row in rows], [3, 5])
+
+        with self.assertRaises(ValueError):
+            next(self.query.FetchSince(self.db, self.db.Users.position))
+
+        # Rows sharing the watermark value are split between batches
+        self.query.Select(self.db.Users.id, self.db.Users.position).From(
+                self.db.Users).Where(self.db.Users.position > 0)
+        batches = [[row.id for row in rows] for rows in self.query.FetchSince(
+            self.db, self.db.Users.position, batch_size=2)]
+        self.assertEquals(batches, [[2, 3], [4]])
+        state = os.path.join(os.path.dirname(state), 'positions.json')
+        rows = sum(self.query.FetchSince(self.db, self.db.Users.position,
+            state=state, batch_size=2), [])
+        self.assertEquals([row.id for row in rows], [2, 3, 4])
+        self.assertFalse(hasattr(rows[0], 'watermark_rowid'))
+        self.query.Insert(self.db.Users).Columns(self.db.Users.id,
+                self.db.Users.position).Values(6, 5)
+        self.query.Execute(self.db)
+        self.query.Select(self.db.Users.id, self.db.Users.position).From(
+                self.db.Users).Where(self.db.Users.position > 0)
+        batches = [[row.id for row in rows] for rows in self.query.FetchSince(
+            self.db, self.db.Users.position, state=state, batch_size=2)]
+        self.assertEquals(batches, [[6]])
+        shutil.rmtree(os.path.dirname(state))
+
+    def test_full_text(self):
+        """Tests full-text search."""
+        self.query.DropTable(Articles)
+        self.query.Execute(self.db)
+        self.query.CreateTable(Articles)
+        self.query.Execute(self.db)
+        for values in [(1, 'SQLite tips', 'Use indexes'),
+                (2, 'Python', 'SQLite and SQLite again'),
+                (3, 'Cooking', 'Soup')]:
+            self.query.Insert(Articles).Columns(Articles.id, Articles.title,
+                    Articles.body).Values(*values)
+            self.query.Execute(self.db)
+
+        self.query.Select(Articles.id).From(Articles).Match(Articles,
+                'sqlite')
+        self.assertEquals([row.id for row in self.query.FetchFrom(self.db)],
+                [2, 1])
+        self.query.Select(Articles.id).From(Articles).Match(Articles.title,
+                'sqlite')
+        self.assertEquals([row.id for row in self.query.FetchFrom(self.db)],
+                [1])
+        # Full-text index is not copied to the replica
+        replicated = sql.Db(self.db_type, {'replica': True})
+        self.assertEquals(self.query.FetchScalars(replicated, Articles.id),
+                [1])
+        self.query.Select(Articles.id).From(Articles)
+        self.assertEquals(len(self.query.FetchFrom(replicated)), 3)
+
+        self.query.Update(Articles).Set(Articles.body == 'Soup with SQLite'
+                ).Where(Articles.id == 3)
+        self.query.Execute(self.db)
+        self.query.Delete().From(Articles).Where(Articles.id == 2)
+        self.query.Execute(self.db)
+        self.query.Select(Articles.id).From(Articles).Match(Articles.body,
+                'sqlite').And(Articles.id > 0)
+        self.assertEquals([row.id for row in self.query.FetchFrom(self.db)],
+                [3])
+
+    def test_replica(self):
+        """Tests reading hot tables from in-memory replica."""
+        db = sql.Db(self.db_type, {'replica': [self.db.Managers]})
+        self.query.Select(db.Managers.photo).From(db.Managers)
+        self.assertEquals([row.photo for row in self.query.FetchFrom(db)],
+                ['photo.jpg'])
+        self.assertFalse(db.db.replica_stale)
+
+        # Changes made elsewhere are not visible until replica is reloaded
+        connection = sqlite3.connect(db.db.name)
+        connection.execute("UPDATE managers SET photo = 'new.jpg'")
+        connection.commit()
+        connection.close()
+        self.assertEquals(self.query.FetchFrom(db)[0].photo, 'photo.jpg')
+
+        # Writes through the db go to the file and refresh the replica
+        self.query.Insert(db.Managers).Columns(db.Managers.id,
+                db.Managers.photo).Values(2, 'second.jpg')
+        self.query.Execute(db)
+        self.assertTrue(db.db.replica_stale)
+        self.query.Select(db.Managers.photo).From(db.Managers)
+        self.assertEquals(sorted(row.photo
+            for row in self.query.FetchFrom(db)), ['new.jpg', 'second.jpg'])
+
+        # Queries touching other tables are served from the file
+        self.query.Select(db.Users.id).From(db.Users)
+        self.assertEquals(len(self.query.FetchFrom(db)), 4)
+
+        db = sql.Db(self.db_type, {'replica': True})
+        self.query.Select(db.Users.id, db.Managers.photo).From(
+                db.Users).InnerJoin(db.Managers).On(
+                db.Users.id == db.Managers.id)
+        self.assertEquals(len(self.query.FetchFrom(db)), 2)
+
+        # Tables named like the beginning of a virtual table are copied
+        connection = sqlite3.connect(db.db.name)
+        connection.execute('CREATE VIRTUAL TABLE manage USING fts5(x)')
+        connection.close()
+        try:
+            db = sql.Db(self.db_type, {'replica': [self.db.Managers]})
+            self.query.Select(db.Managers.photo).From(db.Managers)
+            self.assertEquals(len(self.query.FetchFrom(db)), 2)
+            self.assertFalse(db.db.replica_stale)
+        finally:
+            connection = sqlite3.connect(db.db.name)
+            connection.execute('DROP TABLE manage')
+            connection.close()
+
+    def test_fetch_batch(self):
+        """Tests executing several queries on one connection."""
+        users = sql.SqlBuilder()
+        users.Select(self.db.Users.login).From(self.db.Users).Where(
+                self.db.Users.id == 2)
+        managers = sql.SqlBuilder()
+        managers.Select(self.db.Managers.photo).From(self.db.Managers)
+        count = sql.SqlBuilder()
+        count.Select(self.db.Users.id).From(self.db.Users).Where(
+                self.db.Users.position == 5)
+        queries = [users, managers, count]
+
+        for options in ({}, {'snapshot': True}, {'workers': 2}):
+            results = self.db.FetchBatch(queries, **options)
+            self.assertEquals(results[0][0].login, 'Mike')
+            self.assertEquals(results[1][0].photo, 'photo.jpg')
+            self.assertEquals(len(results[2]), 3)
+        self.assertFalse(self.db.db.held)
+        with self.assertRaises(ValueError):
+            self.db.FetchBatch(queries, snapshot=True, workers=2)
+
+    def test_guard(self):
+        """Tests limits of fetched rows and bytes."""
+        query_log = sql.QueryLog()
+        db = sql.Db(self.db_type, {'max_rows': 3, 'batch_size': 2,
+            'query_log': query_log})
+        self.query.Select(db.Users.login).From(db.Users)
+        with self.assertRaises(ResultTooLargeError):
+            self.query.FetchFrom(db)
+        with self.assertRaises(ResultTooLargeError):
+            self.query.FetchScalars(db, db.Users.login)
+        self.query.Guard(max_rows=4)
+        self.assertEquals(len(self.query.FetchFrom(db)), 4)
+        self.assertEquals(query_log.Top()[0]['peak_bytes'], 17)
+
+        self.query.Guard(max_bytes=16)
+        with self.assertRaises(ResultTooLargeError):
+            self.query.FetchMapping(db, db.Users.login, db.Users.login)
+        self.query.Guard(max_rows=4, max_bytes=17)
+        self.assertEquals(self.query.Count(db), 4)
+        self.assertEquals(len(self.query.FetchFrom(db)), 4)
+
+    def test_precompile(self):
+        """Tests precompiled query module."""
+        users = sql.SqlBuilder()
+        users.Select(self.db.Users.id, self.db.Users.login).From(
+                self.db.Users).Where(
+                self.db.Users.last_login_time < sql.Bind('since')).And(
+                self.db.Users.login != 'admin').OrderBy(self.db.Users.id)
+        login = sql.SqlBuilder()
+        login.Update(self.db.Users).Set(
+                self.db.Users.login == sql.Bind('login')).Where(
+                self.db.Users.id == sql.Bind('id'))
+        times = sql.SqlBuilder()
+        times.Select(self.db.Users.last_login_time).From(
+                self.db.Users).Where(self.db.Users.id.In(
+                    [sql.Bind('first'), sql.Bind('second')]))
+        recent = sql.SqlBuilder()
+        recent.Select(self.db.Users.id).From(self.db.Users).Where(
+                self.db.Users.id < sql.Bind('below')).OrderBy(
+                self.db.Users.id, descending=True).Limit(2)
+        path = os.path.join(tempfile.mkdtemp(), 'queries.py')
+        with open(path, 'w') as module_file:
+            module_file.write(precompile.Generate({'Users': users,
+                'SetLogin': login, 'Times': times, 'Recent': recent}))
+        queries = imp.load_source('queries', path)
+
+        self.assertEquals(queries.Users('2011-01-01').FetchMapping(self.db,
+            self.db.Users.id, self.db.Users.login), {1: 'Greg', 3: 'Alex'})
+        self.assertEquals(queries.Users(datetime(2015, 1, 1)).Count(self.db),
+                3)
+        queries.SetLogin(id=3, login='Alexander').Execute(self.db)
+        self.assertEquals(queries.Users('2011-01-01').FetchOne(self.db).login,
+                'Greg')
+        self.assertEquals(queries.Users('2000-01-01').FetchScalar(self.db),
+                3)
+        self.assertEquals(queries.Times(2, 3).FetchScalars(self.db,
+            self.db.Users.last_login_time),
+            ['2014-01-01', '1999-01-01'])
+        self.query.Select(self.db.Users.login).From(self.db.Users).Where(
+                self.db.Users.id == 3)
+        self.assertEquals(self.query.FetchScalar(self.db), 'Alexander')
+
+        self.assertEquals(queries.Recent(4).FetchScalars(self.db,
+            self.db.Users.id), [3, 2])
+        self.assertEquals(queries.Recent(4).FetchOne(self.db).id, 3)
+        self.assertEquals(queries.Recent(4).FetchScalar(self.db), 3)
+        self.assertEquals(queries.Recent(4).Count(self.db), 2)
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_order_by(self):
+        """Tests ORDER BY and LIMIT."""
+        self.query.Select(self.db.Users.id).From(self.db.Users).OrderBy(
+                self.db.Users.id, descending=True).Limit(2)
+        self.assertEquals(self.query.Compile(), ('SELECT Users.id FROM users '
+            'ORDER BY Users.id DESC LIMIT ?', (2,)))
+        self.assertEquals(self.query.FetchScalars(self.db, self.db.Users.id),
+                [4, 3])
+        self.assertEquals(self.query.Count(self.db), 2)
+        self.assertEquals(self.query.FetchOne(self.db).id, 4)
+        with self.assertRaises(InvalidOrderError):
+            self.query.Select(self.db.Users.id).Limit(1)
+
+    def test_sharded(self):
+        """Tests routing rows to shards and merging fan-out results."""
+        threads = threading.active_count()
+        directory = tempfile.mkdtemp()
+        names = [os.path.join(directory, 'shard{0}.db'.format(i))
+                for i in range(3)]
+        db = sql.Db('sharded', {'names': names, 'keys': [sql.Db.Users.id]})
+        for table in (db.Users, db.Managers):
+            self.query.CreateTable(table)
+            self.query.Execute(db)
+        for i in range(10):
+            self.query.Insert(db.Users).Columns(db.Users.id, db.Users.login,
+                    db.Users.position).Values(i, 'user{0}'.format(i), i % 2)
+            self.query.Execute(db)
+        self.query.Insert(db.Managers).Columns(db.Managers.id,
+                db.Managers.photo).Values(1, 'photo.jpg')
+        self.query.Execute(db)
+
+        for i, name in enumerate(names):
+            shard = sql.Db('sqlite', {'name': name})
+            self.query.Select(shard.Users.id).From(shard.Users)
+            ids = self.query.FetchScalars(shard, shard.Users.id)
+            self.assertTrue(ids)
+            self.assertEquals([key % 3 for key in ids], [i] * len(ids))
+            self.query.Select(shard.Managers.id).From(shard.Managers)
+            self.assertEquals(self.query.Count(shard), 1)
+
+        self.query.Select(db.Users.login).From(db.Users).Where(
+                db.Users.id == 4)
+        self.assertEquals(len(db.db._Route(self.query)), 1)
+        self.assertEquals(self.query.FetchScalar(db), 'user4')
+        self.query.Select(db.Users.id).From(db.Users).Where(
+                db.Users.id.In([1, 4]))
+        self.assertEquals(len(db.db._Route(self.query)), 1)
+        self.query.Select(db.Users.id).From(db.Users).Where(
+                db.Users.id == 1).Or(db.Users.id == 2)
+        self.assertEquals(len(db.db._Route(self.query)), 3)
+
+        self.query.Select(db.Users.id, db.Users.login).From(
+                db.Users).OrderBy(db.Users.id, descending=True).Limit(3)
+        self.assertEquals(self.query.FetchScalars(db, db.Users.id),
+                [9, 8, 7])
+        self.assertEquals(self.query.FetchMapping(db, db.Users.id,
+            db.Users.login), {9: 'user9', 8: 'user8', 7: 'user7'})
+        self.assertEquals(self.query.FetchOne(db).id, 9)
+        self.assertEquals(self.query.Count(db), 3)
+        self.query.Select(db.Users.login).From(db.Users).OrderBy(db.Users.id)
+        with self.assertRaises(ValueError):
+            self.query.FetchFrom(db)
+        self.query.Select(db.Users.id, db.Users.login).From(db.Users)
+        self.assertEquals(len(self.query.FetchMapping(db, db.Users.id,
+            db.Users.login)), 10)
+        self.assertEquals(self.query.Count(db), 10)
+        self.assertTrue(self.query.Exists(db))
+
+        self.query.Select(db.Users.id).From(db.Users).InnerJoin(
+                db.Managers).On(db.Users.position == db.Managers.id)
+        self.assertEquals(sorted(self.query.FetchScalars(db, db.Users.id)),
+                [1, 3, 5, 7, 9])
+
+        self.query.Update(db.Users).Set(db.Users.login == 'five').Where(
+                db.Users.id == 5)
+        self.query.Execute(db)
+        self.query.Delete().From(db.Users).Where(db.Users.position == 0)
+        self.query.Execute(db)
+        self.query.Select(db.Users.id, db.Users.login).From(db.Users)
+        mapping = self.query.FetchMapping(db, db.Users.id, db.Users.login)
+        self.assertEquals(sorted(mapping), [1, 3, 5, 7, 9])
+        self.assertEquals(mapping[5], 'five')
+
+        # Helpers writing raw statements are routed by the shard key
+        self.assertEquals(db.UpdateMany(db.Users, db.Users.id, [
+            {'id': 1, 'login': 'one'}, {'id': 3, 'login': 'three'}]), 2)
+        self.assertEquals(db.DeleteMany(db.Users, db.Users.id, [7, 9]), 2)
+        with sql.Session(db) as session:
+            session.Insert(db.Users, {'id': 11, 'login': 'user11'})
+            session.Insert(db.Managers, {'id': 2, 'photo': 'two.jpg'})
+        path = os.path.join(directory, 'users.csv')
+        with open(path, 'wb') as import_file:
+            import_file.write('id,login\n12,user12\n13,user13\n')
+        self.assertEquals(db.ImportFrom(db.Users, path), 2)
+        self.query.Select(db.Users.id, db.Users.login).From(db.Users)
+        self.assertEquals(self.query.FetchMapping(db, db.Users.id,
+            db.Users.login), {1: 'one', 3: 'three', 5: 'five',
+                11: 'user11', 12: 'user12', 13: 'user13'})
+        for i, name in enumerate(names):
+            shard = sql.Db('sqlite', {'name': name})
+            self.query.Select(shard.Users.id).From(shard.Users)
+            self.assertEquals([key % 3 for key in self.query.FetchScalars(
+                shard, shard.Users.id)], [i] * 2)
+            self.query.Select(shard.Managers.id).From(shard.Managers)
+            self.assertEquals(self.query.Count(shard), 2)
+        with self.assertRaises(ValueError):
+            db.UpdateMany(db.Users, db.Users.login, [{'id': 2,
+                'login': 'one'}])
+        with self.assertRaises(NotImplementedError):
+            self.query.ExportTo(db, path)
+
+        with self.assertRaises(ValueError):
+            self.query.Update(db.Users).Set(db.Users.id == 20).Where(
+                    db.Users.id == 5)
+            self.query.Execute(db)
+        with self.assertRaises(ValueError):
+            self.query.Insert(db.Users).Columns(db.Users.login).Values('x')
+            self.query.Execute(db)
+
+        self.query.Select(db.Users.id).From(db.Users)
+        with self.assertRaises(ValueError):
+            next(self.query.FetchSince(db, db.Users.id))
+
+        # Prepared queries go to all shards and are merged
+        recent = sql.SqlBuilder()
+        recent.Select(db.Users.id, db.Users.login).From(db.Users).Where(
+                db.Users.id < sql.Bind('below')).OrderBy(db.Users.id,
+                descending=True).Limit(2)
+        path = os.path.join(directory, 'queries.py')
+        with open(path, 'w') as module_file:
+            module_file.write(precompile.Generate({'Recent': recent}))
+        queries = imp.load_source('sharded_queries', path)
+        self.assertEquals(len(db.db._Route(queries.Recent(9))), 3)
+        self.assertEquals(queries.Recent(9).FetchScalars(db, db.Users.id),
+                [5, 3])
+        self.assertEquals(queries.Recent(9).FetchOne(db).login, 'five')
+        self.assertEquals(queries.Recent(9).Count(db), 2)
+        db.Close()
+        self.assertEquals(threading.active_count(), threads)
+        shutil.rmtree(directory)
+
+    def test_summary_table(self):
+        """Tests summary table following writes to the source table."""
+        def grouped():
+            """Returns aggregates computed from the source table."""
+            connection = sqlite3.connect(self.db.db.name)
+            rows = connection.execute('SELECT flag, COUNT(*), '
+                    'IFNULL(SUM(position), 0) FROM users GROUP BY flag')
+            result = dict((row[0], row[1:]) for row in rows)
+            connection.close()
+            return result
+
+        def summary():
+            """Returns aggregates kept by the summary table."""
+            self.query.Select(UsersPerFlag.flag, UsersPerFlag.users,
+                    UsersPerFlag.positions).From(UsersPerFlag)
+            return dict((row.flag, (row.users, row.positions))
+                    for row in self.query.FetchFrom(self.db))
+
+        self.query.DropTable(UsersPerFlag)
+        self.query.Execute(self.db)
+        self.query.CreateTable(UsersPerFlag)
+        self.query.Execute(self.db)
+        self.assertEquals(summary(), grouped())
+
+        self.query.Insert(self.db.Users).Columns(self.db.Users.id,
+                self.db.Users.flag, self.db.Users.position).Values(5, 'C', 7)
+        self.query.Execute(self.db)
+        self.db.db.ExecuteMany([('INSERT INTO users (id, flag) '
+            'VALUES (?, ?)', [(6, None), (7, 'C')])])
+        self.assertEquals(summary()['C'], (2, 7))
+        self.assertEquals(summary(), grouped())
+
+        self.query.Update(self.db.Users).Set(self.db.Users.flag == 'B').Where(
+                self.db.Users.flag == 'C')
+        self.query.Execute(self.db)
+        self.assertFalse('C' in summary())
+        self.query.Update(self.db.Users).Set(
+                self.db.Users.position == 1).Where(self.db.Users.id == 6)
+        self.query.Execute(self.db)
+        self.assertEquals(summary(), grouped())
+        self.query.Delete().From(self.db.Users).Where(self.db.Users.id == 6)
+        self.query.Execute(self.db)
+        self.assertEquals(summary(), grouped())
+        self.assertEquals(summary()[None], grouped()[None])
+
+        # Plain tables may have column named source
+        pages = type('Pages', (sql.Table,), {'id': sql.IntegerColumn(),
+            'source': sql.StringColumn()})
+        self.assertFalse('pages' in sql.MetaTable.summaries)
+        self.query.DropTable(pages)
+        self.query.Execute(self.db)
+        self.query.CreateTable(pages)
+        self.query.Execute(self.db)
+        self.query.Insert(pages).Columns(pages.id, pages.source).Values(1,
+                'web')
+        self.query.Execute(self.db)
+        self.query.DropTable(pages)
+        self.query.Execute(self.db)
+
+        self.query.DropTable(UsersPerFlag)
+        self.query.Execute(self.db)
+
+        self.query.DropTable(UsersTotal)
+        self.query.Execute(self.db)
+        self.query.CreateTable(UsersTotal)
+        self.query.Execute(self.db)
+        self.query.Update(self.db.Users).Set(self.db.Users.flag == 'D')
+        self.query.Execute(self.db)
+        self.query.Delete().From(self.db.Users).Where(self.db.Users.id == 5)
+        self.query.Execute(self.db)
+        self.query.Select(UsersTotal.users).From(UsersTotal)
+        self.assertEquals(self.query.FetchScalar(self.db), 5)
+        self.query.DropTable(UsersTotal)
+        self.query.Execute(self.db)
+
+        # Source is assigned after the class is created, so the invalid
+        # tables are not registered as summaries of Veterans
+        empty = type('Empty', (sql.SummaryTable,), {'id': sql.IntegerColumn()})
+        empty.source = Veterans
+        wrong = type('Wrong', (sql.SummaryTable,), {
+            'flag': sql.StringColumn(), 'users': sql.CountColumn()})
+        wrong.source = Veterans
+        for table in (empty, wrong):
+            query = sql.SqlBuilder()
+            with self.assertRaises(InvalidTypeError):
+                query.CreateTable(table)
+            self.assertEquals(query.sql, [])
+        self.assertFalse('veterans' in sql.MetaTable.summaries)
+
+    def test_retry(self):
+        """Tests retrying statements while the database is locked."""
+        policy = sql.RetryPolicy(max_attempts=100, busy_timeout=0)
+        db = sql.Db(self.db_type, {'retry': policy})
+        blocker = sqlite3.connect(db.db.name, check_same_thread=False)
+        blocker.execute('BEGIN EXCLUSIVE')
+        threading.Timer(0.1, blocker.rollback).start()
+        self.query.Insert(db.Users).Columns(db.Users.id).Values(10)
+        self.query.Execute(db)
+        self.assertTrue(policy.Stats()['retries'] > 0)
+        self.assertEquals(policy.Stats()['recovered'], 1)
+
+        policy.max_attempts = 2
+        blocker.execute('BEGIN EXCLUSIVE')
+        try:
+            self.query.Select(db.Users.id).From(db.Users)
+            with self.assertRaises(sqlite3.OperationalError):
+                self.query.FetchFrom(db)
+            with self.assertRaises(sqlite3.OperationalError):
+                db.DeleteMany(db.Users, db.Users.id, [10])
+        finally:
+            blocker.rollback()
+        self.assertEquals(policy.Stats()['failures'], 2)
+        self.assertEquals(db.DeleteMany(db.Users, db.Users.id, [10]), 1)
+
+        self.assertFalse(policy.IsSafe('CREATE TABLE t (a); DROP TABLE t',
+            script=True))
+        policy.writes = False
+        self.assertTrue(policy.IsSafe('SELECT 1'))
+        self.assertFalse(policy.IsSafe('DELETE FROM users'))
+
+    def test_write_queue(self):
+        """Tests grouping writes from many threads."""
+        db = sql.Db(self.db_type, {'write_queue': {'max_batch': 8}})
+        futures = []
+
+        def insert(i):
+            """Inserts one user."""
+            query = sql.SqlBuilder()
+            query.Insert(db.Users).Columns(db.Users.id).Values(i)
+            futures.append(query.Execute(db))
+
+        threads = [threading.Thread(target=insert, args=(i,))
+                for i in range(10, 30)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.query.Insert(Missing).Columns(Missing.id).Values(1)
+        failed = self.query.Execute(db)
+        db.db.write_queue.Close()
+
+        self.assertEquals([future.Wait() for future in futures], [1] * 20)
+        with self.assertRaises(sqlite3.OperationalError):
+            failed.Wait()
+        self.query.Select(self.db.Users.id).From(self.db.Users)
+        self.assertEquals(len(self.query.FetchFrom(self.db)), 24)
+
+        # Script is not grouped with other statements and not replayed
+        db = sql.Db(self.db_type, {'write_queue': {'max_delay': 0.5}})
+        queue = db.db.write_queue
+        futures = [queue.Put('INSERT INTO users (id) VALUES (?)', (30,)),
+                queue.Put('INSERT INTO users (id) VALUES (31)', (), True),
+                queue.Put('INSERT INTO missing (id) VALUES (?)', (1,))]
+        queue.Close()
+        self.assertEquals([future.Wait() for future in futures[:2]], [1, 0])
+        with self.assertRaises(sqlite3.OperationalError):
+            futures[2].Wait()
+        self.query.Select(self.db.Users.id).From(self.db.Users).Where(
+                self.db.Users.id >= 30)
+        self.assertEquals(sorted(self.query.FetchScalars(self.db,
+            self.db.Users.id)), [30, 31])
+
+        # Statement committing on its own is not grouped nor replayed
+        db = sql.Db(self.db_type, {'write_queue': {'max_delay': 0.5}})
+        queue = db.db.write_queue
+        futures = [queue.Put('INSERT INTO users (id) VALUES (?)', (40,)),
+                queue.Put('CREATE TABLE extra (id INT)', ()),
+                queue.Put('INSERT INTO users (id) VALUES (?)', (41,)),
+                queue.Put('INSERT INTO missing (id) VALUES (?)', (1,))]
+        db.Close()
+        try:
+            self.assertEquals([future.Wait() for future in futures[:3]],
+                    [1, 0, 1])
+            with self.assertRaises(sqlite3.OperationalError):
+                futures[3].Wait()
+            self.query.Select(self.db.Users.id).From(self.db.Users).Where(
+                    self.db.Users.id >= 40)
+            self.assertEquals(sorted(self.query.FetchScalars(self.db,
+                self.db.Users.id)), [40, 41])
+        finally:
+            connection = sqlite3.connect(self.db.db.name)
+            connection.execute('DROP TABLE IF EXISTS extra')
+            connection.close()
+
     def test_delete(self):
         """Tests deleting."""
         self.query = sql.SqlBuilder()
@@ -118,6 +971,90 @@ class TestSql(unittest.TestCase):
         result = dict((row.id, row.login) for row in rows)
         self.assertEquals(result, {1: u'Greg', 3: u'Alex'})
 
+    def test_datetime(self):
+        """Tests storing datetime column as epoch."""
+        self.query.DropTable(Logins)
+        self.query.Execute(self.db)
+        self.query.CreateTable(Logins)
+        self.query.Execute(self.db)
+        self.addCleanup(sql.SqlBuilder().DropTable(Logins).Execute, self.db)
+        self.query.Insert(Logins).Columns(Logins.id, Logins.time).Values(5,
+                datetime(2013, 5, 1, 12, 30))
+        self.query.Execute(self.db)
+
+        self.query.Select(Logins.id, Logins.time).From(Logins).Where(
+                Logins.time >= date(2013, 1, 1)).And(
+                Logins.time < '2014-01-01')
+        rows = self.query.FetchFrom(self.db)
+        self.assertEquals([(row.id, row.time) for row in rows],
+                [(5, datetime(2013, 5, 1, 12, 30))])
+        self.assertEquals(self.query.FetchMapping(self.db, Logins.id,
+            Logins.time), {5: datetime(2013, 5, 1, 12, 30)})
+
+        connection = sqlite3.connect(self.db.db.name)
+        value = connection.execute('SELECT time FROM logins '
+                'WHERE id = 5').fetchone()[0]
+        connection.close()
+        self.assertEquals(value, 1367411400)
+
+        column = sql.DateTimeColumn()
+        self.assertEquals(column.to_db(date(2013, 5, 1)), '2013-05-01')
+        self.assertEquals(self.db.Users.last_login_time.storage, 'text')
+        with self.assertRaises(InvalidTypeError):
+            Logins.time < '2013-05'
+        with self.assertRaises(ValueError):
+            self.query.Insert(Logins).Columns(Logins.id,
+                    Logins.time).Values(6)
+
+        # Exported rows are imported back
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.query.Select(Logins.id, Logins.time).From(Logins)
+        for format in ('csv', 'jsonl'):
+            path = os.path.join(directory, 'logins.' + format)
+            self.assertEquals(self.query.ExportTo(self.db, path, format), 1)
+        for format in ('csv', 'jsonl'):
+            path = os.path.join(directory, 'logins.' + format)
+            self.assertEquals(self.db.ImportFrom(Logins, path, format), 1)
+        path = os.path.join(directory, 'logins.csv')
+        self.query.Select(Logins.id, Logins.time).From(Logins)
+        self.assertEquals([(row.id, row.time)
+            for row in self.query.FetchFrom(self.db)],
+            [(5, datetime(2013, 5, 1, 12, 30))] * 3)
+        with open(path, 'wb') as import_file:
+            import_file.write('id,time\n8,1367411400\n')
+        self.assertEquals(self.db.ImportFrom(Logins, path), 1)
+        self.query.Delete().From(Logins).Where(Logins.id == 5)
+        self.query.Execute(self.db)
+        self.query.Select(Logins.time).From(Logins)
+        self.assertEquals(self.query.FetchScalars(self.db, Logins.time),
+                [datetime(2013, 5, 1, 12, 30)])
+        self.query.Delete().From(Logins).Where(Logins.id == 8)
+        self.query.Execute(self.db)
+        self.query.Insert(Logins).Columns(Logins.id, Logins.time).Values(5,
+                datetime(2013, 5, 1, 12, 30))
+        self.query.Execute(self.db)
+
+        # Text stored before epoch storage is fetched as it is and
+        # converted once
+        connection = sqlite3.connect(self.db.db.name)
+        connection.executemany('INSERT INTO logins (id, time) '
+                'VALUES (?, ?)', [(6, '2013-05-01 12:30:00'), (7, 'never')])
+        connection.commit()
+        connection.close()
+        self.query.Select(Logins.id, Logins.time).From(Logins)
+        self.assertEquals(self.query.FetchMapping(self.db, Logins.id,
+            Logins.time)[6], '2013-05-01 12:30:00')
+        self.assertEquals(self.db.MigrateToEpoch(Logins.time), 1)
+        self.query.Select(Logins.id).From(Logins).Where(
+                Logins.time >= date(2013, 1, 1)).And(
+                Logins.time < '2014-01-01')
+        self.assertEquals(self.query.FetchScalars(self.db, Logins.id),
+                [5, 6])
+        self.assertEquals(self.db.MigrateToEpoch(Logins.time), 0)
+        with self.assertRaises(InvalidTypeError):
+            self.db.MigrateToEpoch(self.db.Users.last_login_time)
+
     def test_complex_query(self):
         """Tests complex query."""
         self.query.Select(self.db.Users.all).From(self.db.Users).Where(
@@ -150,6 +1087,123 @@ class TestSql(unittest.TestCase):
         row = rows[0]
         self.assertTrue(hasattr(row, 'photo'))
 
+    def test_fetch_mapping(self):
+        """Tests fetching dicts and lists of values."""
+        self.query.Select(self.db.Users.id, self.db.Users.login).From(
+                self.db.Users).Where(self.db.Users.login != 'admin')
+        self.assertEquals(self.query.FetchMapping(self.db, self.db.Users.id,
+            self.db.Users.login), {1: 'Greg', 2: 'Mike', 3: 'Alex'})
+        self.assertEquals(self.query.FetchMapping(self.db,
+            self.db.Users.login, self.db.Users.id),
+            {'Greg': 1, 'Mike': 2, 'Alex': 3})
+        self.assertEquals(sorted(self.query.FetchScalars(self.db,
+            self.db.Users.id)), [1, 2, 3])
+        with self.assertRaises(ValueError):
+            self.query.FetchScalars(self.db, self.db.Users.flag)
+
+        self.query.Select(self.db.Users.last_login_time, self.db.Users.id,
+                self.db.Users.login).From(self.db.Users).Where(
+                self.db.Users.id == 2)
+        self.assertEquals(self.query.FetchMapping(self.db, self.db.Users.id,
+            self.db.Users.last_login_time), {2: '2014-01-01'})
+
+    def test_fetch_one(self):
+        """Tests fetching single row, value, existence and count."""
+        self.query.Select(self.db.Users.login, self.db.Users.id).From(
+                self.db.Users).Where(self.db.Users.position == 5)
+        self.assertTrue(self.query.FetchOne(self.db).login in
+                ('Mike', 'Alex', 'admin'))
+        self.assertEquals(self.query.Count(self.db), 3)
+        self.assertTrue(self.query.Exists(self.db))
+        self.assertEquals(self.query.Compile()[0].count('LIMIT'), 0)
+
+        # Converters of selected columns are not applied to the count
+        self.query.Select(self.db.Users.last_login_time, self.db.Users.id
+                ).From(self.db.Users)
+        self.assertEquals(self.query.Count(self.db), 4)
+        self.assertTrue(self.query.Exists(self.db) is True)
+        self.query.Select(self.db.Users.id, self.db.Users.last_login_time
+                ).From(self.db.Users)
+        self.assertEquals(self.query.Count(self.db), 4)
+
+        self.query.Select(self.db.Users.login, self.db.Users.id).From(
+                self.db.Users).Where(self.db.Users.id == 2)
+        self.assertEquals(self.query.FetchScalar(self.db), 'Mike')
+        self.assertEquals(self.query.FetchScalar(self.db, self.db.Users.id),
+                2)
+
+        self.query.Select(self.db.Users.login).From(self.db.Users).Where(
+                self.db.Users.id == 10)
+        self.assertEquals(self.query.FetchOne(self.db), None)
+        self.assertEquals(self.query.FetchScalar(self.db), None)
+        self.assertEquals(self.query.Count(self.db), 0)
+        self.assertFalse(self.query.Exists(self.db))
+
+    def test_subquery(self):
+        """Tests IN and EXISTS subqueries and common table expressions."""
+        managers = sql.SqlBuilder()
+        managers.Select(self.db.Managers.id).From(self.db.Managers).Where(
+                self.db.Managers.photo == 'photo.jpg')
+        self.query.Select(self.db.Users.id).From(self.db.Users).Where(
+                self.db.Users.login != 'admin').And(
+                self.db.Users.id.In(managers))
+        self.assertEquals(self.query.Compile()[1], ('admin', 'photo.jpg'))
+        self.assertEquals(self.query.FetchScalars(self.db, self.db.Users.id),
+                [1])
+        self.assertEquals(self.query.tables, set(['users', 'managers']))
+        self.query.Select(self.db.Users.id).From(self.db.Users).Where(
+                self.db.Users.login != 'admin').And(
+                self.db.Users.id.NotIn(managers))
+        self.assertEquals(sorted(self.query.FetchScalars(self.db,
+            self.db.Users.id)), [2, 3])
+
+        managers.Select(self.db.Managers.id).From(self.db.Managers).Where(
+                self.db.Managers.id == self.db.Users.id)
+        self.query.Select(self.db.Users.id).From(self.db.Users).Where(
+                sql.Exists(managers))
+        self.assertEquals(self.query.FetchScalars(self.db, self.db.Users.id),
+                [1])
+        self.query.Select(self.db.Users.id).From(self.db.Users).Where(
+                sql.NotExists(managers) & (self.db.Users.id < 4))
+        self.assertEquals(sorted(self.query.FetchScalars(self.db,
+            self.db.Users.id)), [2, 3])
+
+        veterans = sql.SqlBuilder()
+        veterans.Select(self.db.Users.id, self.db.Users.login).From(
+                self.db.Users).Where(
+                self.db.Users.last_login_time < '2011-01-01')
+        self.query.With(Veterans, veterans).Select(Veterans.login).From(
+                Veterans).Where(Veterans.id > 1)
+        self.assertTrue(self.query.Compile()[0].startswith(
+            'WITH veterans AS (SELECT '))
+        self.assertEquals(sorted(self.query.FetchScalars(self.db,
+            Veterans.login)), ['Alex', 'admin'])
+        self.assertEquals(self.query.Count(self.db), 2)
+        self.assertTrue('users' in self.query.tables)
+        self.query.Select(self.db.Users.id).From(self.db.Users)
+        self.assertFalse(self.query.Compile()[0].startswith('WITH'))
+
+    def test_fetch_nested(self):
+        """Tests grouping joined rows under the parent rows."""
+        self.query.Insert(self.db.Managers).Columns(self.db.Managers.id,
+                self.db.Managers.photo).Values(5, 'boss.jpg')
+        self.query.Execute(self.db)
+
+        self.query.Select(self.db.Users.id, self.db.Users.login,
+                self.db.Managers.id, self.db.Managers.photo).From(
+                self.db.Users).LeftJoin(self.db.Managers).On(
+                self.db.Users.position == self.db.Managers.id)
+        rows = self.query.FetchNested(self.db, self.db.Users.id,
+                managers=self.db.Managers.id)
+        users = dict((row.id, row) for row in rows)
+        self.assertEquals(len(rows), 4)
+        self.assertEquals(users[2].login, 'Mike')
+        self.assertEquals(users[1].managers, [])
+        self.assertEquals([manager.photo for manager in users[2].managers],
+                ['boss.jpg'])
+        # Child rows are hydrated once and shared
+        self.assertTrue(users[2].managers[0] is users[3].managers[0])
+
     def test_in(self):
         """Tests working with sets."""
         self.query.Select(self.db.Users.id).From(self.db.Users).Where(
@@ -163,6 +1217,33 @@ class TestSql(unittest.TestCase):
         rows = self.query.FetchFrom(self.db)
         self.assertTrue(len(rows) == 1)
 
+    def test_in_single_value(self):
+        """Tests IN with one element sequence."""
+        self.query.Select(self.db.Users.id).From(self.db.Users).Where(
+                self.db.Users.id.In([3]))
+        rows = self.query.FetchFrom(self.db)
+        self.assertEquals([row.id for row in rows], [3])
+
+    def test_expression_nodes(self):
+        """Tests structural comparison and reuse of conditions."""
+        condition = self.db.Users.position == 5
+        self.assertEquals(condition, self.db.Users.position == 5)
+        self.assertNotEquals(condition, self.db.Users.position == 6)
+        self.assertEquals(hash(condition), hash(self.db.Users.position == 5))
+        self.assertEquals(condition.Compile(), ('Users.position = ?', (5,)))
+
+        self.query.Select(self.db.Users.id).From(self.db.Users).Where(
+                condition)
+        self.assertEquals(len(self.query.FetchFrom(self.db)), 3)
+
+        other = sql.SqlBuilder()
+        other.Select(self.db.Users.id).From(self.db.Users).Where(
+                condition & (self.db.Users.flag == 'B'))
+        self.assertEquals(other.Compile(), ('SELECT Users.id FROM users '
+                'WHERE (Users.position = ? AND Users.flag = ?)', (5, 'B')))
+        self.assertEquals(len(other.FetchFrom(self.db)), 2)
+        self.assertTrue(other.Compile() is other.Compile())
+
     def test_new_params(self):
         """Tests working with constructed query."""
         self.query.Select(self.db.Users.id).From(self.db.Users).Where(
@@ -192,6 +1273,33 @@ class TestSql(unittest.TestCase):
                     self.db.Users.id == 1).Where(
                         self.db.Users.login == 'admin')
 
+    def test_order_checking_threads(self):
+        """Tests checking order of queries built in several threads."""
+        errors = []
+
+        def build(update):
+            """Builds queries and collects order errors."""
+            query = sql.SqlBuilder()
+            for _ in range(2000):
+                try:
+                    if update:
+                        query.Update(self.db.Users).Set(
+                                self.db.Users.login == 'x').Where(
+                                self.db.Users.id == 1)
+                    else:
+                        query.Select(self.db.Users.id).From(
+                                self.db.Users).Where(self.db.Users.id == 1)
+                except InvalidOrderError as error:
+                    errors.append(error)
+
+        threads = [threading.Thread(target=build, args=(i % 2,))
+                for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+
     def test_sql_injection(self):
         """Tests protection from SQL injection."""
         self.query.Select(self.db.Users.all).From(self.db.Users).Where(